@@ -0,0 +1,50 @@
+"""Benchmarks for the performance sensitive parts of the application.
+
+Each module within this package can be run on its own, for example
+
+    python -m benchmarks.decode
+
+and prints the throughput of the approaches being compared. The whole suite,
+covering ingestion, training, prediction and the HTTP endpoints at a range of
+sizes, is run with
+
+    python -m benchmarks --output results.json
+
+see benchmarks/__main__.py for comparing the results against a baseline.
+
+"""
+
+import time
+from collections.abc import Callable
+from typing import Any
+
+FIT_FILE = "tests/activity.fit"
+
+
+def measure(
+    func: Callable[..., Any],
+    *args,
+    repeat: int = 3,
+    setup: Callable[[], Any] | None = None,
+    **kwargs,
+) -> float:
+    """The best wall time in seconds from repeated calls of func.
+
+    Taking the minimum rather than the mean gives the most stable value, since
+    any noise from the rest of the machine can only ever slow things down. The
+    setup is called before each repeat without being timed.
+
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name: str, seconds: float, items: int, unit: str = "points") -> None:
+    """Print the time taken along with the throughput."""
+    print(f"{name:<32} {seconds:8.3f} s {items / seconds:12,.0f} {unit}/s")
@@ -0,0 +1,357 @@
+"""Run the benchmark suite, saving the results and comparing them to a baseline.
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --baseline results.json --sizes 10000,100000,1000000
+
+Each benchmark is run at each of the sizes, the number of points in the
+activity, taking the best time of a few repeats. The results are written to
+JSON along with a description of the machine and commit, and when a baseline
+from a previous run is given, any benchmark which has become slower than the
+threshold is reported as a regression with a non-zero exit status.
+
+Only compare results from the same machine, the times depend as much on the
+hardware as the code.
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+from sqlmodel import Session
+
+from python_demo import course, derived, machine_learning
+from python_demo.database import create_db_engine
+from python_demo.models import create_db_and_tables
+
+from . import measure, spatial, synthetic
+
+DEFAULT_SIZES = [10_000, 100_000]
+# Requests made to /predict for each size, it doesn't depend on the course
+PREDICT_REQUESTS = 200
+
+
+# The benchmarks of the suite in the order they are run, each taking the suite
+# and the size, and returning the seconds taken and the number of items.
+Benchmark = Callable[["Suite", int], tuple[float, int]]
+BENCHMARKS: list[tuple[str, str, Benchmark]] = []
+
+
+def benchmark(name: str, unit: str = "points"):
+    """Register a function as one of the benchmarks of the suite."""
+
+    def register(func: Benchmark) -> Benchmark:
+        BENCHMARKS.append((name, unit, func))
+        return func
+
+    return register
+
+
+class Suite:
+    """The benchmarks, run within a temporary directory."""
+
+    def __init__(self, directory: Path, repeat: int):
+        self.directory = directory
+        self.repeat = repeat
+        self.benchmarks = list(BENCHMARKS)
+        # The course uploaded by POST /course for each size
+        self.courses: dict[int, int] = {}
+        self._fits: dict[int, Path] = {}
+        self._client = None
+        self._users = 0
+
+    def measure(self, func: Callable[..., Any], *args, **kwargs) -> float:
+        return measure(func, *args, repeat=self.repeat, **kwargs)
+
+    def engine(self, name: str):
+        engine = create_db_engine(f"sqlite:///{self.directory / name}.db")
+        create_db_and_tables(engine)
+        return engine
+
+    def fit_file(self, size: int) -> tuple[Path, int]:
+        """A FIT file of about size points, along with the number of points."""
+        if size not in self._fits:
+            self._fits[size] = synthetic.fit_of_size(self.directory, size)
+        path = self._fits[size]
+        return path, len(course.fit_to_columns(path)["latitude"])
+
+    def client(self):
+        """A client for the application, logged in with a user."""
+        if self._client is None:
+            # The application configures itself from the environment when it
+            # is imported, so this has to be set first.
+            os.environ["DATABASE_URL"] = f"sqlite:///{self.directory / 'http.db'}"
+            os.environ["UPLOAD_DIR"] = str(self.directory / "uploads")
+            os.environ.setdefault("SECRET_KEY", "benchmark-secret-key-of-32-bytes")
+            from fastapi.testclient import TestClient
+
+            from python_demo.main import app
+
+            self._client = TestClient(app)
+            self._client.__enter__()
+            self.new_user()
+        return self._client
+
+    def new_user(self) -> None:
+        """Log the client in with a user which hasn't uploaded anything."""
+        self._users += 1
+        credentials = {"username": f"benchmark{self._users}", "password": "benchmark"}
+        self.client().post("/user", data=credentials)
+        self.client().post("/auth", data=credentials)
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.__exit__(None, None, None)
+
+    def run(self, sizes: list[int]) -> list[dict]:
+        results = []
+        for name, unit, func in self.benchmarks:
+            for size in sizes:
+                seconds, items = func(self, size)
+                result = {
+                    "name": name,
+                    "size": size,
+                    "seconds": seconds,
+                    "items": items,
+                    "unit": unit,
+                }
+                print(
+                    f"{name:<28} {size:>9,d} {seconds:10.4f} s "
+                    f"{items / seconds:14,.0f} {unit}/s",
+                    flush=True,
+                )
+                results.append(result)
+        return results
+
+
+@benchmark("fit_to_columns")
+def fit_to_columns(suite: Suite, size: int) -> tuple[float, int]:
+    path, n_points = suite.fit_file(size)
+    return suite.measure(course.fit_to_columns, path), n_points
+
+
+@benchmark("fit_to_dataframes")
+def fit_to_dataframes(suite: Suite, size: int) -> tuple[float, int]:
+    path, n_points = suite.fit_file(size)
+    return suite.measure(course.fit_to_dataframes, path), n_points
+
+
+@benchmark("decode_fit")
+def decode_fit(suite: Suite, size: int) -> tuple[float, int]:
+    path, n_points = suite.fit_file(size)
+    return suite.measure(course.decode_fit, path), n_points
+
+
+@benchmark("store_course")
+def store_course(suite: Suite, size: int) -> tuple[float, int]:
+    engine = suite.engine(f"store_{size}")
+    chunks = synthetic.synthetic_chunks(size)
+
+    def store():
+        with Session(engine) as session:
+            course.store_course(session, chunks, user_id=None, name="store")
+
+    return suite.measure(store), size
+
+
+@benchmark("store_derived")
+def store_derived(suite: Suite, size: int) -> tuple[float, int]:
+    engine = suite.engine(f"derived_{size}")
+    with Session(engine) as session:
+        course_id = course.store_course(
+            session, synthetic.synthetic_chunks(size), user_id=None, name="derived"
+        ).id
+
+    def store():
+        with Session(engine) as session:
+            derived.store_derived(session, course_id)
+
+    return suite.measure(store), size
+
+
+@benchmark("spatial.points_near", unit="queries")
+def points_near(suite: Suite, size: int) -> tuple[float, int]:
+    """Search around positions within courses with size points in total."""
+    engine = suite.engine(f"spatial_{size}")
+    user_id, positions = spatial.fill(engine, size)
+    around = spatial.queries(positions)
+    return suite.measure(spatial.search, engine, user_id, around), len(around)
+
+
+@benchmark("calculate_gradient")
+def calculate_gradient(suite: Suite, size: int) -> tuple[float, int]:
+    df = synthetic.synthetic_frame(size)
+    seconds = suite.measure(
+        machine_learning.calculate_gradient, df["lat"], df["lon"], df["altitude"]
+    )
+    return seconds, size
+
+
+@benchmark("generate_model")
+def generate_model(suite: Suite, size: int) -> tuple[float, int]:
+    points = synthetic.synthetic_points(size)
+    return suite.measure(machine_learning.generate_model, points), size
+
+
+@benchmark("PowerModel.partial_fit")
+def partial_fit(suite: Suite, size: int) -> tuple[float, int]:
+    df = synthetic.synthetic_frame(size)
+
+    def fit():
+        machine_learning.PowerModel().partial_fit(*machine_learning.training_data(df))
+
+    return suite.measure(fit), size
+
+
+def wait_for_course(client, job_id: str) -> int:
+    """Wait for the job of an upload, returning the id of its course."""
+    while True:
+        response = client.get(f"/course/jobs/{job_id}", follow_redirects=False)
+        if response.status_code == 303:
+            return int(response.headers["location"].split("/")[-1])
+        if response.json()["status"] == "failed":
+            raise RuntimeError(response.json()["error"])
+        time.sleep(0.01)
+
+
+@benchmark("POST /course")
+def post_course(suite: Suite, size: int) -> tuple[float, int]:
+    """Upload the file and wait for the job to store it.
+
+    Uploading a file the user already has only finds the existing course, so
+    each repeat is by a new user.
+
+    """
+    client = suite.client()
+    path, n_points = suite.fit_file(size)
+
+    def upload():
+        with open(path, "rb") as file:
+            response = client.post("/course", files={"file": (path.name, file)})
+        # The location of the job is linked from the page shown after uploading
+        job_id = re.search(r"/course/jobs/(\d+)", response.text).group(1)
+        suite.courses[size] = wait_for_course(client, job_id)
+
+    return suite.measure(upload, setup=suite.new_user), n_points
+
+
+@benchmark("GET /course/{id}/points")
+def get_points(suite: Suite, size: int) -> tuple[float, int]:
+    client = suite.client()
+    _, n_points = suite.fit_file(size)
+
+    def points():
+        response = client.get(f"/course/{suite.courses[size]}/points")
+        response.raise_for_status()
+
+    return suite.measure(points), n_points
+
+
+@benchmark("POST /predict", unit="requests")
+def post_predict(suite: Suite, size: int) -> tuple[float, int]:
+    client = suite.client()
+
+    def predict():
+        for _ in range(PREDICT_REQUESTS):
+            response = client.post("/predict", data={"speed": 30, "gradient": 1})
+            response.raise_for_status()
+
+    return suite.measure(predict), PREDICT_REQUESTS
+
+
+def environment() -> dict[str, str]:
+    """A description of where the benchmarks were run."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": str(os.cpu_count()),
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def compare(results: list[dict], baseline: list[dict], threshold: float) -> list[str]:
+    """The benchmarks which are slower than the baseline by more than threshold."""
+    previous = {(result["name"], result["size"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result["name"], result["size"]))
+        if before is None:
+            continue
+        ratio = result["seconds"] / before["seconds"]
+        if ratio > 1 + threshold:
+            regressions.append(
+                f"{result['name']} at {result['size']:,d}: "
+                f"{before['seconds']:.4f} s -> {result['seconds']:.4f} s "
+                f"({ratio:.2f}x)"
+            )
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="Comma separated numbers of points to run each benchmark with.",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, help="Where to write the results.")
+    parser.add_argument("--baseline", type=Path, help="Results to compare against.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="The fraction slower than the baseline which is a regression.",
+    )
+    parser.add_argument(
+        "--only", help="Only run the benchmarks with names containing this."
+    )
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    with tempfile.TemporaryDirectory() as directory:
+        suite = Suite(Path(directory), args.repeat)
+        if args.only:
+            suite.benchmarks = [
+                benchmark for benchmark in suite.benchmarks if args.only in benchmark[0]
+            ]
+        try:
+            results = suite.run(sizes)
+        finally:
+            suite.close()
+
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps({"environment": environment(), "results": results}, indent=2)
+        )
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""Throughput of importing a batch of files with different numbers of workers.
+
+A batch of copies of the test file is recorded and run by the pool of worker
+processes, as POST /course/batch does, timing until every job has finished.
+With enough files to keep every worker busy, the throughput should grow with
+the number of workers up to the number of cores.
+
+    python -m benchmarks.bulk_import --files 16
+
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from sqlmodel import Session
+
+from python_demo import jobs
+from python_demo.database import create_db_engine
+from python_demo.models import create_db_and_tables
+
+from . import FIT_FILE, report, synthetic
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=16)
+    parser.add_argument(
+        "--workers",
+        help="Comma separated numbers of workers, by default 1 up to the cores.",
+    )
+    args = parser.parse_args()
+    cores = os.cpu_count() or 1
+    if args.workers:
+        counts = [int(count) for count in args.workers.split(",")]
+    else:
+        counts = sorted({1, *(2**power for power in range(cores.bit_length())), cores})
+    n_points = args.files * synthetic.fit_points()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["UPLOAD_DIR"] = str(Path(directory) / "uploads")
+        for workers in counts:
+            # The pool is created with the number of workers when first used
+            os.environ["INGEST_WORKERS"] = str(workers)
+            engine = create_db_engine(f"sqlite:///{Path(directory) / f'{workers}.db'}")
+            create_db_and_tables(engine)
+            # Starting the workers isn't part of the import
+            jobs.get_executor().submit(os.getpid).result()
+
+            start = time.perf_counter()
+            with Session(engine) as session, open(FIT_FILE, "rb") as file:
+                _, batch_jobs = jobs.create_batch(
+                    session,
+                    [(file, f"{number}.fit") for number in range(args.files)],
+                    user_id=1,
+                )
+                futures = [jobs.submit(engine, job) for job in batch_jobs]
+            for future in futures:
+                future.result()
+            report(f"{workers} workers", time.perf_counter() - start, n_points)
+            jobs.shutdown()
+
+
+if __name__ == "__main__":
+    main()
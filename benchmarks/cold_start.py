@@ -0,0 +1,75 @@
+"""Measure the time and memory for a new process to import the application.
+
+Every worker started by the server, or by scaling up, imports the application
+before it can serve a request. The heavy modules for analysing the courses are
+imported when first needed, so this compares importing the application with
+also importing those modules, as happens after the warm up.
+
+Each measurement is made within a new interpreter, since once imported a module
+is never imported again.
+
+    python -m benchmarks.cold_start
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+# Run within the new interpreter, printing the measurements as JSON
+SCRIPT = """
+import json, resource, sys, time
+
+start = time.perf_counter()
+import python_demo.main
+imported = time.perf_counter()
+rss_imported = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+heavy = [name for name in HEAVY if name in sys.modules]
+python_demo.main.warm_up()
+warmed = time.perf_counter()
+rss_warmed = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    "import": imported - start,
+    "warm_up": warmed - imported,
+    "rss_import": rss_imported * 1024,
+    "rss_warm_up": rss_warmed * 1024,
+    "heavy": heavy,
+}))
+"""
+
+# The modules which should only be imported when they are needed
+HEAVY = ["pandas", "sklearn", "geopy", "fitdecode", "pyarrow"]
+
+
+def cold_start() -> dict:
+    """The measurements of importing the application within a new interpreter."""
+    env = {**os.environ, "SECRET_KEY": os.getenv("SECRET_KEY", "cold-start")}
+    output = subprocess.run(
+        [sys.executable, "-c", f"HEAVY = {HEAVY!r}\n{SCRIPT}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main(repeat: int = 5):
+    results = [cold_start() for _ in range(repeat)]
+    # The fastest run has the least noise from the rest of the machine, while
+    # the memory is the same for every run.
+    best = min(results, key=lambda result: result["import"])
+    print(
+        f"import python_demo.main  {best['import']:8.3f} s "
+        f"{best['rss_import'] / 2**20:8.1f} MiB"
+    )
+    print(
+        f"after warm up            {best['import'] + best['warm_up']:8.3f} s "
+        f"{best['rss_warm_up'] / 2**20:8.1f} MiB"
+    )
+    print(f"heavy modules imported   {', '.join(best['heavy']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
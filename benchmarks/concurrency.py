@@ -0,0 +1,108 @@
+"""Throughput of mixed reads and writes from many threads at once.
+
+This mimics the server handling page views while courses are being uploaded,
+with each thread repeatedly performing a unit of work in its own session, as
+each request does. The default engine is compared with the tuned engine from
+python_demo.database, with failures from "database is locked" counted rather
+than stopping the benchmark.
+
+"""
+
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, create_engine, select
+
+from python_demo import course
+from python_demo.database import create_db_engine
+from python_demo.models import Course, CoursePoints, create_db_and_tables
+
+from . import FIT_FILE
+
+THREADS = 16
+REQUESTS = 400
+# The fraction of requests which upload a course, the rest view a course
+WRITE_FRACTION = 0.1
+# Points in each uploaded course, a short ride keeps each write brief
+WRITE_POINTS = 2000
+# Points returned when viewing a course
+PAGE_POINTS = 1000
+
+
+def read(engine, course_ids: list[int]) -> None:
+    with Session(engine) as session:
+        session.exec(select(Course).order_by(Course.start_time.desc())).all()
+        # A page of points, as the course page requests a simplified track
+        session.exec(
+            select(CoursePoints.time, CoursePoints.lat, CoursePoints.lon)
+            .where(CoursePoints.course_id == random.choice(course_ids))
+            .limit(PAGE_POINTS)
+        ).all()
+
+
+def write(engine, columns) -> None:
+    with Session(engine) as session:
+        course.store_course(session, [columns], user_id=None, name="write")
+
+
+def run(engine, columns, course_ids: list[int]) -> tuple[float, int]:
+    """The time to complete all the requests and the number that failed."""
+    small = {key: value[:WRITE_POINTS] for key, value in columns.items()}
+    rng = random.Random(42)
+    work = [rng.random() < WRITE_FRACTION for _ in range(REQUESTS)]
+
+    def request(is_write: bool) -> bool:
+        try:
+            if is_write:
+                write(engine, small)
+            else:
+                read(engine, course_ids)
+        except OperationalError:
+            return False
+        return True
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(THREADS) as executor:
+        succeeded = sum(executor.map(request, work))
+    return time.perf_counter() - start, REQUESTS - succeeded
+
+
+def main():
+    columns = course.fit_to_columns(FIT_FILE)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engines = {
+            "default engine": lambda url: create_engine(
+                url, connect_args={"check_same_thread": False}
+            ),
+            "tuned engine": create_db_engine,
+        }
+        for name, make_engine in engines.items():
+            engine = make_engine(f"sqlite:///{Path(directory) / name}.db")
+            create_db_and_tables(engine)
+            with Session(engine) as session:
+                course_ids = [
+                    course.store_course(
+                        session, [columns], user_id=None, name=str(i)
+                    ).id
+                    for i in range(4)
+                ]
+
+            # The best of a few runs, as with measure, since threads make the
+            # timings noisy.
+            seconds, failed = min(
+                run(engine, columns, course_ids) for _ in range(3)
+            )
+            print(
+                f"{name:<32} {seconds:8.3f} s "
+                f"{REQUESTS / seconds:8.1f} requests/s {failed:6d} failed"
+            )
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""Compare the decoding of a FIT file by rows and by columns."""
+
+from python_demo import course
+from python_demo.models import CoursePoints
+
+from . import FIT_FILE, measure, report
+
+
+def decode_rows(file) -> list[CoursePoints]:
+    """Decode by building a DataFrame and iterating over each of the rows."""
+    return [
+        CoursePoints(
+            lat=row.latitude,
+            lon=row.longitude,
+            time=row.timestamp,
+            heart_rate=row.heart_rate,
+            power=row.power,
+            altitude=row.altitude,
+            speed=row.speed,
+        )
+        for _, row in course.fit_to_dataframes(file).iterrows()
+    ]
+
+
+def main():
+    n_points = len(course.fit_to_columns(FIT_FILE)["latitude"])
+    report("fit_to_columns", measure(course.fit_to_columns, FIT_FILE), n_points)
+    report("fit_to_dataframes", measure(course.fit_to_dataframes, FIT_FILE), n_points)
+    report("decode_fit", measure(course.decode_fit, FIT_FILE), n_points)
+    report("fit_to_dataframes + iterrows", measure(decode_rows, FIT_FILE), n_points)
+
+
+if __name__ == "__main__":
+    main()
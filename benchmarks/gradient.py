@@ -0,0 +1,24 @@
+"""Compare the methods of calculating the gradient between points."""
+
+import pandas as pd
+
+from python_demo import course, machine_learning
+
+from . import FIT_FILE, measure, report
+
+
+def main():
+    columns = course.fit_to_columns(FIT_FILE)
+    lat = pd.Series(columns["latitude"])
+    lon = pd.Series(columns["longitude"])
+    altitude = pd.Series(columns["altitude"])
+
+    for method in ["haversine", "equirectangular", "geodesic"]:
+        seconds = measure(
+            machine_learning.calculate_gradient, lat, lon, altitude, method
+        )
+        report(method, seconds, len(lat), unit="samples")
+
+
+if __name__ == "__main__":
+    main()
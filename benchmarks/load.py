@@ -0,0 +1,164 @@
+"""Load test of the read heavy routes of the running application.
+
+The application is started with uvicorn in a separate process, with a database
+containing a single user and course. Many clients then request each route at
+the same time, with the throughput and latency of the responses reported.
+
+The clients are threads each holding a connection open to the server, which is
+enough to keep the single server process busy.
+
+"""
+
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from sqlmodel import Session
+
+from python_demo import course
+from python_demo.authentication import get_password_hash
+from python_demo.database import create_db_engine
+from python_demo.machine_learning import update_user_model
+from python_demo.models import User, create_db_and_tables
+from python_demo.simplify import store_levels
+
+from . import FIT_FILE
+
+PORT = 8765
+CONCURRENCY = 64
+REQUESTS = 1000
+
+ROUTES = [
+    ("GET", "/home", None),
+    ("GET", "/course/1", None),
+    ("GET", "/course/1/points?format=csv&fields=time,lat,lon&max_points=2000", None),
+    ("POST", "/predict", "speed=30&gradient=1"),
+]
+
+
+def setup_database(url: str) -> None:
+    engine = create_db_engine(url)
+    create_db_and_tables(engine)
+    with Session(engine) as session:
+        user = User(username="load", hashed_password=get_password_hash("test"))
+        session.add(user)
+        session.commit()
+        stored = course.store_course(
+            session,
+            course.iter_fit_columns(FIT_FILE),
+            user_id=user.id,
+            name="load",
+        )
+        store_levels(session, stored.id)
+        update_user_model(session, user.id, stored.id)
+    engine.dispose()
+
+
+def wait_for_server(process: subprocess.Popen) -> None:
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError("The server failed to start")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", PORT)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            return
+        except ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError("The server didn't start in time")
+
+
+def login() -> str:
+    """The cookie of the logged in user."""
+    connection = http.client.HTTPConnection("127.0.0.1", PORT)
+    connection.request(
+        "POST",
+        "/auth",
+        urllib.parse.urlencode({"username": "load", "password": "test"}),
+        {"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    response = connection.getresponse()
+    response.read()
+    return response.getheader("set-cookie").split(";")[0]
+
+
+def load(
+    method: str, path: str, body: str | None, cookie: str
+) -> tuple[list[float], int]:
+    """The latency of each successful request to the route and the failures."""
+    headers = {"Cookie": cookie, "Content-Type": "application/x-www-form-urlencoded"}
+    # One connection per client thread which is kept alive between requests
+    client = threading.local()
+
+    def request(_) -> float | None:
+        if not hasattr(client, "connection"):
+            client.connection = http.client.HTTPConnection("127.0.0.1", PORT)
+        connection = client.connection
+        start = time.perf_counter()
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            return None
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(CONCURRENCY) as executor:
+        results = list(executor.map(request, range(REQUESTS)))
+    latencies = [latency for latency in results if latency is not None]
+    return latencies, len(results) - len(latencies)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{Path(directory) / 'load.db'}"
+        setup_database(url)
+
+        env = {
+            **os.environ,
+            "DATABASE_URL": url,
+            "UPLOAD_DIR": directory,
+            "SECRET_KEY": "load-test-secret-key-of-32-bytes!",
+        }
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "python_demo.main:app",
+                "--port",
+                str(PORT),
+                "--log-level",
+                "warning",
+            ],
+            env=env,
+        )
+        try:
+            wait_for_server(process)
+            cookie = login()
+            print(f"{CONCURRENCY} concurrent clients, {REQUESTS} requests per route")
+            for method, path, body in ROUTES:
+                start = time.perf_counter()
+                latencies, failed = load(method, path, body, cookie)
+                seconds = time.perf_counter() - start
+                p50, p95 = statistics.quantiles(latencies, n=20)[9::8]
+                print(
+                    f"{method} {path.split('?')[0]:<20} "
+                    f"{REQUESTS / seconds:8.1f} requests/s "
+                    f"p50 {p50 * 1000:7.1f} ms p95 {p95 * 1000:7.1f} ms "
+                    f"{failed:5d} failed"
+                )
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Measure the peak memory of ingesting FIT files of increasing length."""
+
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+from sqlmodel import Session, create_engine
+
+from python_demo import course
+from python_demo.models import create_db_and_tables
+
+from . import FIT_FILE
+from .synthetic import chained_fit
+
+
+def peak_memory(engine, path: Path, streamed: bool = True) -> int:
+    """The peak memory in bytes allocated while decoding and storing a file."""
+    tracemalloc.start()
+    chunks = course.iter_fit_columns(path)
+    if not streamed:
+        # Consuming the generator up front holds every chunk in memory at once.
+        chunks = list(chunks)
+    with Session(engine) as session:
+        course.store_course(session, chunks, user_id=None, name="memory")
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    print(f"memory ceiling {course.memory_ceiling() / 2**20:8.1f} MiB")
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{Path(directory) / 'bench.db'}")
+        create_db_and_tables(engine)
+
+        n_points = len(course.fit_to_columns(FIT_FILE)["latitude"])
+        for copies in [1, 2, 4]:
+            path = chained_fit(Path(directory), copies)
+            streamed = peak_memory(engine, path)
+            whole = peak_memory(engine, path, streamed=False)
+            print(
+                f"{copies * n_points:8d} points "
+                f"streamed {streamed / 2**20:8.1f} MiB "
+                f"whole file {whole / 2**20:8.1f} MiB"
+            )
+
+
+if __name__ == "__main__":
+    main()
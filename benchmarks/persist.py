@@ -0,0 +1,40 @@
+"""Compare storing a course through the ORM with the bulk insert path."""
+
+import tempfile
+from pathlib import Path
+
+from sqlmodel import Session, create_engine
+
+from python_demo import course
+from python_demo.models import Course, create_db_and_tables
+
+from . import FIT_FILE, measure, report
+
+
+def store_orm(engine, columns) -> None:
+    """Store the course by creating a CoursePoints object for every point."""
+    with Session(engine) as session:
+        session.add(Course(name="orm", points=course.columns_to_points(columns)))
+        session.commit()
+
+
+def store_bulk(engine, columns) -> None:
+    """Store the course using batched inserts straight from the columns."""
+    with Session(engine) as session:
+        course.store_course(session, [columns], user_id=None, name="bulk")
+
+
+def main():
+    columns = course.fit_to_columns(FIT_FILE)
+    n_points = len(columns["latitude"])
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{Path(directory) / 'bench.db'}")
+        create_db_and_tables(engine)
+
+        report("ORM cascade", measure(store_orm, engine, columns), n_points)
+        report("bulk insert", measure(store_bulk, engine, columns), n_points)
+
+
+if __name__ == "__main__":
+    main()
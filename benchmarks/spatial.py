@@ -0,0 +1,112 @@
+"""Compare searching with the spatial index to scanning every point.
+
+Databases of a growing number of points, as synthetic courses spread over an
+area of about 100 km across, are searched for the points near positions along
+the courses. The time taken by the index should grow much slower than the
+number of points, while the scan, here only the distance calculation over
+positions already in memory, grows with it.
+
+    python -m benchmarks.spatial --sizes 10000,100000,1000000
+
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from sqlmodel import Session
+
+from python_demo import course, spatial
+from python_demo.database import create_db_engine
+from python_demo.geometry import distance_to
+from python_demo.models import User, create_db_and_tables
+
+from . import synthetic
+
+COURSE_POINTS = 10_000
+QUERIES = 100
+RADIUS = 200
+
+
+def fill(engine, n_points: int) -> tuple[int, dict[str, np.ndarray]]:
+    """Store courses with n_points points in total for a user.
+
+    The id of the user is returned along with the positions of every point.
+
+    """
+    rng = np.random.default_rng(0)
+    positions = {"lat": [], "lon": []}
+    with Session(engine) as session:
+        user = User(username="spatial", hashed_password="")
+        session.add(user)
+        session.commit()
+        user_id = user.id
+        for seed in range(max(1, n_points // COURSE_POINTS)):
+            columns = synthetic.synthetic_columns(COURSE_POINTS, seed=seed)
+            # Each course starts from a different place
+            columns["latitude"] += rng.uniform(-0.5, 0.5)
+            columns["longitude"] += rng.uniform(-0.5, 0.5)
+            course.store_course(session, [columns], user_id=user_id, name=str(seed))
+            positions["lat"].append(columns["latitude"])
+            positions["lon"].append(columns["longitude"])
+    return user_id, {name: np.concatenate(values) for name, values in positions.items()}
+
+
+def queries(positions: dict[str, np.ndarray]) -> list[tuple[float, float]]:
+    """Positions near the points of the courses to search around."""
+    rng = np.random.default_rng(1)
+    chosen = rng.integers(0, len(positions["lat"]), QUERIES)
+    return list(zip(positions["lat"][chosen] + 0.001, positions["lon"][chosen]))
+
+
+def search(engine, user_id: int, positions: list[tuple[float, float]]) -> int:
+    """Search around each position, returning the number of points found."""
+    found = 0
+    with Session(engine) as session:
+        for lat, lon in positions:
+            found += len(spatial.points_near(session, user_id, lat, lon, RADIUS))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        default="10000,100000,1000000",
+        help="Comma separated numbers of points to search.",
+    )
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    # The blocks backend stores the courses quickest
+    os.environ["POINT_STORAGE"] = "blocks"
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            engine = create_db_engine(f"sqlite:///{Path(directory) / f'{size}.db'}")
+            create_db_and_tables(engine)
+            user_id, positions = fill(engine, size)
+            around = queries(positions)
+
+            start = time.perf_counter()
+            found = search(engine, user_id, around)
+            indexed = (time.perf_counter() - start) / QUERIES
+
+            start = time.perf_counter()
+            for lat, lon in around:
+                distance = distance_to(lat, lon, positions["lat"], positions["lon"])
+                np.sort(distance[distance <= RADIUS])
+            scanned = (time.perf_counter() - start) / QUERIES
+
+            print(
+                f"{size:>10,d} points {indexed * 1000:8.2f} ms indexed "
+                f"{scanned * 1000:8.2f} ms scan "
+                f"{found / QUERIES:6.0f} points found",
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
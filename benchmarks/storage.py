@@ -0,0 +1,73 @@
+"""Compare storing the points of courses as rows with storing them as blocks.
+
+For each backend of python_demo.storage a database is filled with the same
+synthetic courses, reporting the size of the database along with the time to
+store the courses, read the fields used for training and export the points.
+
+    python -m benchmarks.storage
+
+"""
+
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from sqlmodel import Session
+
+from python_demo import course, export, storage
+from python_demo.database import create_db_engine
+from python_demo.machine_learning import TRAINING_FIELDS
+from python_demo.models import create_db_and_tables
+
+from . import measure, report, synthetic
+
+COURSES = 10
+POINTS = 20_000
+
+
+def main():
+    chunks = synthetic.synthetic_chunks(POINTS)
+    n_points = COURSES * POINTS
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in storage.BACKENDS:
+            # The backend is read as each course is stored
+            os.environ["POINT_STORAGE"] = backend
+            path = Path(directory) / f"{backend}.db"
+            engine = create_db_engine(f"sqlite:///{path}")
+            create_db_and_tables(engine)
+
+            start = time.perf_counter()
+            with Session(engine) as session:
+                course_ids = [
+                    course.store_course(session, chunks, user_id=None, name="a").id
+                    for _ in range(COURSES)
+                ]
+            report(f"{backend} store_course", time.perf_counter() - start, n_points)
+
+            with engine.connect() as connection:
+                connection.exec_driver_sql("VACUUM")
+            size = path.stat().st_size / 2**20
+            print(f"{backend + ' database size':<32} {size:8.1f} MiB")
+
+            def load(engine=engine, course_ids=course_ids):
+                with Session(engine) as session:
+                    for course_id in course_ids:
+                        course.load_points(session, course_id, TRAINING_FIELDS)
+
+            report(f"{backend} load_points", measure(load), n_points)
+
+            def stream(engine=engine, course_ids=course_ids):
+                with Session(engine) as session:
+                    for course_id in course_ids:
+                        content = export.stream_points(
+                            session, course_id, export.POINT_FIELDS, "json"
+                        )
+                        for _ in content:
+                            pass
+
+            report(f"{backend} export json", measure(stream), n_points)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Create activities of any length for the benchmarks.
+
+There are two sources of activities:
+ - FIT files made by chaining copies of the test file together, which the FIT
+   format supports and fitdecode reads as a single stream. These exercise the
+   decoding with real data, in multiples of the length of the test file.
+ - Columns of points generated from a random walk, in the same format as
+   fit_to_columns, for any number of points without the cost of decoding.
+
+"""
+
+import math
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from python_demo import course
+from python_demo.models import CoursePoints
+
+from . import FIT_FILE
+
+
+def fit_points() -> int:
+    """The number of points within the test file."""
+    return sum(len(chunk["latitude"]) for chunk in course.iter_fit_columns(FIT_FILE))
+
+
+def chained_fit(directory: Path, copies: int) -> Path:
+    """Create a FIT file consisting of the test file repeated copies times."""
+    path = directory / f"chained_{copies}.fit"
+    path.write_bytes(Path(FIT_FILE).read_bytes() * copies)
+    return path
+
+
+def fit_of_size(directory: Path, n_points: int) -> Path:
+    """A FIT file with approximately n_points points, at least one copy."""
+    return chained_fit(directory, max(1, math.ceil(n_points / fit_points())))
+
+
+def synthetic_columns(n_points: int, seed: int = 0) -> course.FitColumns:
+    """A ride of n_points points, one each second, as returned by fit_to_columns.
+
+    The position is a random walk at about 30 km/h and the power depends on the
+    speed and gradient, so the model has a relationship to find.
+
+    """
+    rng = np.random.default_rng(seed)
+    speed = np.clip(8 + np.cumsum(rng.normal(0, 0.05, n_points)), 0, 20)
+    heading = np.cumsum(rng.normal(0, 0.05, n_points))
+    # Metres to degrees, near enough for a benchmark
+    lat = -34.9 + np.cumsum(speed * np.cos(heading)) / 111_000
+    lon = 138.6 + np.cumsum(speed * np.sin(heading)) / 91_000
+    altitude = 50 + np.cumsum(rng.normal(0, 0.1, n_points))
+    climb = np.diff(altitude, prepend=altitude[0])
+    power = np.clip(
+        10 * speed + 500 * climb / np.maximum(speed, 1) + rng.normal(0, 10, n_points),
+        0,
+        None,
+    )
+    start = np.datetime64("2023-01-01T00:00:00", "ns")
+    return {
+        "latitude": lat,
+        "longitude": lon,
+        "lap": np.ones(n_points, dtype=np.int64),
+        "timestamp": start + np.arange(n_points).astype("timedelta64[s]"),
+        "altitude": np.round(altitude, 1),
+        "temperature": np.full(n_points, 20.0),
+        "heart_rate": np.round(120 + speed * 3),
+        "cadence": np.full(n_points, 90.0),
+        "speed": speed,
+        "power": np.round(power),
+    }
+
+
+def synthetic_chunks(
+    n_points: int, chunk_size: int = course.POINTS_CHUNK_SIZE
+) -> list[course.FitColumns]:
+    """The synthetic ride split into chunks, as returned by iter_fit_columns."""
+    columns = synthetic_columns(n_points)
+    return [
+        {name: values[start : start + chunk_size] for name, values in columns.items()}
+        for start in range(0, n_points, chunk_size)
+    ]
+
+
+def synthetic_points(n_points: int, course_id: int = 1) -> list[CoursePoints]:
+    """The synthetic ride as CoursePoints objects belonging to a course."""
+    points = course.columns_to_points(synthetic_columns(n_points))
+    for point in points:
+        point.course_id = course_id
+    return points
+
+
+def synthetic_frame(n_points: int) -> pd.DataFrame:
+    """The synthetic ride with the names of the columns in the database."""
+    columns = synthetic_columns(n_points)
+    return pd.DataFrame(
+        {
+            "lat": columns["latitude"],
+            "lon": columns["longitude"],
+            "altitude": columns["altitude"],
+            "speed": columns["speed"],
+            "power": columns["power"],
+        }
+    )
@@ -4,14 +4,133 @@ This is split into a separate module to maintain the visibility of the approach
 to managing passwords along with providing a single location in which to
 modify / update the approach to handling passwords within the database.
 
+Argon2 is deliberately slow and uses a large amount of memory for every hash,
+which makes guessing passwords expensive. The same cost applies to the server,
+so a burst of logins could use all the CPU and memory. Within the application
+the hashing is run on a dedicated pool of threads, limiting the number of
+hashes computed at once, and so the memory used, to the number of threads.
+When too many hashes are waiting, new requests fail straight away with
+HashingBusy rather than queueing without limit. The argon2-cffi library
+releases the GIL while hashing, so threads are able to hash in parallel.
+
+The cost of the hashes can be changed using environment variables, with the
+existing hashes being updated to the new cost when the user next logs in.
+
+ - ARGON2_TIME_COST: the number of iterations
+ - ARGON2_MEMORY_COST: the memory used in KiB
+ - ARGON2_PARALLELISM: the number of lanes used to compute the hash
+ - HASH_WORKERS: the number of hashes computed at once
+ - HASH_QUEUE_DEPTH: the number of hashes able to wait for a worker
+
 """
 
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+
 from passlib.hash import argon2
 
+from .metrics import REGISTRY
+
+# The defaults of passlib
+hasher = argon2.using(
+    time_cost=int(os.getenv("ARGON2_TIME_COST", "3")),
+    memory_cost=int(os.getenv("ARGON2_MEMORY_COST", "65536")),
+    parallelism=int(os.getenv("ARGON2_PARALLELISM", "4")),
+)
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_QUEUE_DEPTH = int(os.getenv("HASH_QUEUE_DEPTH", "16"))
+
+
+class HashingBusy(Exception):
+    """There are too many passwords waiting to be hashed."""
+
+
+# The wait for a worker shows whether there are enough workers for the logins
+HASH_SECONDS = REGISTRY.histogram(
+    "python_demo_password_hash_seconds", "Time taken to hash or verify a password."
+)
+HASH_WAIT_SECONDS = REGISTRY.histogram(
+    "python_demo_password_hash_wait_seconds",
+    "Time passwords waited for a hashing worker.",
+)
+HASH_REJECTED = REGISTRY.counter(
+    "python_demo_password_hash_rejected_total",
+    "Passwords rejected as too many were waiting to be hashed.",
+)
+
+# Each slot is a hash which is either running or waiting for a worker
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_DEPTH)
+
+
+@cache
+def _get_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="argon2")
+
+
+def shutdown() -> None:
+    """Stop the workers, called when the application stops."""
+    if _get_executor.cache_info().currsize:
+        _get_executor().shutdown()
+        _get_executor.cache_clear()
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return argon2.verify(plain_password, hashed_password)
+    return hasher.verify(plain_password, hashed_password)
 
 
 def get_password_hash(password: str) -> str:
-    return argon2.hash(password)
+    return hasher.hash(password)
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """Whether the hash was made with different settings to the current ones."""
+    return hasher.needs_update(hashed_password)
+
+
+async def _run(func, *args):
+    """Run func on the hashing workers, failing when they are all busy."""
+    if not _slots.acquire(blocking=False):
+        HASH_REJECTED.inc()
+        raise HashingBusy("Too many passwords are waiting to be hashed")
+
+    submitted = time.perf_counter()
+
+    def run():
+        started = time.perf_counter()
+        HASH_WAIT_SECONDS.observe(started - submitted)
+        try:
+            return func(*args)
+        finally:
+            HASH_SECONDS.observe(time.perf_counter() - started)
+
+    future = _get_executor().submit(run)
+    # The slot is released once the hash has finished, even when the request
+    # waiting for it has been cancelled, so the limit holds for running hashes.
+    future.add_done_callback(lambda _: _slots.release())
+    return await asyncio.wrap_future(future)
+
+
+async def hash_password(password: str) -> str:
+    """The hash of the password, computed on the hashing workers."""
+    return await _run(get_password_hash, password)
+
+
+async def verify_and_update(
+    plain_password: str, hashed_password: str
+) -> tuple[bool, str | None]:
+    """Check the password, with a new hash when the current one is outdated.
+
+    Returns whether the password matches the hash, along with the hash using
+    the current settings when the hash needs to be replaced, otherwise None.
+
+    """
+    if not await _run(verify_password, plain_password, hashed_password):
+        return False, None
+    if needs_rehash(hashed_password):
+        return True, await hash_password(plain_password)
+    return True, None
@@ -0,0 +1,110 @@
+"""A small in-process cache for values which are expensive to create.
+
+This is shared across the threads serving requests, so every operation takes a
+lock. Values are evicted when they have not been used for the longest time once
+the cache is full, or once they are older than the time to live. The cache is
+full once it holds maxsize values or, for a cache of bytes given maxbytes, the
+values add up to more than maxbytes. The counts of hits, misses and evictions
+are kept to see how well the cache is working.
+
+Each process has its own cache, so when running multiple workers a change made
+in one process is only seen by the others once the time to live has passed.
+
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Generic, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """A bounded, thread safe, least recently used cache with a time to live."""
+
+    def __init__(
+        self,
+        maxsize: int = 128,
+        ttl: float | None = None,
+        timer: Callable[[], float] = time.monotonic,
+        maxbytes: int | None = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.maxbytes = maxbytes
+        # The total length of the values, when limited by maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The values are stored alongside the time they expire, with the order
+        # of the dictionary going from the least to the most recently used.
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> V | None:
+        """The value for the key, or None when it is not in the cache."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires < self.timer():
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: K, value: V) -> None:
+        """Store the value, unless it is larger than maxbytes on its own."""
+        if self.maxbytes is not None and len(value) > self.maxbytes:
+            return
+        expires = self.timer() + self.ttl if self.ttl is not None else float("inf")
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (expires, value)
+            if self.maxbytes is not None:
+                self.nbytes += len(value)
+            while len(self._data) > self.maxsize or (
+                self.maxbytes is not None and self.nbytes > self.maxbytes
+            ):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key: K) -> None:
+        """Remove the key while holding the lock, if it is present."""
+        item = self._data.pop(key, None)
+        if item is not None and self.maxbytes is not None:
+            self.nbytes -= len(item[1])
+
+    def invalidate(self, key: K) -> None:
+        """Remove the key from the cache, if it is present."""
+        with self._lock:
+            self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict[str, int]:
+        """The counts describing the use of the cache."""
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -1,10 +1,21 @@
+from collections.abc import Iterable, Iterator
 from datetime import datetime
 from os import PathLike
 
 import fitdecode
+import numpy as np
 import pandas as pd
+from sqlalchemy import delete
+from sqlmodel import Session, select
 
-from .models import CoursePoints
+from . import spatial, storage
+from .dedup import Fingerprint
+from .derived import Deriver
+from .geometry import step_distance
+from .metrics import timed
+from .models import DERIVED_FIELDS, Course, CourseLevel, CoursePoints, PointBlock
+from .simplify import course_levels, detail_counts, detail_levels
+from .storage import nullable_list
 
 # Define the type for data within the fit file. It can be any one of the below
 # types separated by the vertical bar.
@@ -23,47 +34,151 @@ colnames_points = [
     "power",
 ]
 
-def _get_fit_points( frame: fitdecode.records.FitDataMessage ) -> None | dict[str, FitData]:
-    """Extract some data from an FIT frame representing track points."""
-    # Step 0: Initialise data output
-    data: dict[str, FitData] = {}
+# Positions within a FIT file are stored as 32 bit integers in units of
+# semicircles, this is the number of them within a single degree.
+SEMICIRCLES_PER_DEGREE = (2**32) / 360
 
-    # Step 1: Obtain frame lat and long and convert it from integer to degree 
-    # (if frame has lat and long data)
-    if not (frame.has_field("position_lat") and frame.has_field("position_long")):
-        # Frame does not have any latitude or longitude data. Ignore these
-        # frames in order to keep things simple
-        return None
-    elif (
-        frame.get_value("position_lat") is None
-        and frame.get_value("position_long") is None
-    ):
-        # Frame lat or long is None. Ignore frame
+# The struct-of-arrays representation of the points within a FIT file. Each of
+# the names in colnames_points maps to an array with one value per point, where
+# any values missing from a point are NaN. The timestamps are in UTC.
+FitColumns = dict[str, np.ndarray]
+
+# The number of points decoded and written to the database at a time. Larger
+# chunks reduce the overhead of each insert statement at the cost of memory.
+POINTS_CHUNK_SIZE = 5000
+
+# The assumed upper bound on the peak memory used to ingest each point of a
+# chunk. Running a job for a file of several chunks this is about 2000 bytes
+# when stored as rows and 750 bytes as blocks, so this leaves a margin for other
+# versions of the libraries. tests/jobs_test.py checks the peak stays within.
+_BYTES_PER_POINT = 3072
+
+# The fields we read from each record frame, any other fields are skipped.
+_record_fields = {"position_lat", "position_long", *colnames_points[3:]}
+
+
+def _to_arrays(columns: dict[str, list]) -> FitColumns:
+    """Convert the lists of raw values collected from a FIT file into arrays."""
+    # Timestamps below FIT_DATETIME_MIN are relative to the device start rather
+    # than absolute times, we have no way to place these so they are missing.
+    seconds = np.array(columns["timestamp"], dtype=np.float64)
+    valid = seconds >= fitdecode.FIT_DATETIME_MIN
+    timestamp = np.full(len(seconds), np.datetime64("NaT"), dtype="datetime64[ns]")
+    timestamp[valid] = (
+        seconds[valid].astype(np.int64) + fitdecode.FIT_UTC_REFERENCE
+    ).astype("datetime64[s]")
+
+    data = {
+        name: np.array(values, dtype=np.float64)
+        for name, values in columns.items()
+        if name != "timestamp"
+    }
+    data["latitude"] /= SEMICIRCLES_PER_DEGREE
+    data["longitude"] /= SEMICIRCLES_PER_DEGREE
+    data["lap"] = data["lap"].astype(np.int64)
+    data["timestamp"] = timestamp
+
+    return {name: data[name] for name in colnames_points}
+
+
+def read_file_id(fname: PathLike) -> tuple[int | None, datetime | None]:
+    """The serial number of the device and the time the file was created.
+
+    These come from the file_id message, which is at the start of the file,
+    so only the first few messages are decoded.
+
+    """
+    with fitdecode.FitReader(fname) as fit_file:
+        for frame in fit_file:
+            if (
+                isinstance(frame, fitdecode.records.FitDataMessage)
+                and frame.name == "file_id"
+            ):
+                serial_number = frame.get_value("serial_number", fallback=None)
+                time_created = frame.get_value("time_created", fallback=None)
+                if isinstance(time_created, datetime):
+                    # The times are stored in UTC without the timezone
+                    time_created = time_created.replace(tzinfo=None)
+                else:
+                    time_created = None
+                return serial_number, time_created
+    return None, None
+
+
+def _record_values(
+    frame: fitdecode.records.FitDataMessage,
+) -> dict[str, FitData] | None:
+    """The values of the fields of a record frame, or None without a position."""
+    values: dict[str, FitData] = {}
+    for field in frame.fields:
+        # Only the first field of each name is used, matching the behaviour of
+        # frame.get_value.
+        if field.name in _record_fields and field.name not in values:
+            values[field.name] = field.value
+    if values.get("position_lat") is None or values.get("position_long") is None:
         return None
-    else:
-        data["latitude"] = frame.get_value("position_lat") / ((2**32) / 360)
-        data["longitude"] = frame.get_value("position_long") / ((2**32) / 360)
+    return values
+
+
+def iter_fit_columns(
+    fname: PathLike, chunk_size: int = POINTS_CHUNK_SIZE
+) -> Iterator[FitColumns]:
+    """Read the track points from a FIT file in chunks of columns.
+
+    Rather than building a dictionary for every point, each value is appended
+    straight to the list for its column, with the conversion to typed arrays,
+    degrees and datetimes performed once over the whole column. Once a chunk
+    has chunk_size points it is converted and yielded, so no matter the length
+    of the activity only a single chunk of points is held in memory.
+
+    The reader is run without a data processor, so the timestamps are left as
+    the raw seconds since the FIT epoch and converted in a single vectorised
+    step rather than creating a datetime object for every frame.
+
+    """
+    columns: dict[str, list] = {name: [] for name in colnames_points}
+    lap_no = 1
+    with fitdecode.FitReader(fname, processor=None) as fit_file:
+        for frame in fit_file:
+            if not isinstance(frame, fitdecode.records.FitDataMessage):
+                continue
+
+            if frame.name == "record":
+                values = _record_values(frame)
+                # Frames without a position are ignored to keep things simple.
+                if values is None:
+                    continue
+
+                columns["latitude"].append(values["position_lat"])
+                columns["longitude"].append(values["position_long"])
+                columns["lap"].append(lap_no)
+                for name in colnames_points[3:]:
+                    columns[name].append(values.get(name))
 
-    # Step 2: Extract all other fields
-    for field in colnames_points[3:]:
-        if frame.has_field(field):
-            data[field] = frame.get_value(field)
+                if len(columns["latitude"]) == chunk_size:
+                    yield _to_arrays(columns)
+                    columns = {name: [] for name in colnames_points}
 
-    return data
+            elif frame.name == "lap":
+                lap_no += 1
 
+    if columns["latitude"]:
+        yield _to_arrays(columns)
 
-# This is taking the definition of the fit_to_dataframes from the fit2gpx
-# package and modifying it to suit our use case, primarily the checking of the
-# file extension which in the case of the temporary file created when uploading
-# isn't used. This removes the check for the extension and we then assign the
-# updated method.
-#
-# This approach is definitely abusing some of the inner workings of python;
-# however, is also demonstrates that nearly anything is possible. The main
-# reason this is a bad idea is that the underlying class could change,
-# and we then have to work out why and fix it.
 
+@timed("fit_to_columns")
+def fit_to_columns(fname: PathLike) -> FitColumns:
+    """Read all the track points from a FIT file into one array per column."""
+    chunks = list(iter_fit_columns(fname))
+    if not chunks:
+        return _to_arrays({name: [] for name in colnames_points})
+    return {
+        name: np.concatenate([chunk[name] for chunk in chunks])
+        for name in colnames_points
+    }
 
+
+@timed("fit_to_dataframes")
 def fit_to_dataframes(fname: PathLike) -> pd.DataFrame:
     """Takes path to a FIT file returning DataFrames for lap and point data.
 
@@ -74,43 +189,354 @@ def fit_to_dataframes(fname: PathLike) -> pd.DataFrame:
         dfs (tuple): df containing data about the laps , df containing data
             about the individual points.
     """
-    data_points = []
-    lap_no = 1
-    with fitdecode.FitReader(fname) as fit_file:
-        for frame in fit_file:
-            if isinstance(frame, fitdecode.records.FitDataMessage):
-                # Determine if frame is a data point or a lap:
-                if frame.name == "record":
-                    single_point_data = _get_fit_points(frame)
-                    if single_point_data is not None:
-                        single_point_data["lap"] = lap_no  # record lap number
-                        data_points.append(single_point_data)
-
-                elif frame.name == "lap":
-                    lap_no += 1  # increase lap counter
-
-    # Create DataFrames from the data we have collected. (If any information
-    # is missing from a lap or track point, it will show up as a "NaN" in the
-    # DataFrame.)
-
-    df_points = pd.DataFrame(data_points, columns=colnames_points)
+    # If any information is missing from a lap or track point, it will show up
+    # as a "NaN" in the DataFrame.
+    df_points = pd.DataFrame(fit_to_columns(fname), columns=colnames_points)
+    df_points["timestamp"] = df_points["timestamp"].dt.tz_localize("UTC")
 
     return df_points
 
 
+@timed("decode_fit")
 def decode_fit(file) -> list[CoursePoints]:
     """Decode the values within a file to Points within a course."""
-    df_point = fit_to_dataframes(fname=file)
+    return columns_to_points(fit_to_columns(file))
+
+
+def columns_to_points(columns: FitColumns) -> list[CoursePoints]:
+    """Create a CoursePoints object for each of the points within the columns."""
+    time = pd.DatetimeIndex(columns["timestamp"], tz="UTC").to_pydatetime()
 
     return [
         CoursePoints(
-            lat=row.latitude,
-            lon=row.longitude,
-            time=row.timestamp,
-            heart_rate=row.heart_rate,
-            power=row.power,
-            altitude=row.altitude,
-            speed=row.speed,
+            lat=lat,
+            lon=lon,
+            time=time,
+            heart_rate=heart_rate,
+            power=power,
+            altitude=altitude,
+            speed=speed,
         )
-        for _, row in df_point.iterrows()
+        for lat, lon, time, heart_rate, power, altitude, speed in zip(
+            columns["latitude"].tolist(),
+            columns["longitude"].tolist(),
+            time,
+            columns["heart_rate"].tolist(),
+            columns["power"].tolist(),
+            columns["altitude"].tolist(),
+            columns["speed"].tolist(),
+        )
+    ]
+
+
+def _point_rows(
+    course_id: int, columns: FitColumns, values: dict[str, np.ndarray]
+) -> list[dict]:
+    """Convert the columns into rows for the CoursePoints table.
+
+    The values are the derived values and the level of detail of the points,
+    from _derive_chunk. These are converted to the same types as those the
+    CoursePoints model would store, without the cost of creating and validating
+    a model instance for every point.
+
+    """
+    names = [
+        "lat",
+        "lon",
+        "time",
+        "power",
+        "speed",
+        "heart_rate",
+        "altitude",
+        "detail",
+        *DERIVED_FIELDS,
     ]
+    rows = zip(
+        nullable_list(columns["latitude"]),
+        nullable_list(columns["longitude"]),
+        pd.DatetimeIndex(columns["timestamp"]).to_pydatetime(),
+        nullable_list(columns["power"]),
+        nullable_list(columns["speed"]),
+        nullable_list(columns["heart_rate"], int),
+        nullable_list(columns["altitude"], int),
+        values["detail"].tolist(),
+        *[nullable_list(values[field]) for field in DERIVED_FIELDS],
+    )
+    return [{"course_id": course_id, **dict(zip(names, row))} for row in rows]
+
+
+def _block_columns(
+    columns: FitColumns, values: dict[str, np.ndarray]
+) -> dict[str, np.ndarray]:
+    """The columns with the names of the fields of the points."""
+    return {
+        "time": columns["timestamp"],
+        "lat": columns["latitude"],
+        "lon": columns["longitude"],
+        "power": columns["power"],
+        "speed": columns["speed"],
+        "heart_rate": columns["heart_rate"],
+        "altitude": columns["altitude"],
+        **values,
+    }
+
+
+def _with_following(
+    chunks: Iterable[FitColumns],
+) -> Iterator[tuple[FitColumns, FitColumns | None]]:
+    """Pair each chunk containing points with the chunk following it.
+
+    The final chunk is paired with None.
+
+    """
+    previous = None
+    for columns in chunks:
+        if len(columns["latitude"]) == 0:
+            continue
+        if previous is not None:
+            yield previous, columns
+        previous = columns
+    if previous is not None:
+        yield previous, None
+
+
+def _derive_chunk(
+    deriver: Deriver, columns: FitColumns, following: FitColumns | None
+) -> dict[str, np.ndarray]:
+    """The derived values and the level of detail of each point of a chunk.
+
+    Each chunk is simplified on its own, together with the first point of the
+    following chunk, so the tracks of neighbouring chunks meet at that point.
+    Every point is still within the tolerance of the track at each level, with
+    the first point of every chunk kept at all of them.
+
+    """
+    lat, lon = columns["latitude"], columns["longitude"]
+    # The altitude is stored in whole metres, the values are derived from the
+    # stored altitude the same as for the courses stored before.
+    altitude = np.trunc(columns["altitude"])
+    if following is None:
+        values = deriver.derive(lat, lon, altitude)
+        values["detail"] = detail_levels(lat, lon)
+        return values
+
+    values = deriver.derive(
+        lat,
+        lon,
+        altitude,
+        following=(
+            following["latitude"][0],
+            following["longitude"][0],
+            np.trunc(following["altitude"][0]),
+        ),
+    )
+    detail = detail_levels(
+        np.append(lat, following["latitude"][0]),
+        np.append(lon, following["longitude"][0]),
+    )
+    values["detail"] = detail[: len(lat)]
+    return values
+
+
+class _CourseSummary:
+    """Accumulate the summary of a course as each chunk of points is stored."""
+
+    def __init__(self):
+        self.n_points = 0
+        self.start_time = np.datetime64("NaT")
+        self.end_time = np.datetime64("NaT")
+        self.distance = 0.0
+        self.bounds = np.array([np.inf, -np.inf, np.inf, -np.inf])
+        # The final position of the previous chunk, which is needed to find the
+        # distance to the first point of the following chunk.
+        self._last_position: tuple[float, float] | None = None
+
+    def update(self, columns: FitColumns) -> None:
+        lat = columns["latitude"]
+        lon = columns["longitude"]
+        if len(lat) == 0:
+            return
+
+        self.n_points += len(lat)
+        self.bounds = np.array(
+            [
+                min(self.bounds[0], lat.min()),
+                max(self.bounds[1], lat.max()),
+                min(self.bounds[2], lon.min()),
+                max(self.bounds[3], lon.max()),
+            ]
+        )
+        # Unlike min and max, fmin and fmax ignore the NaT used as the initial
+        # value when there are no previous times.
+        times = columns["timestamp"][~np.isnat(columns["timestamp"])]
+        if len(times) > 0:
+            self.start_time = np.fmin(self.start_time, times.min())
+            self.end_time = np.fmax(self.end_time, times.max())
+
+        if self._last_position is not None:
+            lat = np.insert(lat, 0, self._last_position[0])
+            lon = np.insert(lon, 0, self._last_position[1])
+        self.distance += np.nansum(step_distance(lat, lon))
+        self._last_position = (lat[-1], lon[-1])
+
+    def apply(self, course: Course) -> None:
+        """Set the summary values of the course."""
+        course.n_points = self.n_points
+        if self.n_points == 0:
+            return
+
+        course.distance = float(self.distance)
+        course.min_lat, course.max_lat, course.min_lon, course.max_lon = (
+            self.bounds.tolist()
+        )
+        if not np.isnat(self.start_time):
+            course.start_time = pd.Timestamp(self.start_time).to_pydatetime()
+            course.duration = float(
+                (self.end_time - self.start_time) / np.timedelta64(1, "s")
+            )
+
+
+@timed("store_course")
+def store_course(
+    session: Session,
+    chunks: Iterable[FitColumns],
+    *,
+    user_id: int | None,
+    name: str | None,
+    fingerprint: Fingerprint | None = None,
+) -> Course:
+    """Persist a course along with all the points within the chunks of columns.
+
+    Rather than creating a CoursePoints object for every point and having the
+    ORM cascade them when the course is added, the course row is written first
+    to obtain an id, then each chunk of points is inserted using a single
+    executemany. When given the generator from iter_fit_columns, each chunk is
+    written before the next is decoded, keeping the memory use within
+    memory_ceiling however long the activity is.
+
+    As the points are stored, the summary of the course is accumulated from
+    each chunk, saving having to read the points back to list the courses. The
+    derived values and the levels of detail of the points are calculated from
+    each chunk too, see python_demo.derived and python_demo.simplify, so the
+    points are complete once stored.
+
+    The points are stored with the backend given by POINT_STORAGE, either a row
+    for each point or blocks of each field, see python_demo.storage. Either way
+    the points are added to the spatial index, see python_demo.spatial.
+
+    The fingerprint of the file the course was uploaded from is stored with
+    it, so any later upload of the file is recognised, see python_demo.dedup.
+
+    """
+    course = Course(user_id=user_id, name=name, storage=storage.default_backend())
+    if fingerprint is not None:
+        course.file_hash = fingerprint.file_hash
+        course.fit_serial_number = fingerprint.serial_number
+        course.fit_time_created = fingerprint.time_created
+    session.add(course)
+    # Flushing sends the insert to the database, providing the id of the
+    # course without committing the transaction.
+    session.flush()
+
+    insert_points = CoursePoints.__table__.insert()
+    summary = _CourseSummary()
+    deriver = Deriver()
+    counts = detail_counts(np.empty(0, dtype=np.int64))
+    n_blocks = 0
+    for columns, following in _with_following(chunks):
+        values = _derive_chunk(deriver, columns, following)
+        counts += detail_counts(values["detail"])
+        if course.storage == storage.BLOCKS:
+            n_blocks += storage.write_blocks(
+                session, course.id, _block_columns(columns, values), first=n_blocks
+            )
+        else:
+            session.execute(insert_points, _point_rows(course.id, columns, values))
+        spatial.index_points(
+            session,
+            course.id,
+            columns["timestamp"],
+            columns["latitude"],
+            columns["longitude"],
+        )
+        summary.update(columns)
+
+    summary.apply(course)
+    session.add(course)
+    session.add_all(course_levels(course.id, counts))
+    session.commit()
+    session.refresh(course)
+    return course
+
+
+def delete_course(session: Session, course_id: int) -> None:
+    """Remove a course along with its points and everything derived from them."""
+    for table in [CoursePoints.__table__, PointBlock.__table__, CourseLevel.__table__]:
+        session.execute(delete(table).where(table.c.course_id == course_id))
+    spatial.remove_course(session, course_id)
+    session.execute(delete(Course).where(Course.id == course_id))
+    session.commit()
+
+
+def memory_ceiling(chunk_size: int = POINTS_CHUNK_SIZE) -> int:
+    """The upper bound in bytes on the memory used to ingest a FIT file.
+
+    This covers the lists of raw values, the arrays, the derived values and the
+    rows for the database of a single chunk, which is all the ingestion holds
+    at once. The model of the user is then updated reading the stored points a
+    chunk at a time, see python_demo.machine_learning.
+
+    """
+    return chunk_size * _BYTES_PER_POINT
+
+
+@timed("load_points")
+def load_points(
+    session: Session, course_id: int, fields: list[str]
+) -> pd.DataFrame:
+    """Read the given fields of all the points within a course, ordered by time.
+
+    Only the requested columns are selected from the database, and the rows
+    are read straight into a DataFrame without creating CoursePoints objects.
+    For a course stored in blocks, the blocks of the fields are decoded into
+    the columns of the DataFrame.
+
+    """
+    if storage.course_backend(session, course_id) == storage.BLOCKS:
+        return pd.DataFrame(storage.read_blocks(session, course_id, fields))
+
+    query = (
+        select(*[getattr(CoursePoints, field) for field in fields])
+        .where(CoursePoints.course_id == course_id)
+        .order_by(CoursePoints.time)
+    )
+    return pd.DataFrame.from_records(session.exec(query).all(), columns=fields)
+
+
+def iter_points(
+    session: Session,
+    course_id: int,
+    fields: list[str],
+    chunk_size: int = POINTS_CHUNK_SIZE,
+) -> Iterator[pd.DataFrame]:
+    """Read the fields of the points within a course like load_points, in chunks.
+
+    Only a chunk of points is held at once, so the whole of a long course can
+    be processed in the same memory as it was stored in. A course stored in
+    blocks is read a block at a time.
+
+    """
+    if storage.course_backend(session, course_id) == storage.BLOCKS:
+        for columns in storage.iter_blocks(session, course_id, fields):
+            yield pd.DataFrame(columns)
+        return
+
+    query = (
+        select(*[getattr(CoursePoints, field) for field in fields])
+        .where(CoursePoints.course_id == course_id)
+        .order_by(CoursePoints.time)
+    )
+    # Without yield_per the session fetches every row before returning any
+    result = session.execute(query, execution_options={"yield_per": chunk_size})
+    for rows in result.partitions():
+        yield pd.DataFrame.from_records(rows, columns=fields)
@@ -0,0 +1,150 @@
+"""Configuration of the connection to the database.
+
+Here we are using sqlite as it is included within python and there are no
+separate services to start and manage. The defaults of SQLite are tuned for
+safety over a single writer, so when serving many requests at once we change a
+few of the settings, known as pragmas, each time a connection is opened.
+
+ - journal_mode=WAL allows reads to continue while a write is taking place,
+   rather than every reader waiting on the writer and failing with
+   "database is locked".
+ - synchronous=NORMAL only waits for the disk at checkpoints rather than
+   every commit, which with WAL is still safe from corruption.
+ - busy_timeout is how long a connection waits for another to finish writing
+   before giving up.
+ - cache_size and mmap_size keep more of the database in memory.
+
+The read heavy routes of the application are served asynchronously, using
+aiosqlite to run the queries on a separate thread without blocking the event
+loop, with create_async_db_engine configuring the same settings for the async
+connections.
+
+All the settings can be changed through environment variables, which are
+listed in DEFAULTS.
+
+"""
+
+import os
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlmodel import create_engine
+
+from .metrics import COMMIT_SECONDS
+
+DEFAULTS = {
+    "DATABASE_URL": "sqlite:///database.db",
+    # Logging every SQL statement is useful while developing, though the
+    # formatting and output of every statement has a real cost.
+    "SQL_ECHO": "0",
+    "SQLITE_JOURNAL_MODE": "WAL",
+    "SQLITE_SYNCHRONOUS": "NORMAL",
+    # Milliseconds to wait for the lock held by another writer
+    "SQLITE_BUSY_TIMEOUT": "5000",
+    # Negative values are in KiB rather than pages, this is 64 MiB
+    "SQLITE_CACHE_SIZE": "-65536",
+    # Bytes of the database file to memory map, this is 256 MiB
+    "SQLITE_MMAP_SIZE": "268435456",
+    "DB_POOL_SIZE": "10",
+    "DB_MAX_OVERFLOW": "20",
+}
+
+
+def _setting(name: str) -> str:
+    return os.getenv(name, DEFAULTS[name])
+
+
+def _set_pragmas(dbapi_connection, _connection_record) -> None:
+    """Configure each new SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    # The values come from our own configuration rather than from users, and
+    # pragmas don't support parameters.
+    for pragma, setting in [
+        ("journal_mode", "SQLITE_JOURNAL_MODE"),
+        ("synchronous", "SQLITE_SYNCHRONOUS"),
+        ("busy_timeout", "SQLITE_BUSY_TIMEOUT"),
+        ("cache_size", "SQLITE_CACHE_SIZE"),
+        ("mmap_size", "SQLITE_MMAP_SIZE"),
+    ]:
+        cursor.execute(f"PRAGMA {pragma} = {_setting(setting)}")
+    cursor.close()
+
+
+def _commit_started(session: Session) -> None:
+    session.info["commit_started"] = time.perf_counter()
+
+
+def _commit_finished(session: Session) -> None:
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+
+# The time of every commit is recorded, from any session within the process.
+# The async sessions wrap a sync session, so are included too.
+event.listen(Session, "before_commit", _commit_started)
+event.listen(Session, "after_commit", _commit_finished)
+
+
+def create_db_engine(url: str | None = None) -> Engine:
+    """Create the engine for the database at the url, by default DATABASE_URL.
+
+    Connections are kept in a pool and reused between requests rather than
+    opening the database file and configuring it for every request.
+
+    """
+    url = url or _setting("DATABASE_URL")
+    echo = _setting("SQL_ECHO").lower() in ("1", "true", "yes")
+    if not url.startswith("sqlite"):
+        return create_engine(url, echo=echo)
+
+    # An in memory database only exists within a single connection, so the
+    # default pool which shares that connection is kept.
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        return create_engine(url, echo=echo)
+
+    engine = create_engine(
+        url,
+        echo=echo,
+        # Connections are shared between the threads serving requests, with the
+        # pool making sure only one thread uses a connection at a time.
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=int(_setting("DB_POOL_SIZE")),
+        max_overflow=int(_setting("DB_MAX_OVERFLOW")),
+    )
+    event.listen(engine, "connect", _set_pragmas)
+    return engine
+
+
+def create_async_db_engine(url: str | None = None) -> AsyncEngine:
+    """Create an async engine for the database at the url, by default DATABASE_URL.
+
+    The url is that of the sync engine, like sqlite:///database.db, with the
+    driver replaced by aiosqlite.
+
+    """
+    url = url or _setting("DATABASE_URL")
+    echo = _setting("SQL_ECHO").lower() in ("1", "true", "yes")
+    if not url.startswith("sqlite:"):
+        return create_async_engine(url, echo=echo)
+
+    url = url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url in ("sqlite+aiosqlite://", "sqlite+aiosqlite:///:memory:"):
+        return create_async_engine(url, echo=echo)
+
+    engine = create_async_engine(
+        url,
+        echo=echo,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=int(_setting("DB_POOL_SIZE")),
+        max_overflow=int(_setting("DB_MAX_OVERFLOW")),
+    )
+    # Events are registered on the sync engine which the async engine wraps,
+    # with aiosqlite providing the same interface to the connection.
+    event.listen(engine.sync_engine, "connect", _set_pragmas)
+    return engine
@@ -0,0 +1,156 @@
+"""Recognise uploads of an activity which has already been stored.
+
+Devices and the tools syncing them often upload the same activity more than
+once. Every course is stored with the fingerprint of the file it came from:
+ - the SHA-256 of the bytes of the file, calculated while the upload is copied
+   to the spool directory, so checking it costs nothing beyond the copy,
+ - the serial number of the device and the time the file was created, from
+   the file_id message at the start of the FIT file. This finds the same
+   activity when a tool has rewritten the file, and is read by the worker
+   before decoding the rest of the file.
+An upload matching either of these for one of the courses of the user is
+given that course, without decoding the file or storing any points. The hash
+of the file is unique for each user, so the same file uploaded twice at once
+is still stored only once.
+
+Courses stored before the fingerprints, or the same activity uploaded as two
+different files at once, are found by comparing their points with
+
+    python -m python_demo.dedup
+
+"""
+
+import argparse
+import hashlib
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import and_, func, or_
+from sqlmodel import Session, select
+
+from .database import create_db_engine
+from .metrics import REGISTRY
+from .models import (
+    Course,
+    add_missing_columns,
+    backfill_summaries,
+    create_db_and_tables,
+)
+
+DUPLICATE_UPLOADS = REGISTRY.counter(
+    "python_demo_duplicate_uploads_total",
+    "Uploads of an existing course, by how they were recognised.",
+)
+
+
+class Fingerprint(NamedTuple):
+    """What identifies the file a course was uploaded from."""
+
+    file_hash: str | None
+    serial_number: int | None = None
+    time_created: datetime | None = None
+
+
+def find_duplicate(
+    session: Session, user_id: int, fingerprint: Fingerprint
+) -> Course | None:
+    """The course of the user uploaded from the same file, if there is one."""
+    matches = []
+    if fingerprint.file_hash is not None:
+        matches.append(Course.file_hash == fingerprint.file_hash)
+    if fingerprint.serial_number is not None and fingerprint.time_created is not None:
+        matches.append(
+            and_(
+                Course.fit_serial_number == fingerprint.serial_number,
+                Course.fit_time_created == fingerprint.time_created,
+            )
+        )
+    if not matches:
+        return None
+    return session.exec(
+        select(Course)
+        .where(Course.user_id == user_id, or_(*matches))
+        .order_by(Course.id)
+        .limit(1)
+    ).first()
+
+
+def points_hash(session: Session, course_id: int) -> str:
+    """The SHA-256 of the time and position of every point of a course.
+
+    The positions are rounded to the precision of a FIT file, so the same
+    course gives the same hash from either storage backend.
+
+    """
+    from .course import load_points
+
+    df = load_points(session, course_id, ["time", "lat", "lon"])
+    digest = hashlib.sha256()
+    digest.update(df["time"].to_numpy("datetime64[us]").view(np.int64).tobytes())
+    for field in ["lat", "lon"]:
+        digest.update(np.round(df[field].to_numpy(np.float64), 7).tobytes())
+    return digest.hexdigest()
+
+
+def find_duplicates(session: Session) -> list[list[int]]:
+    """The ids of each set of courses of a user with the same points.
+
+    Only courses with the same user, start time and number of points can be
+    the same, so the points are read and compared for just these. Courses
+    stored before the summary was kept are summarised first.
+
+    """
+    backfill_summaries(session.connection())
+    session.commit()
+    candidates = session.exec(
+        select(Course.user_id, Course.start_time, Course.n_points)
+        .where(Course.n_points > 0)
+        .group_by(Course.user_id, Course.start_time, Course.n_points)
+        .having(func.count() > 1)
+    ).all()
+
+    duplicates = []
+    for user_id, start_time, n_points in candidates:
+        course_ids = session.exec(
+            select(Course.id)
+            .where(
+                Course.user_id == user_id,
+                Course.start_time == start_time,
+                Course.n_points == n_points,
+            )
+            .order_by(Course.id)
+        ).all()
+        by_points = defaultdict(list)
+        for course_id in course_ids:
+            by_points[points_hash(session, course_id)].append(course_id)
+        duplicates.extend(ids for ids in by_points.values() if len(ids) > 1)
+    return duplicates
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m python_demo.dedup",
+        description="List the courses which are copies of another course.",
+    )
+    parser.add_argument(
+        "--database",
+        default=os.getenv("DATABASE_URL", "sqlite:///database.db"),
+        help="The url of the database, by default from DATABASE_URL.",
+    )
+    args = parser.parse_args(argv)
+
+    engine = create_db_engine(args.database)
+    create_db_and_tables(engine)
+    add_missing_columns(engine)
+    with Session(engine) as session:
+        duplicates = find_duplicates(session)
+    for first, *copies in duplicates:
+        print(f"course {first} is duplicated by {', '.join(map(str, copies))}")
+    print(f"{sum(len(ids) - 1 for ids in duplicates)} duplicate courses")
+
+
+if __name__ == "__main__":
+    main()
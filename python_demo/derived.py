@@ -0,0 +1,227 @@
+"""Values derived for each point from the recorded values of the whole course.
+
+The distance between points, the smoothed altitude and the gradient all depend
+on the neighbouring points, so these are calculated as the course is stored, a
+vectorised pass over each chunk of points with Deriver, and stored alongside
+the recorded values of each point. Training the models, drawing the course and
+summarising it then read these rather than calculating them again. Courses
+stored before then have the values derived by store_derived when first needed.
+
+The course module imports this one to derive the values, so the functions here
+reading the points import it when they are called.
+
+"""
+
+from collections.abc import Iterator
+
+import numpy as np
+import pandas as pd
+from sqlmodel import Session, bindparam, select, update
+
+from . import storage
+from .geometry import step_distance
+from .metrics import timed
+from .models import DERIVED_FIELDS, CoursePoints
+
+# The span of the exponentially weighted mean smoothing the altitude
+ALTITUDE_SPAN = 11
+
+
+def smooth_altitude(altitude: np.ndarray) -> np.ndarray:
+    """The altitude with the noise of the sensor removed.
+
+    The altitude data is very noisy, so by performing an exponentially weighted
+    mean we are able to smooth the data and remove the noise.
+
+    """
+    smoothed = pd.Series(altitude, dtype=np.float64).ewm(span=ALTITUDE_SPAN).mean()
+    return smoothed.to_numpy()
+
+
+def gradient(distance: np.ndarray, smoothed_altitude: np.ndarray) -> np.ndarray:
+    """The gradient in percent from each point to the following point.
+
+    Where two points are in the same place the gradient is infinite, which is
+    no more use than a missing value so these are NaN.
+
+    """
+    rise = np.append(np.diff(smoothed_altitude), np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = rise / distance * 100
+    result[np.isinf(result)] = np.nan
+    return result
+
+
+# The altitudes before a chunk which its smoothing starts from. The weight of an
+# altitude this far back is below the precision of a float, so the chunks are
+# smoothed the same as the whole course at once.
+_SMOOTHING_HISTORY = 256
+
+
+class Deriver:
+    """Calculate the derived values of a course one chunk of points at a time.
+
+    The values of a point depend on the points before it and the point after
+    it, so each chunk is given along with the first point of the following
+    chunk, while the recent altitudes and the distance so far are carried from
+    one chunk to the next.
+
+    """
+
+    def __init__(self):
+        self._altitudes = np.empty(0)
+        self._distance = 0.0
+
+    def derive(
+        self,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        altitude: np.ndarray,
+        following: tuple[float, float, float] | None = None,
+    ) -> dict[str, np.ndarray]:
+        """The derived values of the next chunk of points, ordered by time.
+
+        The following point is the latitude, longitude and altitude of the
+        first point of the next chunk, or None for the last chunk.
+
+        """
+        n_points = len(lat)
+        altitude = np.asarray(altitude, dtype=np.float64)
+        if following is not None:
+            lat, lon, altitude = (
+                np.append(values, value)
+                for values, value in zip([lat, lon, altitude], following)
+            )
+
+        distance = step_distance(lat, lon)
+        history = len(self._altitudes)
+        smoothed = smooth_altitude(np.concatenate([self._altitudes, altitude]))
+        smoothed = smoothed[history:]
+        # The distance to a point is the sum of the steps before it, where the
+        # final step of the course is always NaN as there is no following point.
+        cumulative = self._distance + np.concatenate(
+            [[0.0], np.nancumsum(distance)]
+        )
+        values = {
+            "step_distance": distance[:n_points],
+            "cumulative_distance": cumulative[:n_points],
+            "smoothed_altitude": smoothed[:n_points],
+            "gradient": gradient(distance, smoothed)[:n_points],
+        }
+
+        self._altitudes = np.concatenate([self._altitudes, altitude[:n_points]])
+        self._altitudes = self._altitudes[-_SMOOTHING_HISTORY:]
+        self._distance = float(cumulative[n_points])
+        return values
+
+
+def derive(
+    lat: np.ndarray, lon: np.ndarray, altitude: np.ndarray
+) -> dict[str, np.ndarray]:
+    """Calculate the derived values of each point of a course, ordered by time."""
+    return Deriver().derive(lat, lon, altitude)
+
+
+@timed("store_derived")
+def store_derived(session: Session, course_id: int) -> None:
+    """Calculate and store the derived values of every point within a course.
+
+    New courses have the values derived as they are stored, this is for the
+    courses stored before then.
+
+    """
+    from .course import load_points
+
+    df = load_points(session, course_id, ["id", "lat", "lon", "altitude"])
+    if len(df) > 0:
+        values = derive(
+            df["lat"].to_numpy(np.float64),
+            df["lon"].to_numpy(np.float64),
+            df["altitude"].to_numpy(np.float64),
+        )
+        if storage.course_backend(session, course_id) == storage.BLOCKS:
+            storage.write_columns(session, course_id, values)
+        else:
+            _update_rows(session, df["id"].tolist(), values)
+        storage.touch_course(session, course_id)
+    session.commit()
+
+
+def _update_rows(session: Session, ids: list[int], values: dict[str, np.ndarray]):
+    """Set the derived values of the rows of CoursePoints with the ids."""
+    columns = [storage.nullable_list(values[field]) for field in DERIVED_FIELDS]
+    if session.get_bind().dialect.paramstyle == "qmark":
+        # Every point is updated, so with a driver taking ? placeholders, like
+        # sqlite3, the statement is given to the driver as tuples. This skips
+        # the processing of the parameters of every row by SQLAlchemy, which
+        # takes longer than the update itself.
+        # The names are all our own, so there is nothing to inject.
+        table = CoursePoints.__tablename__
+        assignments = ", ".join(f"{field} = ?" for field in DERIVED_FIELDS)
+        statement = f"UPDATE {table} SET {assignments} WHERE id = ?"  # noqa: S608
+        session.connection().exec_driver_sql(statement, list(zip(*columns, ids)))
+        return
+
+    # The names of the parameters can't be those of the columns being set
+    names = [f"point_{field}" for field in DERIVED_FIELDS]
+    points = CoursePoints.__table__
+    session.execute(
+        update(points)
+        .where(points.c.id == bindparam("point_id"))
+        .values({field: bindparam(name) for field, name in zip(DERIVED_FIELDS, names)}),
+        [
+            {"point_id": point_id, **dict(zip(names, row))}
+            for point_id, *row in zip(ids, *columns)
+        ],
+    )
+
+
+def is_derived(session: Session, course_id: int) -> bool:
+    """Whether the derived values of the course have been stored.
+
+    Courses stored before the values were derived have them all missing, while
+    otherwise the cumulative distance of the first point is always 0.
+
+    """
+    if storage.course_backend(session, course_id) == storage.BLOCKS:
+        return storage.has_field(session, course_id, "cumulative_distance")
+    first = session.exec(
+        select(CoursePoints.cumulative_distance)
+        .where(CoursePoints.course_id == course_id)
+        .order_by(CoursePoints.time)
+        .limit(1)
+    ).first()
+    return first is not None
+
+
+def load_derived(session: Session, course_id: int, fields: list[str]) -> pd.DataFrame:
+    """Read the fields of the points like load_points, including derived fields.
+
+    The derived values of courses stored before these were calculated are
+    stored first.
+
+    """
+    from .course import load_points
+
+    if any(field in DERIVED_FIELDS for field in fields) and not is_derived(
+        session, course_id
+    ):
+        store_derived(session, course_id)
+    return load_points(session, course_id, fields)
+
+
+def iter_derived(
+    session: Session, course_id: int, fields: list[str]
+) -> Iterator[pd.DataFrame]:
+    """Read the fields of the points like iter_points, including derived fields.
+
+    Like load_derived, the derived values are stored first where missing.
+
+    """
+    from .course import iter_points
+
+    if any(field in DERIVED_FIELDS for field in fields) and not is_derived(
+        session, course_id
+    ):
+        store_derived(session, course_id)
+    return iter_points(session, course_id, fields)
@@ -0,0 +1,256 @@
+"""Serialise the points of a course in a range of formats.
+
+The points are read from the database cursor one batch at a time and each batch
+is encoded and sent before the next is read, so the response starts straight
+away and the whole course is never held in memory. Only the requested fields
+are selected from the database.
+
+The formats available are
+ - json: a list with an object for each point, the default.
+ - columns: an object with a list of the values of each field, which avoids
+   repeating the name of every field for every point.
+ - csv: a header row with the names of the fields followed by a row per point.
+ - arrow: the Apache Arrow IPC stream format, which requires pyarrow.
+
+"""
+
+import csv
+import io
+import json
+from collections.abc import Iterator, Sequence
+from functools import cache
+
+from sqlalchemy.engine import Row
+from sqlmodel import Session, select
+
+from . import storage
+from .models import DERIVED_FIELDS, CoursePoints
+
+
+@cache
+def _pyarrow():
+    """The pyarrow module, imported when first needed as it's slow to import.
+
+    None is returned when pyarrow isn't installed.
+
+    """
+    try:
+        import pyarrow
+    except ImportError:  # pragma: no cover
+        return None
+    return pyarrow
+
+
+# The fields of the points which are able to be exported, these are returned
+# when no fields are requested.
+POINT_FIELDS = [
+    "id",
+    "course_id",
+    "lat",
+    "lon",
+    "time",
+    "power",
+    "speed",
+    "heart_rate",
+    "altitude",
+]
+# The values derived from the neighbouring points can also be exported, though
+# they're only included when requested.
+EXPORT_FIELDS = POINT_FIELDS + DERIVED_FIELDS
+
+# The number of rows read from the database cursor at a time.
+BATCH_SIZE = 5000
+
+MEDIA_TYPES = {
+    "json": "application/json",
+    "columns": "application/json",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def _accepted(accept: str | None) -> list[str]:
+    """The media types within the Accept header, highest quality first.
+
+    Media types of the same quality keep their order within the header, while
+    those with a quality of zero aren't accepted so are left out.
+
+    """
+    candidates = []
+    for position, media_range in enumerate((accept or "").split(",")):
+        media_type, *params = (part.strip() for part in media_range.split(";"))
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                quality = float(param[2:])
+        if quality > 0:
+            candidates.append((-quality, position, media_type))
+    return [media_type for _, _, media_type in sorted(candidates)]
+
+
+def negotiate(accept: str | None, format: str | None = None) -> str:
+    """Choose the format of the response.
+
+    A format given explicitly takes precedence over the Accept header, since
+    many clients, like the Vega chart loading the data, can't set the header.
+    Otherwise the first of the media types within the Accept header with the
+    highest quality which we are able to provide is chosen.
+
+    """
+    if format is not None:
+        if format not in MEDIA_TYPES:
+            raise ValueError(f"Unknown format {format}")
+        return format
+
+    for media_type in _accepted(accept):
+        if media_type in ("", "*/*", "application/*", "application/json"):
+            return "json"
+        for name, known_type in MEDIA_TYPES.items():
+            if media_type == known_type:
+                return name
+    raise ValueError(f"None of the media types {accept} are available")
+
+
+def parse_fields(fields: str | None) -> list[str]:
+    """The list of fields from a comma separated string."""
+    if not fields:
+        return POINT_FIELDS
+    requested = [field.strip() for field in fields.split(",")]
+    unknown = set(requested) - set(EXPORT_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields {', '.join(sorted(unknown))}")
+    return requested
+
+
+def _batches(
+    session: Session, course_id: int, fields: list[str], level: int
+) -> Iterator[list]:
+    """Read the fields of the points in the course, a batch at a time.
+
+    The points of a course stored in blocks are read a block at a time.
+
+    """
+    if storage.course_backend(session, course_id) == storage.BLOCKS:
+        for columns in storage.iter_blocks(session, course_id, fields, level):
+            yield storage.to_rows(columns)
+        return
+
+    query = (
+        select(*[getattr(CoursePoints, field) for field in fields])
+        .where(CoursePoints.course_id == course_id)
+        .order_by(CoursePoints.time)
+    )
+    if level > 0:
+        query = query.where(CoursePoints.detail >= level)
+    # Without yield_per the session fetches every row before returning any
+    result = session.execute(query, execution_options={"yield_per": BATCH_SIZE})
+    yield from result.partitions()
+
+
+def _to_text(rows: Sequence[Row], fields: list[str]) -> list[list]:
+    """Convert the values of rows to those which can be encoded as text."""
+    if "time" not in fields:
+        return [list(row) for row in rows]
+    index = fields.index("time")
+    converted = []
+    for row in rows:
+        values = list(row)
+        if values[index] is not None:
+            values[index] = values[index].isoformat()
+        converted.append(values)
+    return converted
+
+
+def _json_rows(session: Session, course_id: int, fields: list[str], level: int):
+    yield b"["
+    separator = b""
+    for rows in _batches(session, course_id, fields, level):
+        objects = [dict(zip(fields, row)) for row in _to_text(rows, fields)]
+        # Encoding the list of objects and removing the brackets leaves the
+        # objects separated by commas, ready to join with the other batches.
+        yield separator + json.dumps(objects).encode()[1:-1]
+        separator = b","
+    yield b"]"
+
+
+def _json_columns(session: Session, course_id: int, fields: list[str], level: int):
+    # Each column is read with a separate pass over the points of the course so
+    # they can be streamed one after the other.
+    for position, field in enumerate(fields):
+        yield (b"{" if position == 0 else b",") + json.dumps(field).encode() + b":["
+        separator = b""
+        for rows in _batches(session, course_id, [field], level):
+            values = [value for value, in _to_text(rows, [field])]
+            yield separator + json.dumps(values).encode()[1:-1]
+            separator = b","
+        yield b"]"
+    yield b"}" if fields else b"{}"
+
+
+def _csv(session: Session, course_id: int, fields: list[str], level: int):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for rows in _batches(session, course_id, fields, level):
+        writer.writerows(_to_text(rows, fields))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def _arrow_schema(fields: list[str]):
+    pa = _pyarrow()
+    types = {
+        "id": pa.int64(),
+        "course_id": pa.int64(),
+        "lat": pa.float64(),
+        "lon": pa.float64(),
+        "time": pa.timestamp("us"),
+        "power": pa.float64(),
+        "speed": pa.float64(),
+        "heart_rate": pa.int64(),
+        "altitude": pa.int64(),
+        **{field: pa.float64() for field in DERIVED_FIELDS},
+    }
+    return pa.schema([(field, types[field]) for field in fields])
+
+
+def _arrow(session: Session, course_id: int, fields: list[str], level: int):
+    pa = _pyarrow()
+    schema = _arrow_schema(fields)
+    buffer = io.BytesIO()
+    with pa.ipc.new_stream(buffer, schema) as writer:
+        for rows in _batches(session, course_id, fields, level):
+            columns = [
+                pa.array(values, type=field.type)
+                for values, field in zip(zip(*rows), schema)
+            ]
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    # Closing the writer adds the end of stream marker
+    yield buffer.getvalue()
+
+
+_writers = {
+    "json": _json_rows,
+    "columns": _json_columns,
+    "csv": _csv,
+    "arrow": _arrow,
+}
+
+
+def stream_points(
+    session: Session, course_id: int, fields: list[str], format: str, level: int = 0
+) -> Iterator[bytes]:
+    """The points of the course encoded in the format, in chunks of bytes.
+
+    Only the points kept at the level of detail are included, where level 0 is
+    every point.
+
+    """
+    if format == "arrow" and _pyarrow() is None:
+        raise ValueError("The arrow format requires pyarrow to be installed")
+    return _writers[format](session, course_id, fields, level)
@@ -0,0 +1,86 @@
+"""Distances between points given by their latitude and longitude.
+
+This is kept separate from the modules using it, since both the ingestion of
+courses and the machine learning rely on the distance between points.
+
+"""
+
+from typing import TYPE_CHECKING, Literal
+
+import numpy as np
+
+# Only needed for the annotations, pandas is slow to import and isn't needed
+# for the calculations.
+if TYPE_CHECKING:
+    import pandas as pd
+
+# The mean radius of the earth in metres, which gives the smallest error when
+# approximating the WGS-84 ellipsoid by a sphere.
+EARTH_RADIUS = 6_371_008.8
+
+# The methods available for calculating the distance between points.
+#  - haversine: the great circle distance on a sphere.
+#  - equirectangular: a projection onto a plane which is only accurate over
+#    short distances, though this is the case for consecutive samples.
+#  - geodesic: the exact distance on the WGS-84 ellipsoid calculated by geopy
+#    one pair at a time, this is slow and intended for validation.
+#
+# Over the points in tests/activity.fit, both the haversine and equirectangular
+# methods are within 0.25% of the geodesic distance for each step, which comes
+# from treating the earth as a sphere and is at most 0.5% anywhere on earth.
+# This same relative error carries through to the gradient.
+DistanceMethod = Literal["haversine", "equirectangular", "geodesic"]
+
+
+def step_distance(
+    lat: "pd.Series[float]",
+    lon: "pd.Series[float]",
+    method: DistanceMethod = "haversine",
+) -> np.ndarray:
+    """The distance in metres from each point to the following point.
+
+    There is no point following the final point, so the distance is NaN.
+
+    """
+    if method == "geodesic":
+        import geopy.distance
+
+        points = [geopy.Point(lat, lon) for lat, lon in zip(lat, lon)]
+        distance = [
+            geopy.distance.distance(point, point_next).meters
+            for point, point_next in zip(points, points[1:])
+        ]
+        return np.append(distance, np.nan)
+
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    dlat = np.diff(lat)
+    dlon = np.diff(lon)
+
+    if method == "haversine":
+        a = (
+            np.sin(dlat / 2) ** 2
+            + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2) ** 2
+        )
+        distance = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+    elif method == "equirectangular":
+        x = dlon * np.cos((lat[:-1] + lat[1:]) / 2)
+        distance = EARTH_RADIUS * np.hypot(x, dlat)
+    else:
+        raise ValueError(f"Unknown distance method {method}")
+
+    return np.append(distance, np.nan)
+
+
+def distance_to(
+    lat: float, lon: float, lats: np.ndarray, lons: np.ndarray
+) -> np.ndarray:
+    """The haversine distance in metres from a position to each of the points."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
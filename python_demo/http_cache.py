@@ -0,0 +1,147 @@
+"""Conditional requests and caching of the responses for courses.
+
+The points of a course don't change once the course has been stored, apart
+from the rare changes which increase Course.version. The responses for a course
+are therefore given an ETag from the id and version of the course, along with
+the request for the points, and the time of the last change as Last-Modified.
+A browser sending these back with If-None-Match or If-Modified-Since gets a
+304 Not Modified with no body.
+
+So the checks don't need the database, the user and version of each course
+requested recently are kept in memory by course_versions. The body of each
+response is also kept by payload_cache, up to PAYLOAD_CACHE_BYTES in total, so
+viewing a course again is served without reading or encoding the points.
+
+Like the other caches, each process has its own, so a change to a course made
+by another process is only seen once the entry of course_versions expires.
+
+"""
+
+import hashlib
+import os
+from collections.abc import Iterator
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import NamedTuple
+
+from fastapi import Request, Response, status
+
+from .cache import LRUCache
+from .models import Course
+
+# The pages are checked with the server on every view, which is a 304 when
+# nothing has changed. The points are used straight from the cache of the
+# browser for POINTS_MAX_AGE seconds, as the chart requests them every time the
+# page is shown.
+PAGE_CACHE_CONTROL = "private, no-cache"
+POINTS_MAX_AGE = int(os.getenv("POINTS_MAX_AGE", "300"))
+POINTS_CACHE_CONTROL = f"private, max-age={POINTS_MAX_AGE}"
+
+
+class CourseVersion(NamedTuple):
+    """Who the course belongs to, and which version of it is stored."""
+
+    user_id: int | None
+    version: int
+    modified: datetime | None
+
+
+VERSION_CACHE_SIZE = 4096
+VERSION_CACHE_TTL = 60
+course_versions: LRUCache[int, CourseVersion] = LRUCache(
+    maxsize=VERSION_CACHE_SIZE, ttl=VERSION_CACHE_TTL
+)
+
+# The memory held by the bodies of the responses, where a single response can
+# use at most an eighth.
+PAYLOAD_CACHE_BYTES = int(os.getenv("PAYLOAD_CACHE_BYTES", str(64 * 2**20)))
+PAYLOAD_MAX_BYTES = PAYLOAD_CACHE_BYTES // 8
+PAYLOAD_CACHE_SIZE = 1024
+payload_cache: LRUCache[str, bytes] = LRUCache(
+    maxsize=PAYLOAD_CACHE_SIZE, maxbytes=PAYLOAD_CACHE_BYTES
+)
+
+
+def remember(course: Course) -> CourseVersion:
+    """Keep the version of the course read from the database."""
+    version = CourseVersion(course.user_id, course.version, course.modified)
+    course_versions.set(course.id, version)
+    return version
+
+
+def etag(course_id: int, version: CourseVersion, *variant) -> str:
+    """The strong ETag of a response for the course.
+
+    The variant describes which response it is, such as the format and fields
+    of the points, which each have a different ETag.
+
+    """
+    digest = hashlib.sha256(repr(variant).encode()).hexdigest()[:16]
+    return f'"{course_id}-{version.version}-{digest}"'
+
+
+def headers(tag: str, version: CourseVersion, cache_control: str) -> dict[str, str]:
+    """The headers letting the response be cached and checked."""
+    result = {"ETag": tag, "Cache-Control": cache_control}
+    if version.modified is not None:
+        result["Last-Modified"] = format_datetime(_utc(version.modified), usegmt=True)
+    return result
+
+
+def _utc(time: datetime) -> datetime:
+    # The times are read from the database without the timezone
+    if time.tzinfo is None:
+        return time.replace(tzinfo=timezone.utc)
+    return time
+
+
+def not_modified(request: Request, tag: str, version: CourseVersion) -> bool:
+    """Whether the client already has the response, from the conditional headers.
+
+    If-Modified-Since is only used without If-None-Match, as the ETag is the
+    more precise of the two.
+
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [
+            value.strip().removeprefix("W/") for value in if_none_match.split(",")
+        ]
+        return "*" in tags or tag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or version.modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    # The header only has whole seconds
+    return _utc(version.modified).replace(microsecond=0) <= since
+
+
+def not_modified_response(headers: dict[str, str]) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+def keep(tag: str, content: Iterator[bytes]) -> Iterator[bytes]:
+    """Pass through the content of a response, caching it once complete.
+
+    Content larger than the cache is able to hold isn't kept, and neither is
+    content which wasn't sent in full, such as when the client disconnected.
+
+    """
+    chunks: list[bytes] | None = []
+    size = 0
+    for chunk in content:
+        if chunks is not None:
+            size += len(chunk)
+            if size <= PAYLOAD_MAX_BYTES:
+                chunks.append(chunk)
+            else:
+                chunks = None
+        yield chunk
+    if chunks is not None:
+        payload_cache.set(tag, b"".join(chunks))
@@ -0,0 +1,420 @@
+"""Ingest uploaded courses in the background using a pool of processes.
+
+Decoding a FIT file is CPU bound, so running it within the request both keeps
+the client waiting and ties up one of the threads serving requests. Instead
+the upload is copied to a spool directory and an IngestJob is recorded within
+the database, with the decoding and storage of the points taking place in a
+separate process. Using processes rather than threads means the decoding is
+not limited by the GIL, so multiple uploads are able to use multiple cores.
+
+Importing a history of activities uploads many FIT files at once, or a zip
+archive of them, as an ImportBatch. A job is recorded for each file and all
+of them are submitted together, so the pool decodes as many files at once as
+there are workers, one for each core unless INGEST_WORKERS is set.
+
+The modules decoding and analysing the courses import pandas, which is slow to
+import, so they are only imported by run_job within the workers. The server
+is then able to record and submit jobs without importing them.
+
+"""
+
+import hashlib
+import os
+import tempfile
+import zipfile
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import cache
+from multiprocessing import get_context
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, NamedTuple
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from .database import create_db_engine
+from .dedup import DUPLICATE_UPLOADS, Fingerprint, find_duplicate
+from .metrics import REGISTRY, timed
+from .models import Course, ImportBatch, IngestJob, JobStatus
+from .power_model import invalidate_user_model
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def upload_dir() -> Path:
+    """The directory uploaded files are kept in until they are ingested."""
+    directory = Path(os.getenv("UPLOAD_DIR", "uploads"))
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """The pool of processes running the jobs, created when first needed."""
+    global _executor
+    if _executor is None:
+        workers = int(os.getenv("INGEST_WORKERS", "0")) or None
+        # Starting the workers with spawn rather than fork means they don't
+        # inherit any of the threads or database connections of the server.
+        _executor = ProcessPoolExecutor(workers, mp_context=get_context("spawn"))
+    return _executor
+
+
+def shutdown() -> None:
+    """Stop the workers, any unfinished jobs are resumed on the next startup."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+# The size of the pieces the uploads are copied in
+_COPY_BUFFER = 1024 * 1024
+
+
+def spool_upload(file: BinaryIO) -> tuple[Path, str]:
+    """Copy the uploaded file to the spool directory.
+
+    The temporary file provided with an upload is removed once the request
+    is complete, so it has to be copied somewhere it will outlive the request.
+    The bytes are hashed as they are copied, returning the SHA-256 in hex along
+    with the new path.
+
+    """
+    descriptor, path = tempfile.mkstemp(suffix=".fit", dir=upload_dir())
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(descriptor, "wb") as spool:
+            while piece := file.read(_COPY_BUFFER):
+                digest.update(piece)
+                spool.write(piece)
+    except BaseException:
+        Path(path).unlink(missing_ok=True)
+        raise
+    return Path(path), digest.hexdigest()
+
+
+def _use_existing(session: Session, job: IngestJob) -> bool:
+    """Finish the job with the course of the user uploaded from the same file.
+
+    The spooled copy of the file is no longer needed, so it is removed. This
+    returns whether there was such a course.
+
+    """
+    existing = find_duplicate(session, job.user_id, Fingerprint(job.file_hash))
+    if existing is None:
+        return False
+    job.status = JobStatus.done
+    job.course_id = existing.id
+    Path(job.path).unlink(missing_ok=True)
+    DUPLICATE_UPLOADS.inc(by="file_hash")
+    return True
+
+
+def create_job(
+    session: Session, file: BinaryIO, *, user_id: int, name: str | None
+) -> IngestJob:
+    """Record a job to ingest the uploaded file.
+
+    When the user has already uploaded the file, the job is done as soon as it
+    is recorded, with the existing course.
+
+    """
+    path, file_hash = spool_upload(file)
+    job = IngestJob(user_id=user_id, name=name, path=str(path), file_hash=file_hash)
+    _use_existing(session, job)
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+class Spooled(NamedTuple):
+    """A file within an upload, copied to the spool directory.
+
+    When the file couldn't be read from an archive, there is the error in
+    place of the path and hash.
+
+    """
+
+    name: str | None
+    path: Path | None
+    file_hash: str | None
+    error: str | None = None
+
+
+# The most files, and the most bytes of FIT files once decompressed, an archive
+# can hold. These are checked before any of it is copied, so a small archive
+# can't fill the spool directory.
+MAX_ARCHIVE_MEMBERS = int(os.getenv("MAX_ARCHIVE_MEMBERS", "10000"))
+MAX_ARCHIVE_BYTES = int(os.getenv("MAX_ARCHIVE_BYTES", str(4 * 2**30)))
+
+
+def _fit_members(archive: zipfile.ZipFile) -> list[zipfile.ZipInfo]:
+    """The FIT files within the archive, checking it is within the limits."""
+    members = archive.infolist()
+    if len(members) > MAX_ARCHIVE_MEMBERS:
+        raise ValueError(f"The archive has more than {MAX_ARCHIVE_MEMBERS} files")
+    members = [
+        member
+        for member in members
+        if not member.is_dir() and member.filename.lower().endswith(".fit")
+    ]
+    # Reading a member stops at its file_size, so this bounds what is copied
+    if sum(member.file_size for member in members) > MAX_ARCHIVE_BYTES:
+        raise ValueError(f"The archive has more than {MAX_ARCHIVE_BYTES} bytes")
+    return members
+
+
+def spool_files(file: BinaryIO, filename: str | None) -> Iterator[Spooled]:
+    """Copy each FIT file within an upload to the spool directory.
+
+    An upload is either a FIT file or a zip archive of them, where any other
+    files within the archive are skipped. An archive which can't be read, or
+    is over the limits, is given as a single file with the error.
+
+    """
+    if not zipfile.is_zipfile(file):
+        file.seek(0)
+        yield Spooled(filename, *spool_upload(file))
+        return
+
+    file.seek(0)
+    try:
+        archive = zipfile.ZipFile(file)
+    except (zipfile.BadZipFile, OSError) as error:
+        yield Spooled(filename, None, None, str(error) or type(error).__name__)
+        return
+    with archive:
+        try:
+            members = _fit_members(archive)
+        except ValueError as error:
+            yield Spooled(filename, None, None, str(error))
+            return
+        for member in members:
+            name = PurePosixPath(member.filename).name
+            try:
+                with archive.open(member) as content:
+                    spooled = Spooled(name, *spool_upload(content))
+            except (zipfile.BadZipFile, NotImplementedError, OSError) as error:
+                spooled = Spooled(name, None, None, str(error) or type(error).__name__)
+            yield spooled
+
+
+def create_batch(
+    session: Session, files: list[tuple[BinaryIO, str | None]], *, user_id: int
+) -> tuple[ImportBatch, list[IngestJob]]:
+    """Record a job to ingest every FIT file within the uploads, as a batch.
+
+    The jobs are committed together rather than one at a time. A file which
+    couldn't be read from an archive is recorded as a failed job, so every
+    file is reported with the batch, while a file the user has already
+    uploaded is done straight away with the existing course.
+
+    """
+    batch = ImportBatch(user_id=user_id)
+    batch_jobs = []
+    try:
+        session.add(batch)
+        session.flush()
+        for file, filename in files:
+            for spooled in spool_files(file, filename):
+                job = IngestJob(
+                    user_id=user_id,
+                    name=spooled.name,
+                    path=str(spooled.path or ""),
+                    file_hash=spooled.file_hash,
+                    batch_id=batch.id,
+                )
+                batch_jobs.append(job)
+                if spooled.error is not None:
+                    job.status = JobStatus.failed
+                    job.error = spooled.error
+                else:
+                    _use_existing(session, job)
+        session.add_all(batch_jobs)
+        session.commit()
+    except BaseException:
+        # None of the jobs were recorded, so nothing would remove their files
+        session.rollback()
+        for job in batch_jobs:
+            if job.path:
+                Path(job.path).unlink(missing_ok=True)
+        raise
+    for job in [batch, *batch_jobs]:
+        session.refresh(job)
+    return batch, batch_jobs
+
+
+def batch_status(session: Session, batch_id: int) -> dict:
+    """The number of files at each stage along with the status of each file."""
+    batch_jobs = session.exec(
+        select(IngestJob).where(IngestJob.batch_id == batch_id).order_by(IngestJob.id)
+    ).all()
+    counts = {status.value: 0 for status in JobStatus}
+    for job in batch_jobs:
+        counts[JobStatus(job.status).value] += 1
+    return {
+        "id": batch_id,
+        "total": len(batch_jobs),
+        "finished": counts["done"] + counts["failed"] == len(batch_jobs),
+        **counts,
+        "files": [
+            {
+                "job_id": job.id,
+                "name": job.name,
+                "status": job.status,
+                "course_id": job.course_id,
+                "error": job.error,
+            }
+            for job in batch_jobs
+        ],
+    }
+
+
+INGEST_JOBS = REGISTRY.counter(
+    "python_demo_ingest_jobs_total", "Ingest jobs finished, by status."
+)
+
+
+# Each worker process keeps a single engine for all the jobs it runs.
+@cache
+def _worker_engine(database_url: str) -> Engine:
+    return create_db_engine(database_url)
+
+
+def _store_course(
+    session: Session, job: IngestJob, fingerprint: Fingerprint
+) -> tuple[Course, bool]:
+    """Store the course of the job, returning it and whether it was stored.
+
+    Two jobs for the same file, such as copies within a batch, can both find
+    no existing course. As the hash of the file is unique for each user only
+    one of them stores the course, the other is given that course instead.
+
+    """
+    from .course import iter_fit_columns, store_course
+
+    try:
+        course = store_course(
+            session,
+            iter_fit_columns(job.path),
+            user_id=job.user_id,
+            name=job.name,
+            fingerprint=fingerprint,
+        )
+    except IntegrityError:
+        session.rollback()
+        course = find_duplicate(session, job.user_id, Fingerprint(job.file_hash))
+        if course is None:
+            raise
+        DUPLICATE_UPLOADS.inc(by="file_hash")
+        return course, False
+    return course, True
+
+
+@timed("run_job")
+def run_job(database_url: str, job_id: int) -> int | None:
+    """Decode the file of an IngestJob and store it as a course.
+
+    This is run within the worker processes, so it connects to the database
+    using the url rather than being passed a session. The id of the created
+    course is returned, or None when the job failed. When the user already has
+    a course from the same file, the job is given that course instead.
+
+    A failed job leaves nothing behind, the course is deleted if it had been
+    stored and the spooled file is removed, so the file has to be uploaded
+    again once the problem is fixed.
+
+    """
+    from .course import delete_course, read_file_id
+    from .machine_learning import update_user_model
+
+    with Session(_worker_engine(database_url)) as session:
+        job = session.get(IngestJob, job_id)
+        if job is None or job.status == JobStatus.done:
+            return job.course_id if job is not None else None
+
+        job.status = JobStatus.running
+        session.add(job)
+        session.commit()
+
+        created = None
+        try:
+            fingerprint = Fingerprint(job.file_hash, *read_file_id(job.path))
+            # The same activity may have been stored since the job was recorded,
+            # or uploaded before as a file with different bytes.
+            course = find_duplicate(session, job.user_id, fingerprint)
+            if course is not None:
+                by = "file_hash" if course.file_hash == job.file_hash else "file_id"
+                DUPLICATE_UPLOADS.inc(by=by)
+            else:
+                course, stored = _store_course(session, job, fingerprint)
+                if stored:
+                    created = course.id
+                    # The points of the new course are added to the model of
+                    # the user while they are likely still in the cache of the
+                    # database.
+                    update_user_model(session, job.user_id, course.id)
+        # Any problem with the file should be reported back through the job
+        # rather than taking down the worker.
+        except Exception as error:
+            session.rollback()
+            # The course is committed before the rest is calculated, so it is
+            # removed rather than left for later uploads to be matched with.
+            if created is not None:
+                delete_course(session, created)
+            job.status = JobStatus.failed
+            job.error = str(error) or type(error).__name__
+            course_id = None
+        else:
+            job.status = JobStatus.done
+            job.course_id = course_id = course.id
+        # Failed jobs aren't run again, so the file is removed either way
+        Path(job.path).unlink(missing_ok=True)
+
+        session.add(job)
+        session.commit()
+        INGEST_JOBS.inc(status=JobStatus(job.status).value)
+
+    return course_id
+
+
+def _run_in_worker(database_url: str, job_id: int) -> tuple[int | None, dict]:
+    """Run the job, sending back the metrics recorded while running it."""
+    course_id = run_job(database_url, job_id)
+    return course_id, REGISTRY.drain()
+
+
+def submit(engine: Engine, job: IngestJob) -> Future:
+    """Run the job within the pool of worker processes.
+
+    The worker updates the model of the user within the database, so once the
+    job is finished any copy of the model cached by this process is replaced.
+    The result of the future is the id of the course along with the metrics
+    recorded by the worker, which are added to those of this process.
+
+    """
+    database_url = engine.url.render_as_string(hide_password=False)
+    future = get_executor().submit(_run_in_worker, database_url, job.id)
+    user_id = job.user_id
+
+    def finished(future: Future) -> None:
+        invalidate_user_model(user_id)
+        if not future.cancelled() and future.exception() is None:
+            _, values = future.result()
+            REGISTRY.merge(values)
+
+    future.add_done_callback(finished)
+    return future
+
+
+def resume_jobs(engine: Engine) -> list[Future]:
+    """Resubmit all the jobs which were not finished when the server stopped."""
+    with Session(engine) as session:
+        unfinished = session.exec(
+            select(IngestJob).where(
+                IngestJob.status.in_([JobStatus.pending, JobStatus.running])
+            )
+        ).all()
+    return [submit(engine, job) for job in unfinished]
@@ -1,7 +1,14 @@
-import geopy.distance
+import numpy as np
 import pandas as pd
-from sklearn.linear_model import LinearRegression
-from sqlmodel import SQLModel
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import defer
+from sqlmodel import Session, SQLModel, select, text
+
+from .derived import DERIVED_FIELDS, gradient, iter_derived, smooth_altitude
+from .geometry import DistanceMethod, step_distance
+from .metrics import timed
+from .models import Course, MLModel
+from .power_model import FEATURES, PowerModel, invalidate_user_model, model_cache
 
 
 def sqmodel_to_df(objs: list[SQLModel]) -> pd.DataFrame:
@@ -10,49 +17,250 @@ def sqmodel_to_df(objs: list[SQLModel]) -> pd.DataFrame:
     return pd.DataFrame.from_records(records)
 
 
+@timed("calculate_gradient")
 def calculate_gradient(
     # Typing support within the python ecosystem is still a little incomplete,
     # in this case with the handling of pandas Series hence the quotation marks
     lat: "pd.Series[float]", 
     lon: "pd.Series[float]", 
-    altitude: "pd.Series[float]"
+    altitude: "pd.Series[float]",
+    method: DistanceMethod = "haversine",
 ) -> "pd.Series[float]":
     """Use the position and altitude to find the gradient at each point.
 
     This finds the distance between the previous point and the current one to
     calculate the distance and the difference in altitude between the previous
-    point and the current one.
+    point and the current one. The distance is calculated for all the points at
+    once using the given method.
+
+    This is the same calculation as the gradient stored for each point, see
+    python_demo.derived, which only supports the default method.
 
     """
-    points = pd.Series([geopy.Point(lat, lon) for lat, lon in zip(lat, lon)])
-    run = pd.Series(
-        [
-            geopy.distance.distance(point_prev, point).meters
-            for point_prev, point in zip(points.shift(-1), points)
-        ]
-    )
-    # The altitude data is very noisy, so by performing an exponentially weighted
-    # mean we are able to smooth the data and remove the noise.
-    altitude = altitude.ewm(span=11).mean()
-    rise = altitude.shift(-1) - altitude
+    run = step_distance(lat, lon, method)
+    smoothed = smooth_altitude(np.asarray(altitude, dtype=np.float64))
+    return pd.Series(gradient(run, smoothed), index=altitude.index)
 
-    # Calculate the gradient and convert to percentage
-    return (rise / run) * 100
 
+# The columns of the points required to train the model, the gradient is
+# calculated as the course is stored.
+TRAINING_FIELDS = ["speed", "gradient", "power"]
 
-def generate_model(objs: list[SQLModel]):
+
+def training_data(df: pd.DataFrame) -> tuple[pd.DataFrame, "pd.Series[float]"]:
+    """Calculate the features and target from the points of a single course.
+
+    The gradient is found from consecutive points, so this has to be given the
+    points of each course separately, ordered by time. When the stored gradient
+    is one of the columns the points can be given a chunk at a time.
+
+    """
     df = (
-        sqmodel_to_df(objs)
-        .assign(
-            speed_kmh=lambda x: x["speed"] * 3.6,
-            gradient=lambda x: calculate_gradient(x["lat"], x["lon"], x["altitude"])
-        )
+        df.assign(**features(df))
         # Having NA values within the Machine Learning model will give rise to 
         # errors so we remove them here.
         .dropna(subset=["gradient", "speed", "power"])
     )
+    return df[FEATURES], df["power"]
+
+
+@timed("features")
+def features(df: pd.DataFrame) -> pd.DataFrame:
+    """Find the features used by the model from the points of a course.
+
+    The stored gradient is used when it's one of the columns, otherwise it is
+    calculated from the position and altitude.
+
+    """
+    if "gradient" in df.columns:
+        gradient = df["gradient"].astype(np.float64)
+    else:
+        gradient = calculate_gradient(df["lat"], df["lon"], df["altitude"])
+    return pd.DataFrame({"speed_kmh": df["speed"] * 3.6, "gradient": gradient})
+
+
+@timed("generate_model")
+def generate_model(objs: list[SQLModel]):
+    """Fit a linear regression to all the points at once.
+
+    This provides the reference the incremental PowerModel is compared to.
+
+    """
+    # Only imported here, scikit-learn isn't needed to train or use the models
+    # of the users so it's loaded only when this is used.
+    from sklearn.linear_model import LinearRegression
+
+    # The gradient is calculated again rather than using the stored values, so
+    # this is also a reference for those.
+    df = sqmodel_to_df(objs).drop(columns=DERIVED_FIELDS)
+    features, target = zip(
+        *(training_data(points) for _, points in df.groupby("course_id", sort=False))
+    )
     model = LinearRegression()
-    X = df[["speed_kmh", "gradient"]]
-    y = df["power"]
-    model.fit(X, y)
+    model.fit(pd.concat(features), pd.concat(target))
+    return model
+
+
+def _select_model(user_id: int):
+    """Select the stored model of the user.
+
+    The pickled model is only read from the database when it is accessed, which
+    is only needed when the model has no parameters.
+
+    """
+    return (
+        select(MLModel).where(MLModel.user_id == user_id).options(defer(MLModel.model))
+    )
+
+
+def load_model(ml_model: MLModel) -> PowerModel | None:
+    """Create the model from what is stored in the database.
+
+    None is returned when the model can't be used, such as a pickled estimator
+    from before the models could be updated, or parameters in a format from a
+    newer version, so the model has to be trained again.
+
+    """
+    if ml_model.params is not None:
+        try:
+            return PowerModel.from_dict(ml_model.params)
+        except ValueError:
+            return None
+    if isinstance(ml_model.model, PowerModel):
+        return ml_model.model
+    return None
+
+
+def _model_values(model) -> dict:
+    """The columns storing the model, by its parameters where possible."""
+    if isinstance(model, PowerModel):
+        return {"params": model.to_dict(), "model": None}
+    return {"params": None, "model": model}
+
+
+def store_model(ml_model: MLModel, model) -> None:
+    """Set the model to be stored, by its parameters where possible."""
+    for name, value in _model_values(model).items():
+        setattr(ml_model, name, value)
+
+
+# The databases able to insert a row or update the existing one in a single
+# statement, which both take the same arguments.
+_UPSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+
+def save_model(session: Session, user_id: int, model) -> None:
+    """Store the model of the user, replacing the existing model if there is one.
+
+    Another job can store the first model of the user while this one is being
+    trained, so the row is inserted or updated in one statement rather than
+    checking for it first, which would add a second model for the user.
+
+    """
+    values = _model_values(model)
+    upsert = _UPSERTS.get(session.get_bind().dialect.name)
+    if upsert is not None:
+        session.execute(
+            upsert(MLModel.__table__)
+            .values(user_id=user_id, **values)
+            .on_conflict_do_update(index_elements=["user_id"], set_=values)
+        )
+    else:
+        ml_model = session.exec(_select_model(user_id)).one_or_none()
+        if ml_model is None:
+            ml_model = MLModel(user_id=user_id)
+        store_model(ml_model, model)
+        session.add(ml_model)
+    session.commit()
+
+
+def _course_model(session: Session, course_id: int) -> PowerModel:
+    """Fit a PowerModel to the points of a single course, a chunk at a time."""
+    model = PowerModel()
+    for df in iter_derived(session, course_id, TRAINING_FIELDS):
+        model.partial_fit(*training_data(df))
+    return model
+
+
+@timed("update_user_model")
+def update_user_model(session: Session, user_id: int, course_id: int) -> PowerModel:
+    """Add the points from a newly stored course to the model of the user.
+
+    Only the points of the new course are read from the database, these are
+    merged into the existing statistics of the model.
+
+    """
+    course_model = _course_model(session, course_id)
+
+    # Reading the model and writing it back has to happen without another job
+    # updating the model in between. SQLite only locks the whole database, so
+    # beginning the transaction immediately takes the write lock before reading
+    # the model. Other databases lock the row of the model as it is read.
+    session.commit()
+    query = _select_model(user_id)
+    if session.get_bind().dialect.name == "sqlite":
+        session.execute(text("BEGIN IMMEDIATE"))
+    else:
+        query = query.with_for_update()
+    ml_model = session.exec(query).one_or_none()
+    model = None if ml_model is None else load_model(ml_model)
+
+    if model is None:
+        # There is no existing model to update, so one is trained from all
+        # the courses of the user, which will include this course. The lock
+        # isn't held while training, save_model replaces a model stored by
+        # another job in the meantime.
+        session.rollback()
+        return train_user_model(session, user_id)
+
+    model.merge(course_model)
+    store_model(ml_model, model)
+    session.add(ml_model)
+    session.commit()
+    invalidate_user_model(user_id)
+    return model
+
+
+@timed("train_user_model")
+def train_user_model(session: Session, user_id: int) -> PowerModel:
+    """Train the model of a user from all of their courses.
+
+    The courses are read a chunk of points at a time, keeping only those
+    points in memory however long the courses are. A model without any samples,
+    from a user without courses, is neither stored nor cached, so the model is
+    trained once there is a course.
+
+    """
+    course_ids = session.exec(
+        select(Course.id).where(Course.user_id == user_id).order_by(Course.id)
+    ).all()
+    model = PowerModel()
+    for course_id in course_ids:
+        model.merge(_course_model(session, course_id))
+
+    if model.n_samples > 0:
+        save_model(session, user_id, model)
+        model_cache.set(user_id, model)
+    return model
+
+
+def get_user_model(session: Session, user_id: int) -> PowerModel:
+    """The model of the user, from the cache where possible.
+
+    The model is updated as each course is uploaded, it only needs training
+    from all the courses when it is missing or was created before the models
+    could be updated.
+
+    """
+    model = model_cache.get(user_id)
+    if model is not None:
+        return model
+
+    ml_model = session.exec(_select_model(user_id)).one_or_none()
+    model = None if ml_model is None else load_model(ml_model)
+    # Models without any samples were stored before these were skipped
+    if model is None or model.n_samples == 0:
+        return train_user_model(session, user_id)
+
+    model_cache.set(user_id, model)
     return model
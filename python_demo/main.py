@@ -1,29 +1,71 @@
+import hashlib
 import os
+import threading
+import time
+from collections.abc import Iterator
 from datetime import timedelta
+from functools import cache
+from typing import Any
 
+import numpy as np
 from dotenv import load_dotenv
 from fastapi import (
+    Body,
     Depends,
     FastAPI,
     Form,
     HTTPException,
+    Query,
     Request,
+    Response,
     UploadFile,
     status,
 )
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.templating import Jinja2Templates
 from fastapi_login import LoginManager
 from fastapi_login.exceptions import InvalidCredentialsException
-from sqlmodel import Session, create_engine, select
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from . import authentication, export, http_cache, jobs, spatial
+from .cache import LRUCache
+from .database import create_async_db_engine, create_db_engine
+from .metrics import REGISTRY, TEMPLATE_SECONDS, MetricsMiddleware, timed
+from .models import (
+    Course,
+    CourseLevel,
+    ImportBatch,
+    IngestJob,
+    JobStatus,
+    User,
+    add_missing_columns,
+    create_db_and_tables,
+)
+from .power_model import PowerModel, UntrainedModel, model_cache
+from .simplify import choose_level
 
-from .authentication import get_password_hash, verify_password
-from .course import decode_fit
-from .machine_learning import generate_model
-from .models import Course, CoursePoints, MLModel, User, create_db_and_tables
 
 # Configuration for the templating.
-templates = Jinja2Templates(directory="templates")
+class Templates(Jinja2Templates):
+    """The templates, recording the time taken to render each response."""
+
+    def TemplateResponse(self, name: str, context: dict, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().TemplateResponse(name, context, *args, **kwargs)
+        TEMPLATE_SECONDS.observe(time.perf_counter() - start, template=name)
+        return response
+
+
+templates = Templates(directory="templates")
 
 # Configuration for the authentication.
 # This is particularly important because we don't want to include the SECRET_KEY
@@ -46,15 +88,12 @@ TOKEN_URL = "/auth" # noqa: S105
 manager = LoginManager(SECRET_KEY, token_url=TOKEN_URL, use_cookie=True)
 
 
-# Configuration of the database
-# Here we are using sqlite as it is included within python and there are no
-# separate services to start and manage.
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
-
-# This stops the check that the SQL model object is created on the same thread
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
+# Configuration of the database, see python_demo.database for the settings which
+# can be changed through environment variables like the SECRET_KEY.
+engine = create_db_engine()
+# The routes which only read from the database are async, so waiting on the
+# database doesn't take up one of the threads shared by the sync routes.
+async_engine = create_async_db_engine()
 
 
 def get_session():
@@ -62,23 +101,93 @@ def get_session():
         yield session
 
 
+async def get_async_session():
+    async with AsyncSession(async_engine) as session:
+        yield session
+
+
+# The users making requests are kept in memory, saving a query on every
+# request to find the user from the username within the token. The time to live
+# is kept short, bounding how long a change made by another process is missed.
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 60
+user_cache: LRUCache[str, User] = LRUCache(
+    maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL
+)
+
+
+def _cache_stat(stat: str):
+    """The statistic of each of the caches for the metrics."""
+    caches = {
+        "model": model_cache,
+        "user": user_cache,
+        "course_version": http_cache.course_versions,
+        "payload": http_cache.payload_cache,
+    }
+    return lambda: [
+        ({"cache": name}, cache.stats()[stat]) for name, cache in caches.items()
+    ]
+
+
+REGISTRY.gauge(
+    "python_demo_cache_entries", "Values held by each cache.", _cache_stat("size")
+)
+REGISTRY.gauge(
+    "python_demo_cache_hits_total",
+    "Values found in each cache.",
+    _cache_stat("hits"),
+    type="counter",
+)
+REGISTRY.gauge(
+    "python_demo_cache_misses_total",
+    "Values missing from each cache.",
+    _cache_stat("misses"),
+    type="counter",
+)
+REGISTRY.gauge(
+    "python_demo_cache_evictions_total",
+    "Values removed from each cache as it was full or they expired.",
+    _cache_stat("evictions"),
+    type="counter",
+)
+REGISTRY.gauge(
+    "python_demo_payload_cache_bytes",
+    "Memory held by the cached bodies of responses.",
+    lambda: http_cache.payload_cache.nbytes,
+)
+
+
 # Configure and setup the FastAPI application
 app = FastAPI()
+# The time and count of every request is recorded for the /metrics
+app.add_middleware(MetricsMiddleware)
 
 
 # the python-multipart package is required to use the OAuth2PasswordRequestForm
 @app.post("/auth")
-def login(
+async def login(
     request: Request,
     data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_session),
+    db: AsyncSession = Depends(get_async_session),
 ):
     # we are using the same function to retrieve the user
-    user = load_user(data.username, db)
+    user = await load_user(data.username, db)
     if not user:
         raise InvalidCredentialsException
-    elif not verify_password(data.password, user.hashed_password):
+    # Hashing the password is deliberately slow, so it is run on the hashing
+    # workers rather than blocking the event loop for every other request.
+    valid, new_hash = await authentication.verify_and_update(
+        data.password, user.hashed_password
+    )
+    if not valid:
         raise InvalidCredentialsException
+    # The password is only available when logging in, so this is when the hash
+    # is updated after a change to the settings of argon2.
+    if new_hash is not None:
+        user.hashed_password = new_hash
+        db.add(user)
+        await db.commit()
+        user_cache.invalidate(data.username)
 
     context = {
         "request": request,
@@ -99,10 +208,21 @@ def login(
     return response
 
 
-@manager.user_loader(session=next(get_session()))
-def load_user(username: str, session) -> User:
+@manager.user_loader()
+async def load_user(
+    username: str, session: AsyncSession | None = None
+) -> User | None:
     """Ensure the user is loaded to provide access to properties.
 
+    When called by the login manager there is no session, so the user is
+    taken from the cache, or otherwise looked up with a session from the pool.
+    Sharing a single session between all the requests isn't safe. This is
+    called for every request, so the lookup is async to avoid blocking the
+    event loop. When a session is given, the user is always read from the
+    database so it can be modified within that session.
+
+    The cached user is shared between requests, so it must only be read.
+
     Note:
     ----
         When working with the user object and other sessions, that is when
@@ -112,7 +232,35 @@ def load_user(username: str, session) -> User:
         the user directly.
 
     """
-    return session.exec(select(User).where(User.username == username)).one()
+    if session is None:
+        user = user_cache.get(username)
+        if user is not None:
+            return user
+        async with AsyncSession(async_engine) as session:
+            user = await load_user(username, session)
+        # Users which don't exist are not cached, so they are seen straight
+        # away once they sign up.
+        if user is not None:
+            user_cache.set(username, user)
+        return user
+    result = await session.exec(select(User).where(User.username == username))
+    return result.one_or_none()
+
+
+# The modules decoding courses and training the models import pandas, which
+# takes longer to import and uses more memory than the rest of the application
+# together. Rather than importing these when the application is imported, they
+# are imported by the routes needing them, so the server is able to start and
+# serve the other routes without waiting. Unless WARM_UP is 0, they are then
+# imported in the background once the server has started, ready for the first
+# request needing them.
+WARM_UP = os.getenv("WARM_UP", "1") != "0"
+
+
+@timed("warm_up")
+def warm_up() -> None:
+    """Import the modules for analysing the courses."""
+    from . import course, machine_learning  # noqa: F401
 
 
 # When the FastAPI application starts, is will run the "startup" events. For
@@ -121,6 +269,27 @@ def load_user(username: str, session) -> User:
 @app.on_event("startup")
 def on_startup():
     create_db_and_tables(engine)
+    add_missing_columns(engine)
+    # Any uploads which were not ingested before the server stopped are
+    # picked up where they were left.
+    jobs.resume_jobs(engine)
+    if WARM_UP:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    jobs.shutdown()
+    authentication.shutdown()
+    await async_engine.dispose()
+
+
+@app.get("/metrics")
+async def read_metrics():
+    """The metrics of this process in the Prometheus text format."""
+    return PlainTextResponse(
+        REGISTRY.render(), media_type="text/plain; version=0.0.4"
+    )
 
 
 @app.get("/")
@@ -139,14 +308,32 @@ def signup(request: Request):
     return templates.TemplateResponse("sign_up.html", context)
 
 
+@app.exception_handler(authentication.HashingBusy)
+def hashing_busy(request: Request, exc: authentication.HashingBusy):
+    # Rather than waiting, the client is asked to try again shortly, which keeps
+    # the memory used by hashing within the limits during a burst of logins.
+    return JSONResponse(
+        {"detail": str(exc)},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(spatial.IndexUnavailable)
+def spatial_index_unavailable(request: Request, exc: spatial.IndexUnavailable):
+    return JSONResponse(
+        {"detail": str(exc)}, status_code=status.HTTP_501_NOT_IMPLEMENTED
+    )
+
+
 @app.post("/user")
-def new_user(
+async def new_user(
     request: Request,
     username=Form(),
     password=Form(),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    if session.exec(select(User).where(User.username == username)).first() is not None:
+    if await load_user(username, session) is not None:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="User Exists")
 
     # Create the new user and store within the database. This doesn't persist
@@ -154,10 +341,10 @@ def new_user(
     session.add(
         User(
             username=username,
-            hashed_password=get_password_hash(password),
+            hashed_password=await authentication.hash_password(password),
         )
     )
-    session.commit()
+    await session.commit()
 
     context = {
         "request": request,
@@ -182,86 +369,316 @@ def post_course(
     session: Session = Depends(get_session),
     user: User = Depends(manager),
 ):
-    """Upload and store a course for the currently logged in user.
+    """Upload a course for the currently logged in user.
+
+    Rather than decoding the file within the request, this records a job which
+    stores the course in the background, returning the location where the
+    progress of the job can be followed.
 
-    This allows us to upload a file and persist the data within the database.
     """
-    # The UploadFile class handles creating a temporary file for us, so we can use
-    # the file property to pass this temporary file to any other function.
-    points = decode_fit(file.file)
     if name is not None:
         name = name
     else:
         name = file.filename
-    course = Course(user_id=user.id, name=name, points=points)
-    session.add(course)
-    session.commit()
-    # Ensure all the database created values like ids and relationships are
-    # refreshed and up to date.
-    session.refresh(course)
+    # The UploadFile class handles creating a temporary file for us, so we can use
+    # the file property to pass this temporary file to any other function.
+    job = jobs.create_job(session, file.file, user_id=user.id, name=name)
+    # An upload of an existing course is done already, with that course
+    if job.status == JobStatus.pending:
+        jobs.submit(engine, job)
 
     # This context is used by the template to fill in values
     context = {
         "request": request,
         "success_msg": "Course upload Successful!",
-        "path_route": f"/course/{course.id}",
-        "path_msg": "Click here to view the course!",
+        "path_route": f"/course/jobs/{job.id}",
+        "path_msg": "Click here to follow the processing of the course!",
     }
     return templates.TemplateResponse("success.html", context)
 
 
+@app.get("/course/jobs/{job_id}")
+def read_job(
+    job_id: int,
+    current_user: User = Depends(manager),
+    session: Session = Depends(get_session),
+):
+    """The status of an upload, redirecting to the course once it is stored."""
+    job = session.get(IngestJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Job does not belong to current user.",
+        )
+
+    if job.status == JobStatus.done:
+        return RedirectResponse(
+            f"/course/{job.course_id}", status_code=status.HTTP_303_SEE_OTHER
+        )
+    return {"id": job.id, "status": job.status, "error": job.error}
+
+
+@app.post("/course/batch", status_code=status.HTTP_202_ACCEPTED)
+def post_course_batch(
+    *,
+    files: list[UploadFile],
+    session: Session = Depends(get_session),
+    user: User = Depends(manager),
+):
+    """Upload many courses at once, as FIT files or zip archives of FIT files.
+
+    A job is recorded for each FIT file and these are all run by the pool of
+    workers, returning the status of the batch. The progress of every file is
+    then followed through /course/batch/{batch_id}.
+
+    """
+    batch, batch_jobs = jobs.create_batch(
+        session, [(file.file, file.filename) for file in files], user_id=user.id
+    )
+    for job in batch_jobs:
+        if job.status == JobStatus.pending:
+            jobs.submit(engine, job)
+    return jobs.batch_status(session, batch.id)
+
+
+@app.get("/course/batch/{batch_id}")
+def read_batch(
+    batch_id: int,
+    current_user: User = Depends(manager),
+    session: Session = Depends(get_session),
+):
+    """The status of each of the files uploaded within a batch."""
+    batch = session.get(ImportBatch, batch_id)
+    if batch is None or batch.user_id != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Batch does not belong to current user.",
+        )
+    return jobs.batch_status(session, batch.id)
+
+
 @app.get("/home")
-def read_my_home(request: Request, current_user: User = Depends(manager)):
+async def read_my_home(
+    request: Request,
+    current_user: User = Depends(manager),
+    session: AsyncSession = Depends(get_async_session),
+):
+    # The summary of each course is stored alongside it, so listing the courses
+    # is a single query which doesn't touch any of the points.
+    result = await session.exec(
+        select(Course)
+        .where(Course.user_id == current_user.id)
+        .order_by(Course.start_time.desc())
+    )
+    courses = result.all()
     context = {
         "username": current_user.username,
         "request": request,
-        "courses": current_user.courses,
+        "courses": courses,
     }
     return templates.TemplateResponse("home.html", context)
 
 
+async def _course_version(
+    session: AsyncSession, course_id: int, user: User
+) -> http_cache.CourseVersion:
+    """The version of a course of the user, from memory where possible."""
+    version = http_cache.course_versions.get(course_id)
+    if version is None:
+        course = await session.get(Course, course_id)
+        if course is not None:
+            version = http_cache.remember(course)
+    if version is None or version.user_id != user.id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Course does not belong to current user.",
+        )
+    return version
+
+
+@cache
+def _template_hash(name: str) -> str:
+    """Identify the source of a template, and the base it extends.
+
+    This is part of the ETag of the pages, so a change to the templates
+    doesn't leave browsers with the old pages.
+
+    """
+    digest = hashlib.sha256()
+    for template in [name, "base.html"]:
+        source, _, _ = templates.env.loader.get_source(templates.env, template)
+        digest.update(source.encode())
+    return digest.hexdigest()[:16]
+
+
 @app.get("/course/{course_id}")
-def read_courses(
+async def read_courses(
     course_id: int,
     request: Request,
     current_user: User = Depends(manager),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    course = session.get(Course, course_id)
-    if course is None or course.user != current_user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Course does not belong to current user.",
-        )
+    """The page of the course, drawing the track from its points.
+
+    The page only changes with the version of the course, so a page already
+    held by the browser is confirmed with a 304, and the page is rendered once
+    for each version.
+
+    """
+    version = await _course_version(session, course_id, current_user)
+    tag = http_cache.etag(course_id, version, _template_hash("course.html"))
+    headers = http_cache.headers(tag, version, http_cache.PAGE_CACHE_CONTROL)
+    if http_cache.not_modified(request, tag, version):
+        return http_cache.not_modified_response(headers)
+
+    body = http_cache.payload_cache.get(tag)
+    if body is not None:
+        return HTMLResponse(body, headers=headers)
 
+    course = await session.get(Course, course_id)
     context = {
         "request": request,
         "course": course,
     }
-    return templates.TemplateResponse("course.html", context)
+    response = templates.TemplateResponse("course.html", context, headers=headers)
+    http_cache.payload_cache.set(tag, response.body)
+    return response
 
 
 @app.get("/course/{course_id}/points")
-def read_course_points(
+async def read_course_points(
     course_id: int,
+    request: Request,
+    format: str | None = None,
+    fields: str | None = None,
+    max_points: int | None = None,
+    current_user: User = Depends(manager),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """The points of the course, streamed in the requested format.
+
+    The format is chosen from the Accept header, or the format query parameter
+    which is one of json, columns, csv or arrow. The fields query parameter is
+    a comma separated list of the fields to include, like fields=lat,lon,speed.
+    With max_points, the track is simplified to the most detailed level which
+    has no more than that many points.
+
+    The checks are made asynchronously, while the points are read and encoded
+    by a generator which the StreamingResponse runs on a thread, since encoding
+    many thousands of points would otherwise block the event loop.
+
+    The points only change with the version of the course. Points the browser
+    already has are confirmed with a 304 and the encoded points are cached,
+    neither of which reads from the database, see python_demo.http_cache.
+
+    """
+    version = await _course_version(session, course_id, current_user)
+
+    try:
+        fields_list = export.parse_fields(fields)
+    except ValueError as error:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(error)
+        ) from error
+    try:
+        format = export.negotiate(request.headers.get("accept"), format)
+    except ValueError as error:
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=str(error)
+        ) from error
+
+    tag = http_cache.etag(course_id, version, format, fields_list, max_points)
+    headers = http_cache.headers(tag, version, http_cache.POINTS_CACHE_CONTROL)
+    # The format depends on the Accept header when it isn't given
+    headers["Vary"] = "Accept"
+    if http_cache.not_modified(request, tag, version):
+        return http_cache.not_modified_response(headers)
+
+    body = http_cache.payload_cache.get(tag)
+    if body is not None:
+        return Response(body, media_type=export.MEDIA_TYPES[format], headers=headers)
+
+    level = 0
+    if max_points is not None:
+        result = await session.exec(
+            select(CourseLevel).where(CourseLevel.course_id == course_id)
+        )
+        level = choose_level(result.all(), max_points)
+
+    # The session is closed by the generator once the response is complete
+    sync_session = Session(engine)
+    try:
+        content = export.stream_points(
+            sync_session, course_id, fields_list, format, level
+        )
+    except ValueError as error:
+        sync_session.close()
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=str(error)
+        ) from error
+
+    return StreamingResponse(
+        http_cache.keep(tag, _closing(sync_session, content)),
+        media_type=export.MEDIA_TYPES[format],
+        headers=headers,
+    )
+
+
+def _closing(session: Session, content: Iterator[bytes]) -> Iterator[bytes]:
+    try:
+        yield from content
+    finally:
+        session.close()
+
+
+# The largest area searched around a position in metres, so a single request
+# can't read the points of every course.
+MAX_SEARCH_RADIUS = 50_000
+
+
+@app.get("/search/courses")
+def search_courses(
+    min_lat: float = Query(ge=-90, le=90),
+    max_lat: float = Query(ge=-90, le=90),
+    min_lon: float = Query(ge=-180, le=180),
+    max_lon: float = Query(ge=-180, le=180),
     current_user: User = Depends(manager),
     session: Session = Depends(get_session),
-) -> list[CoursePoints]:
-    course = session.get(Course, course_id)
-    if course is None or course.user != current_user:
+):
+    """The courses of the user passing through the box, latest first."""
+    if min_lat > max_lat or min_lon > max_lon:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Course does not belong to current user.",
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="The minimum of the box is above its maximum.",
         )
+    box = spatial.Box(min_lat, max_lat, min_lon, max_lon)
+    return spatial.courses_in_box(session, current_user.id, box)
 
-    return course.points
+
+@app.get("/search/points")
+def search_points(
+    lat: float = Query(ge=-90, le=90),
+    lon: float = Query(ge=-180, le=180),
+    radius: float = Query(default=200, gt=0, le=MAX_SEARCH_RADIUS),
+    limit: int = Query(default=100, gt=0, le=1000),
+    current_user: User = Depends(manager),
+    session: Session = Depends(get_session),
+):
+    """The points of the courses of the user within radius metres, nearest first.
+
+    Each point has the id of its course, the time, the position and the
+    distance in metres from the given position.
+
+    """
+    return JSONResponse(
+        spatial.points_near(session, current_user.id, lat, lon, radius, limit)
+    )
 
 
 @app.get("/predict")
-def get_predict(
+async def get_predict(
     request: Request,
     current_user: User = Depends(manager),
-    session: Session = Depends(get_session),
 ):
     context = {
         "request": request,
@@ -269,37 +686,43 @@ def get_predict(
     return templates.TemplateResponse("predict.html", context)
 
 
+async def _user_model(user_id: int) -> PowerModel:
+    """The model of the user, without blocking the event loop.
+
+    The model is almost always within the cache, otherwise reading and possibly
+    training it is run on a thread.
+
+    """
+    model = model_cache.get(user_id)
+    if model is not None:
+        return model
+
+    def load() -> PowerModel:
+        from .machine_learning import get_user_model
+
+        with Session(engine) as session:
+            return get_user_model(session, user_id)
+
+    return await run_in_threadpool(load)
+
+
 @app.post("/predict")
-def get_predict_post(
+async def get_predict_post(
     *,
     speed: float = Form(),
     gradient: float = Form(),
     request: Request,
     current_user: User = Depends(manager),
-    session: Session = Depends(get_session),
 ):
-    ml_model = session.exec(
-        select(MLModel).where(MLModel.user_id == current_user.id)
-    ).one_or_none()
-
-    if ml_model is None or ml_model.model is None:
-        query = (
-            select(CoursePoints)
-            .join(Course)
-            .where(Course.user_id == current_user.id)
-            .order_by(CoursePoints.course_id, CoursePoints.time)
-        )
-        model = generate_model(session.exec(query).fetchall())
-        if ml_model is None:
-            ml_model = MLModel(user_id=current_user.id, model=model)
-        else:
-            ml_model.model = model
-        session.add(ml_model)
-        session.commit()
-        session.refresh(ml_model)
-
-    # Calculate the predicted power output
-    power = ml_model.model.predict([[speed, gradient]])[0]
+    model = await _user_model(current_user.id)
+
+    # Calculate the predicted power output, for a single point this is quick
+    # enough to run on the event loop. Without any courses there is no
+    # prediction, and the user is asked to upload one.
+    try:
+        power = model.predict([[speed, gradient]])[0]
+    except UntrainedModel:
+        power = None
 
     context = {
         "request": request,
@@ -308,3 +731,75 @@ def get_predict_post(
         "gradient": gradient,
     }
     return templates.TemplateResponse("prediction.html", context)
+
+
+@app.post("/predict/batch")
+def predict_batch(
+    *,
+    # Declaring the body as a plain dictionary rather than lists of floats means
+    # pydantic doesn't validate every value one at a time, instead numpy converts
+    # each list to an array in a single step.
+    body: dict[str, Any] = Body(),
+    current_user: User = Depends(manager),
+    session: Session = Depends(get_session),
+):
+    """Predict the power for many speeds (km/h) and gradients (%) at once.
+
+    The body contains either the lists "speed" and "gradient", or a "course_id"
+    to predict the power at every point of one of the courses of the user. Any
+    points where the prediction isn't possible have a power of null.
+
+    """
+    from .derived import load_derived
+    from .machine_learning import TRAINING_FIELDS, features, get_user_model
+    from .storage import nullable_list
+
+    if "course_id" in body:
+        # A bool is an int in python, though not a valid id
+        course_id = body["course_id"]
+        if not isinstance(course_id, int) or isinstance(course_id, bool):
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="The course_id must be an integer.",
+            )
+        course = session.get(Course, course_id)
+        if course is None or course.user_id != current_user.id:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Course does not belong to current user.",
+            )
+        df = load_derived(session, course.id, TRAINING_FIELDS)
+        X = features(df).to_numpy()
+    else:
+        try:
+            X = np.column_stack(
+                [
+                    np.asarray(body["speed"], dtype=np.float64),
+                    np.asarray(body["gradient"], dtype=np.float64),
+                ]
+            )
+        except (KeyError, TypeError, ValueError):
+            X = None
+        if X is None or X.shape[1] != 2:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Expected a course_id or lists of speed and gradient.",
+            )
+
+    model = get_user_model(session, current_user.id)
+    try:
+        power = model.predict(X)
+    except UntrainedModel as error:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail=str(error)
+        ) from error
+
+    # Returning the response directly skips the conversion of every value by
+    # the jsonable_encoder, leaving the json module to encode the lists.
+    return JSONResponse(
+        {
+            "speed": nullable_list(X[:, 0]),
+            "gradient": nullable_list(X[:, 1]),
+            "power": nullable_list(power),
+        }
+    )
@@ -0,0 +1,318 @@
+"""Measure where the time goes within the application.
+
+The metrics are kept in memory and served from /metrics in the Prometheus text
+exposition format, so they can be scraped by Prometheus or simply read in the
+browser. There are three types of metric:
+
+ - Counter: a count which only ever increases, like the number of requests.
+ - Histogram: the distribution of values like durations, as the count of the
+   values within each bucket along with the total count and sum.
+ - Gauge: a value read when the metrics are collected, like the size of a
+   cache, taken from a function.
+
+Recording a value is a dictionary lookup and addition under a lock, cheap
+enough to leave on for every request. Each metric can have labels, like the
+route of a request, given as keyword arguments.
+
+The ingest jobs run in separate worker processes, each with their own copy of
+the metrics. The values recorded by a job are taken from the worker with
+drain, sent back along with the result of the job and added to the metrics of
+the server with merge.
+
+"""
+
+import bisect
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import ContextDecorator
+from typing import Any
+
+Labels = tuple[tuple[str, str], ...]
+
+# Buckets in seconds suiting the duration of requests and the steps within them
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(labels: dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """A count of events, like the number of requests."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(_labels(labels), 0)
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name, labels, value
+
+    def drain(self) -> dict[Labels, float]:
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: dict[Labels, float]) -> None:
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+
+class _Timer(ContextDecorator):
+    """Observe the time taken within a with block or call of a function."""
+
+    def __init__(self, histogram: "Histogram", labels: dict[str, Any]):
+        self.histogram = histogram
+        self.labels = labels
+        # The start times are kept per thread, so a single timer used as a
+        # decorator can time calls made on several threads at once.
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._local.__dict__.setdefault("starts", []).append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        start = self._local.starts.pop()
+        self.histogram.observe(time.perf_counter() - start, **self.labels)
+        return False
+
+
+class Histogram:
+    """The distribution of values, like the time taken to respond to requests."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # For each set of labels the count within each bucket, with the last
+        # being those above the largest bucket, then the sum of the values.
+        self._values: dict[Labels, tuple[list[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or (
+                [0] * (len(self.buckets) + 1),
+                0.0,
+            )
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels: Any) -> _Timer:
+        """Time a block of code, or every call of a function when decorating it."""
+        return _Timer(self, labels)
+
+    def count(self, **labels: Any) -> int:
+        counts, _ = self._values.get(_labels(labels), ([], 0.0))
+        return sum(counts)
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        with self._lock:
+            values = [
+                (labels, list(counts), total)
+                for labels, (counts, total) in self._values.items()
+            ]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    (*labels, ("le", _format_value(bound))),
+                    cumulative,
+                )
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, total
+
+    def drain(self) -> dict[Labels, tuple[list[int], float]]:
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: dict[Labels, tuple[list[int], float]]) -> None:
+        with self._lock:
+            for key, (counts, total) in values.items():
+                current, current_total = self._values.get(key) or (
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                )
+                merged = [a + b for a, b in zip(current, counts)]
+                self._values[key] = (merged, current_total + total)
+
+
+class Gauge:
+    """A value read from a function whenever the metrics are collected.
+
+    The function returns either a single value, or a list of the labels, as a
+    dictionary, along with the value for those labels. Counts which are kept
+    elsewhere, like the hits of a cache, can be reported as a counter by
+    setting the type.
+
+    """
+
+    def __init__(
+        self, name: str, help: str, func: Callable[[], Any], type: str = "gauge"
+    ):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        values = self.func()
+        if isinstance(values, int | float):
+            yield self.name, (), values
+            return
+        for labels, value in values:
+            yield self.name, _labels(labels), value
+
+
+class Registry:
+    """All the metrics of the application."""
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram | Gauge] = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"The metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.register(Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def gauge(
+        self, name: str, help: str, func: Callable[[], Any], type: str = "gauge"
+    ) -> Gauge:
+        return self.register(Gauge(name, help, func, type))
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def drain(self) -> dict[str, Any]:
+        """Take the values of the counters and histograms, resetting them."""
+        return {
+            name: metric.drain()
+            for name, metric in self._metrics.items()
+            if not isinstance(metric, Gauge)
+        }
+
+    def merge(self, values: dict[str, Any]) -> None:
+        """Add the values taken from the registry of another process."""
+        for name, metric_values in values.items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric.merge(metric_values)
+
+
+REGISTRY = Registry()
+
+# The time taken by the steps of handling a request or ingesting a course
+FUNCTION_SECONDS = REGISTRY.histogram(
+    "python_demo_function_seconds", "Time taken by instrumented functions."
+)
+COMMIT_SECONDS = REGISTRY.histogram(
+    "python_demo_db_commit_seconds", "Time taken to commit a database session."
+)
+TEMPLATE_SECONDS = REGISTRY.histogram(
+    "python_demo_template_render_seconds", "Time taken to render a template."
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "python_demo_request_seconds", "Time taken to respond to HTTP requests."
+)
+REQUESTS = REGISTRY.counter("python_demo_requests_total", "HTTP requests served.")
+
+
+def timed(name: str) -> _Timer:
+    """Decorate a function to record the time taken by each call."""
+    return FUNCTION_SECONDS.time(function=name)
+
+
+class MetricsMiddleware:
+    """Record the count and latency of every HTTP request.
+
+    Requests are labelled by the path of the route, like /course/{course_id},
+    rather than the path requested, keeping the number of labels bounded. The
+    time is measured until the response has been completely sent, so includes
+    streaming the response.
+
+    This is a plain ASGI middleware rather than using the http middleware
+    decorator of FastAPI, which has a much larger overhead.
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            labels = {
+                "method": scope["method"],
+                "route": route.path if route is not None else "unmatched",
+            }
+            REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+            REQUESTS.inc(**labels, status=status)
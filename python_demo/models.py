@@ -1,6 +1,23 @@
-from datetime import datetime, date
+from datetime import date, datetime, timezone
+from enum import Enum
 
-from sqlmodel import Column, Field, PickleType, Relationship, SQLModel
+import numpy as np
+from sqlalchemy import (
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    Table,
+    delete,
+    func,
+    inspect,
+    literal,
+    select,
+    update,
+)
+from sqlmodel import JSON, Column, Field, Index, PickleType, Relationship, SQLModel
+
+from .geometry import step_distance
 
 
 def create_db_and_tables(engine):
@@ -11,6 +28,140 @@ def create_db_and_tables(engine):
 
     """
     SQLModel.metadata.create_all(engine)
+    # SQLAlchemy is unable to create virtual tables, so the spatial index is
+    # created separately.
+    if has_point_index(engine):
+        with engine.begin() as connection:
+            connection.exec_driver_sql(POINT_INDEX_DDL)
+
+
+def add_missing_columns(engine) -> list[str]:
+    """Add the columns of the tables which are missing from the database.
+
+    The tables are only created when they don't exist, so a database created
+    before a column was added to one of the models is missing that column.
+    These are added, with the default value of the column where it has one,
+    along with any missing indexes. An index which has since been made unique
+    is created again, once the rows which would break it are removed. The
+    summary of the courses stored before it was kept is filled in. The names
+    of the columns added are returned.
+
+    """
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                definition = f"{column.name} {column.type.compile(engine.dialect)}"
+                if column.default is not None and column.default.is_scalar:
+                    value = literal(column.default.arg).compile(
+                        dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+                    )
+                    definition += f" DEFAULT {value}"
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN {definition}"
+                )
+                added.append(f"{table.name}.{column.name}")
+        _remove_duplicates(connection)
+        backfill_summaries(connection)
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {
+                index["name"]: index
+                for index in inspect(connection).get_indexes(table.name)
+            }
+            for index in table.indexes:
+                # An index which has since been made unique is created again
+                if index.name in existing:
+                    if bool(existing[index.name]["unique"]) == index.unique:
+                        continue
+                    index.drop(connection)
+                index.create(connection)
+    return added
+
+
+def _remove_duplicates(connection) -> None:
+    """Remove the rows which would break an index from before it was unique."""
+    # A user could be given more than one model, only the latest is kept
+    latest = select(func.max(MLModel.id)).group_by(MLModel.user_id)
+    connection.execute(delete(MLModel).where(MLModel.id.not_in(latest)))
+    # The same file could be stored more than once by a user. The copies are
+    # kept without the hash, python -m python_demo.dedup still lists them.
+    first = (
+        select(func.min(Course.id))
+        .where(Course.file_hash.is_not(None))
+        .group_by(Course.user_id, Course.file_hash)
+    )
+    connection.execute(
+        update(Course)
+        .where(Course.file_hash.is_not(None), Course.id.not_in(first))
+        .values(file_hash=None)
+    )
+
+
+# The number of points read at a time to find the distance of a course
+_BACKFILL_CHUNK_SIZE = 5000
+
+
+def backfill_summaries(connection) -> None:
+    """Summarise the points of the courses stored before the summary was kept.
+
+    These courses have points without a start time. Only courses stored as
+    rows can be missing the summary, as blocks came later. Each course is
+    summarised once, courses without points are left as they are.
+
+    """
+    points = CoursePoints.__table__
+    missing = select(Course.id).where(Course.start_time.is_(None))
+    summaries = connection.execute(
+        select(
+            points.c.course_id,
+            func.count(),
+            func.min(points.c.time),
+            func.max(points.c.time),
+            func.min(points.c.lat),
+            func.max(points.c.lat),
+            func.min(points.c.lon),
+            func.max(points.c.lon),
+        )
+        .where(points.c.course_id.in_(missing))
+        .group_by(points.c.course_id)
+    ).all()
+    for course_id, n_points, start_time, end_time, *bounds in summaries:
+        connection.execute(
+            update(Course)
+            .where(Course.id == course_id)
+            .values(
+                n_points=n_points,
+                start_time=start_time,
+                duration=(end_time - start_time).total_seconds(),
+                distance=_course_distance(connection, course_id),
+                min_lat=bounds[0],
+                max_lat=bounds[1],
+                min_lon=bounds[2],
+                max_lon=bounds[3],
+            )
+        )
+
+
+def _course_distance(connection, course_id: int) -> float:
+    """The distance travelled over the points of a course stored as rows."""
+    points = CoursePoints.__table__
+    result = connection.execute(
+        select(points.c.lat, points.c.lon)
+        .where(points.c.course_id == course_id)
+        .order_by(points.c.time)
+    )
+    distance = 0.0
+    # The final position of the previous chunk, for the step to the next chunk
+    last = np.empty((0, 2))
+    for rows in result.partitions(_BACKFILL_CHUNK_SIZE):
+        positions = np.concatenate([last, np.array(rows, dtype=np.float64)])
+        distance += np.nansum(step_distance(positions[:, 0], positions[:, 1]))
+        last = positions[-1:]
+    return float(distance)
 
 
 class User(SQLModel, table=True):
@@ -37,7 +188,13 @@ class User(SQLModel, table=True):
 
 class MLModel(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    user_id: int = Field(foreign_key="user.id")
+    # Each user has a single model, so concurrent trainings can't both add one
+    user_id: int = Field(foreign_key="user.id", index=True, unique=True)
+    # The parameters of the model as returned by PowerModel.to_dict, which can
+    # be read without unpickling or importing the library the model came from.
+    params: dict | None = Field(default=None, sa_column=Column(JSON))
+    # Models which can't be described by their parameters are pickled instead.
+    # This is also where models were stored before the parameters were used.
     model: PickleType | None = Field(default=None, sa_column=Column(PickleType))
 
     # To store the machine learning model we need to store it as binary data
@@ -57,7 +214,46 @@ class Course(SQLModel, table=True):
 
     id: int | None = Field(default=None, primary_key=True)
     name: str | None
-    user_id: int | None = Field(default=None, foreign_key="user.id")
+    user_id: int | None = Field(default=None, foreign_key="user.id", index=True)
+
+    # A summary of the points within the course, calculated as the points are
+    # stored. Listing the courses is then able to use these values rather than
+    # reading the points of every course. Courses stored before these were kept
+    # are summarised by add_missing_columns.
+    start_time: datetime | None = None
+    # The time from the first to the last point in seconds
+    duration: float | None = None
+    n_points: int = 0
+    # The distance travelled over the course in metres
+    distance: float | None = None
+    # The bounding box containing all the points within the course
+    min_lat: float | None = None
+    max_lat: float | None = None
+    min_lon: float | None = None
+    max_lon: float | None = None
+
+    # Where the points of the course are stored, either a row for each point
+    # within CoursePoints, or blocks of values within PointBlock. See
+    # python_demo.storage for the details.
+    storage: str = "rows"
+
+    # Increased whenever the points are changed after being stored, such as
+    # storing their derived values, along with the time of the change. The
+    # responses for the course are cached by these, see python_demo.http_cache.
+    version: int = 1
+    modified: datetime | None = Field(
+        default_factory=lambda: datetime.now(timezone.utc)
+    )
+
+    # The fingerprint of the uploaded file, so uploading the same activity
+    # again returns this course rather than storing another copy, see
+    # python_demo.dedup. These are missing for courses uploaded before.
+    # The SHA-256 of the bytes of the file, in hex
+    file_hash: str | None = None
+    # The identity of the activity given by the device within the FIT file,
+    # which is kept when the file is copied by tools changing its bytes.
+    fit_serial_number: int | None = None
+    fit_time_created: datetime | None = None
 
     points: list["CoursePoints"] = Relationship(
         back_populates="course",
@@ -65,20 +261,30 @@ class Course(SQLModel, table=True):
     )
     user: User = Relationship(back_populates="courses")
 
+    # Uploads are checked against the other courses of the user by fingerprint.
+    # Each file is only stored once for a user, even when uploaded twice at the
+    # same time.
+    __table_args__ = (
+        Index("ix_course_user_id_file_hash", "user_id", "file_hash", unique=True),
+        Index(
+            "ix_course_user_id_fit_file_id",
+            "user_id",
+            "fit_serial_number",
+            "fit_time_created",
+        ),
+    )
+
     # Rather than store this additional data, we can make it available as though it was
     # using the property decorator. This should only be used where the cost of computing
     # the value is low rather than for complex transformations.
     @property
     def date(self) -> date | None:
         """Use the date of the first point as the date of the course."""
-        # Handle the case where there are no points in the course. This takes
-        # the better to ask forgiveness than permission approach.
-        try:
-            point = self.points[0]
-        except IndexError:
+        # Handle the case where there are no points in the course.
+        if self.start_time is None:
             return None
 
-        return point.time.date()
+        return self.start_time.date()
 
 
 class CoursePoints(SQLModel, table=True):
@@ -101,6 +307,139 @@ class CoursePoints(SQLModel, table=True):
     speed: float | None
     heart_rate: int | None
     altitude: int | None
+    # The coarsest level of detail at which this point is needed to draw the
+    # track of the course, see python_demo.simplify.
+    detail: int = 0
+
+    # Values depending on the neighbouring points, calculated once the course
+    # has been stored, see python_demo.derived.
+    # The distance in metres to the following point
+    step_distance: float | None = None
+    # The distance in metres from the first point of the course
+    cumulative_distance: float | None = None
+    # The altitude in metres with the noise of the sensor smoothed out
+    smoothed_altitude: float | None = None
+    # The gradient in percent to the following point
+    gradient: float | None = None
 
     # Provide a link back to the course
     course: Course | None = Relationship(back_populates="points")
+
+    # The points are nearly always read for a single course ordered by time, so
+    # an index on both allows these to be read without scanning or sorting.
+    __table_args__ = (Index("ix_coursepoints_course_id_time", "course_id", "time"),)
+
+
+class PointBlock(SQLModel, table=True):
+    """The values of a field for a block of consecutive points of a course.
+
+    These are used in place of a row of CoursePoints for every point when the
+    course is stored in blocks, see python_demo.storage.
+
+    """
+
+    course_id: int = Field(foreign_key="course.id", primary_key=True)
+    field: str = Field(primary_key=True)
+    # The position of the block within the course, starting from 0
+    block: int = Field(primary_key=True)
+    n_points: int
+    # The compressed array of the values, see python_demo.storage.encode
+    data: bytes
+
+
+# The fields of CoursePoints derived from the neighbouring points
+DERIVED_FIELDS = [
+    "step_distance",
+    "cumulative_distance",
+    "smoothed_altitude",
+    "gradient",
+]
+
+
+class JobStatus(str, Enum):
+    """The stages an IngestJob moves through."""
+
+    pending = "pending"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class ImportBatch(SQLModel, table=True):
+    """Files uploaded together, each stored by an IngestJob within the batch."""
+
+    id: int | None = Field(default=None, primary_key=True)
+    user_id: int = Field(foreign_key="user.id", index=True)
+    created: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class IngestJob(SQLModel, table=True):
+    """An uploaded file waiting to be, or having been, ingested as a Course.
+
+    The uploaded file is copied to the path, where it remains until the job is
+    complete. Keeping the jobs within the database means they are resumed when
+    the application restarts rather than being lost.
+
+    """
+
+    id: int | None = Field(default=None, primary_key=True)
+    user_id: int = Field(foreign_key="user.id", index=True)
+    name: str | None
+    path: str
+    status: JobStatus = Field(default=JobStatus.pending, index=True)
+    # Once the job is done this is the course that was created.
+    course_id: int | None = Field(default=None, foreign_key="course.id")
+    error: str | None = None
+    # The SHA-256 of the uploaded file in hex, calculated as it is spooled
+    file_hash: str | None = None
+    # The batch the file was uploaded with, when it was uploaded with others
+    batch_id: int | None = Field(default=None, foreign_key="importbatch.id", index=True)
+    # The default_factory is called when each object is created, rather than the
+    # default which would be evaluated only once when the class is created.
+    created: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class CourseLevel(SQLModel, table=True):
+    """The number of points at each level of detail of a course.
+
+    Points are kept at a level when they are further than the tolerance in
+    metres from the simplified track.
+
+    """
+
+    course_id: int = Field(foreign_key="course.id", primary_key=True)
+    level: int = Field(primary_key=True)
+    tolerance: float
+    n_points: int
+
+
+# The spatial index of the points, an SQLite R-tree holding the bounding box of
+# each segment of consecutive points of a course, see python_demo.spatial. The
+# columns prefixed with + are stored alongside each box without being indexed.
+POINT_INDEX_DDL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS point_index USING rtree(
+    id, min_lat, max_lat, min_lon, max_lon, +course_id, +start_time, +end_time
+)
+"""
+
+
+def has_point_index(bind) -> bool:
+    """Whether the database has the spatial index, which only SQLite provides."""
+    return bind.dialect.name == "sqlite"
+
+
+# The index as a table of SQLAlchemy, for querying it. This has metadata of its
+# own, keeping it out of the tables created with the models.
+point_index = Table(
+    "point_index",
+    MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("min_lat", Float),
+    Column("max_lat", Float),
+    Column("min_lon", Float),
+    Column("max_lon", Float),
+    Column("course_id", Integer),
+    # The time of the first and last point within the segment
+    Column("start_time", DateTime),
+    Column("end_time", DateTime),
+)
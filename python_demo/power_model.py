@@ -0,0 +1,170 @@
+"""The model predicting the power of a rider from their speed and the gradient.
+
+The model is a linear regression, so everything needed to make a prediction is
+a handful of floats. Rather than pickling the object, which ties the stored
+model to the versions of the libraries and runs the unpickler on every load,
+the model is stored as a small dictionary of its parameters, see to_dict.
+
+This only depends on numpy, so making a prediction doesn't need to import
+pandas or scikit-learn. The models of the users held in memory are also kept
+here, so the server is able to use them before those have been imported.
+
+"""
+
+import numpy as np
+
+from .cache import LRUCache
+
+# The features the model uses to predict the power, in order
+FEATURES = ["speed_kmh", "gradient"]
+
+# Incremented whenever the format of to_dict changes, so a model stored in an
+# older format is recognised rather than misread.
+SCHEMA_VERSION = 1
+
+
+class UntrainedModel(ValueError):
+    """The model has no samples to predict from, as the user has no courses."""
+
+
+class PowerModel:
+    """A linear regression which can be updated one course at a time.
+
+    Rather than keeping all the points used to train the model, this keeps the
+    sufficient statistics of the features and target: the number of samples,
+    their means and the sums of the products of their deviations from the mean.
+    Statistics from a new batch of samples are merged with the existing ones,
+    giving the same coefficients as fitting all the samples at once, without
+    needing any of the previous samples.
+
+    The interface follows scikit-learn, so this can be used in the same way as
+    the LinearRegression it replaces.
+
+    """
+
+    # The coefficients are found from the statistics when first needed. This is
+    # also the value for models pickled before the coefficients were kept.
+    _coef: np.ndarray | None = None
+
+    def __init__(self):
+        n_columns = len(FEATURES) + 1
+        self.n_samples = 0
+        # The features are followed by the target within the means and the
+        # co-moment matrix.
+        self.mean = np.zeros(n_columns)
+        self.comoment = np.zeros((n_columns, n_columns))
+
+    def partial_fit(self, X, y) -> "PowerModel":
+        """Update the model with an additional batch of samples."""
+        data = np.column_stack([np.asarray(X, dtype=np.float64), y])
+        if len(data) == 0:
+            return self
+
+        batch = PowerModel()
+        batch.n_samples = len(data)
+        batch.mean = data.mean(axis=0)
+        deviation = data - batch.mean
+        batch.comoment = deviation.T @ deviation
+        return self.merge(batch)
+
+    def merge(self, other: "PowerModel") -> "PowerModel":
+        """Update the model with the samples used to train another model.
+
+        This combines the statistics of the two sets of samples, using the
+        approach of Chan et al. which remains accurate however large the means.
+
+        """
+        n_total = self.n_samples + other.n_samples
+        if n_total == 0:
+            return self
+
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n_samples / n_total
+        self.comoment = (
+            self.comoment
+            + other.comoment
+            + np.outer(delta, delta) * self.n_samples * other.n_samples / n_total
+        )
+        self.n_samples = n_total
+        self._coef = None
+        return self
+
+    @property
+    def coef_(self) -> np.ndarray:
+        if self._coef is None:
+            # Least squares rather than solve handles the case where the
+            # features are collinear, like when a rider has only ever been on
+            # the flat.
+            self._coef, *_ = np.linalg.lstsq(
+                self.comoment[:-1, :-1], self.comoment[:-1, -1], rcond=None
+            )
+        return self._coef
+
+    @property
+    def intercept_(self) -> float:
+        return self.mean[-1] - self.mean[:-1] @ self.coef_
+
+    def predict(self, X) -> np.ndarray:
+        """The predicted power for each row of the features.
+
+        Any samples with missing features have a prediction of NaN. A model
+        without any samples has nothing to predict from, so raises
+        UntrainedModel rather than predicting 0 W.
+
+        """
+        if self.n_samples == 0:
+            raise UntrainedModel("Upload a course before predicting the power.")
+        return np.asarray(X, dtype=np.float64) @ self.coef_ + self.intercept_
+
+    def to_dict(self) -> dict:
+        """The parameters of the model, which can be stored as JSON.
+
+        Along with the coefficients used for predictions, the statistics of the
+        training samples are included so the model can continue to be updated.
+
+        """
+        return {
+            "version": SCHEMA_VERSION,
+            "type": "linear",
+            "features": FEATURES,
+            "coef": self.coef_.tolist(),
+            "intercept": float(self.intercept_),
+            "n_samples": self.n_samples,
+            "mean": self.mean.tolist(),
+            "comoment": self.comoment.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, params: dict) -> "PowerModel":
+        """Create the model from the parameters returned by to_dict."""
+        if params.get("version") != SCHEMA_VERSION or params.get("type") != "linear":
+            raise ValueError(
+                f"Unsupported model {params.get('type')} "
+                f"version {params.get('version')}"
+            )
+        if params["features"] != FEATURES:
+            raise ValueError(f"The model has different features {params['features']}")
+
+        model = cls()
+        model.n_samples = params["n_samples"]
+        model.mean = np.array(params["mean"], dtype=np.float64)
+        model.comoment = np.array(params["comoment"], dtype=np.float64)
+        # The stored coefficients are used directly rather than solving again
+        model._coef = np.array(params["coef"], dtype=np.float64)
+        return model
+
+
+# The deserialised models of the most active users are kept in memory, saving
+# both the query and decoding of the model for each prediction. The time to
+# live bounds how long a process can use a model which has been updated by
+# another process.
+MODEL_CACHE_SIZE = 1024
+MODEL_CACHE_TTL = 300
+model_cache: LRUCache[int, PowerModel] = LRUCache(
+    maxsize=MODEL_CACHE_SIZE, ttl=MODEL_CACHE_TTL
+)
+
+
+def invalidate_user_model(user_id: int) -> None:
+    """Ensure the next use of the model of the user reads it from the database."""
+    model_cache.invalidate(user_id)
@@ -0,0 +1,190 @@
+"""Simplified tracks of a course at a range of levels of detail.
+
+A course recorded every second has many more points than can be shown on a
+chart, so each point is given the coarsest level of detail at which it is still
+needed to draw the track. Reading the points of a course at a level then only
+returns the points with a detail at least that level.
+
+The levels come from the Douglas-Peucker algorithm, which keeps the point
+furthest from the line between the ends of a section of the track, splitting
+the section in two at that point until every point is within a tolerance of the
+line. Rather than running the algorithm once for every tolerance, each point is
+given the distance at which it was chosen, limited to the distance of the point
+which split the section it is within. A point is then kept at a tolerance when
+this distance is greater than the tolerance, giving the same points as running
+the algorithm with that tolerance.
+
+"""
+
+import numpy as np
+from sqlmodel import Session, bindparam, delete, update
+
+from . import storage
+from .geometry import EARTH_RADIUS
+from .metrics import timed
+from .models import CourseLevel, CoursePoints
+
+# The tolerance in metres of each level of detail above 0, where level 0
+# contains every point.
+LEVEL_TOLERANCES = [2.0, 8.0, 32.0, 128.0]
+
+
+def _planar(lat: np.ndarray, lon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Project the positions onto a plane in metres, centred on the course.
+
+    Over the extent of a single course the distortion of this projection is
+    well below the tolerances we are simplifying to.
+
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    x = EARTH_RADIUS * (lon - lon.mean()) * np.cos(lat.mean())
+    y = EARTH_RADIUS * (lat - lat.mean())
+    return x, y
+
+
+def significance(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """The tolerance in metres below which Douglas-Peucker keeps each point.
+
+    The end points are always kept, so have a significance of infinity. Rather
+    than recursing into each section separately, all the sections which need
+    splitting are processed together, using a single set of array operations
+    for each depth of the recursion.
+
+    """
+    n_points = len(lat)
+    result = np.zeros(n_points)
+    if n_points == 0:
+        return result
+    result[[0, -1]] = np.inf
+    x, y = _planar(np.asarray(lat, np.float64), np.asarray(lon, np.float64))
+
+    # The sections still to split, given by the index of the points at either
+    # end, along with the significance of the point which created them.
+    start = np.array([0])
+    end = np.array([n_points - 1])
+    limit = np.array([np.inf])
+
+    while len(start) > 0:
+        # Only sections with points between the ends need splitting
+        interior = end - start > 1
+        start, end, limit = start[interior], end[interior], limit[interior]
+        if len(start) == 0:
+            break
+
+        # The index of every point between the ends of each section, along with
+        # the section the point is within.
+        lengths = end - start - 1
+        section = np.repeat(np.arange(len(start)), lengths)
+        boundaries = np.cumsum(lengths) - lengths
+        offsets = np.arange(len(section)) - boundaries[section]
+        index = start[section] + 1 + offsets
+
+        # The distance from each point to the line segment between the ends
+        x0, y0 = x[start[section]], y[start[section]]
+        dx, dy = x[end[section]] - x0, y[end[section]] - y0
+        length_sq = dx**2 + dy**2
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = ((x[index] - x0) * dx + (y[index] - y0) * dy) / length_sq
+        # Where the ends are in the same place the distance is to that point.
+        t = np.clip(np.nan_to_num(t), 0, 1)
+        distance = np.hypot(x[index] - x0 - t * dx, y[index] - y0 - t * dy)
+
+        # The point furthest from the line within each section, taking the
+        # first where there are multiple at the same distance.
+        furthest = np.maximum.reduceat(distance, boundaries)
+        candidates = np.flatnonzero(distance == furthest[section])
+        _, first = np.unique(section[candidates], return_index=True)
+        split = index[candidates[first]]
+
+        chosen = np.minimum(furthest, limit)
+        result[split] = chosen
+        start, end, limit = (
+            np.concatenate([start, split]),
+            np.concatenate([split, end]),
+            np.concatenate([chosen, chosen]),
+        )
+
+    return result
+
+
+def detail_levels(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """The coarsest level of detail at which each point is kept."""
+    return np.searchsorted(LEVEL_TOLERANCES, significance(lat, lon), side="left")
+
+
+def detail_counts(detail: np.ndarray) -> np.ndarray:
+    """The number of points with each level as their coarsest level of detail."""
+    return np.bincount(detail, minlength=len(LEVEL_TOLERANCES) + 1)
+
+
+def course_levels(course_id: int, counts: np.ndarray) -> list[CourseLevel]:
+    """The levels of a course from the counts of the points at each level.
+
+    The number of points at each level lets the level to serve be chosen
+    without counting the points.
+
+    """
+    return [
+        CourseLevel(
+            course_id=course_id,
+            level=level,
+            tolerance=tolerance,
+            n_points=int(counts[level:].sum()),
+        )
+        for level, tolerance in enumerate([0.0, *LEVEL_TOLERANCES])
+    ]
+
+
+@timed("store_levels")
+def store_levels(session: Session, course_id: int) -> list[CourseLevel]:
+    """Calculate and store the level of detail of each point within a course.
+
+    New courses have the levels calculated as they are stored, a chunk at a
+    time, this is for the courses stored before then. Only the positions and
+    the current levels of the points are read, and only the points with a
+    different level are updated. For a course stored in blocks the levels are
+    stored as another field of the blocks.
+
+    """
+    # Reading the points uses pandas, which the server choosing a level
+    # doesn't need to import.
+    from .course import load_points
+
+    df = load_points(session, course_id, ["id", "lat", "lon", "detail"])
+    detail = detail_levels(df["lat"].to_numpy(), df["lon"].to_numpy())
+
+    changed = detail != df["detail"].to_numpy()
+    if storage.course_backend(session, course_id) == storage.BLOCKS:
+        storage.write_columns(session, course_id, {"detail": detail})
+    elif changed.any():
+        session.execute(
+            update(CoursePoints.__table__)
+            .where(CoursePoints.__table__.c.id == bindparam("point_id"))
+            .values(detail=bindparam("point_detail")),
+            [
+                {"point_id": point_id, "point_detail": level}
+                for point_id, level in zip(
+                    df["id"][changed].tolist(), detail[changed].tolist()
+                )
+            ],
+        )
+
+    levels = course_levels(course_id, detail_counts(detail))
+    session.execute(delete(CourseLevel).where(CourseLevel.course_id == course_id))
+    session.add_all(levels)
+    storage.touch_course(session, course_id)
+    session.commit()
+    return levels
+
+
+def choose_level(levels: list[CourseLevel], max_points: int) -> int:
+    """The most detailed level with at most max_points points.
+
+    When even the coarsest level has too many points that level is used.
+
+    """
+    for level in sorted(levels, key=lambda level: level.level):
+        if level.n_points <= max_points:
+            return level.level
+    return max((level.level for level in levels), default=0)
@@ -0,0 +1,350 @@
+"""Find the courses and points within an area, using a spatial index.
+
+Every course is indexed as it is stored, by the bounding box of each segment of
+SEGMENT_SIZE consecutive points, within an SQLite R-tree (the point_index
+table). A query then happens in two steps:
+ - the R-tree finds the segments of the courses of the user whose boxes
+   overlap the area, only visiting the parts of the tree near the area rather
+   than every course,
+ - the points of those segments are read, by the range of times covered by
+   each segment, and checked exactly against the area.
+Indexing segments rather than single points keeps the index a small fraction of
+the size of the points, with little cost to the queries since a segment only
+covers a few hundred metres.
+
+Courses stored before the index was added are indexed with
+
+    python -m python_demo.spatial
+
+Other databases don't have an R-tree, so courses are stored without being
+indexed and searching raises IndexUnavailable.
+
+This only depends on numpy, so the server doesn't need pandas to search.
+
+"""
+
+import argparse
+import math
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import and_, delete, insert, or_
+from sqlmodel import Session, select
+
+from . import storage
+from .database import create_db_engine
+from .geometry import EARTH_RADIUS, distance_to
+from .metrics import timed
+from .models import (
+    Course,
+    CoursePoints,
+    create_db_and_tables,
+    has_point_index,
+    point_index,
+)
+
+# The number of consecutive points within each segment of the index. At one
+# point a second this is half a minute of riding.
+SEGMENT_SIZE = 32
+
+# The time of a segment, as read from the index
+TimeRange = tuple[datetime, datetime]
+
+# Segments read from a course stored as rows are joined into ranges of time
+# when they are less than _MERGE_GAP apart, with at most _MAX_RANGES ranges.
+_MERGE_GAP = timedelta(seconds=SEGMENT_SIZE)
+_MAX_RANGES = 100
+
+
+class IndexUnavailable(Exception):
+    """The database has no spatial index, so it can't be searched by area."""
+
+
+class Box(NamedTuple):
+    """An area between two latitudes and two longitudes, in degrees."""
+
+    min_lat: float
+    max_lat: float
+    min_lon: float
+    max_lon: float
+
+    @classmethod
+    def around(cls, lat: float, lon: float, radius: float) -> "Box":
+        """The box containing every position within radius metres of a point."""
+        dlat = math.degrees(radius / EARTH_RADIUS)
+        # The degrees of longitude shrink towards the poles, the width is
+        # limited so the box never wraps around the earth.
+        dlon = min(dlat / max(math.cos(math.radians(lat)), 1e-6), 180)
+        return cls(lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+
+    def contains(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """Whether each of the points is within the box."""
+        return (
+            (lat >= self.min_lat)
+            & (lat <= self.max_lat)
+            & (lon >= self.min_lon)
+            & (lon <= self.max_lon)
+        )
+
+
+def index_points(
+    session: Session,
+    course_id: int,
+    time: np.ndarray,
+    lat: np.ndarray,
+    lon: np.ndarray,
+) -> int:
+    """Add consecutive points of a course to the index, by segment.
+
+    Points without a position or time can't be found, so segments without any
+    are left out. The number of segments added is returned.
+
+    """
+    starts = np.arange(0, len(lat), SEGMENT_SIZE)
+    if len(starts) == 0 or not has_point_index(session.get_bind()):
+        return 0
+    # The NaN and NaT values are ignored by fmin and fmax
+    boxes = {
+        "min_lat": np.fmin.reduceat(lat, starts),
+        "max_lat": np.fmax.reduceat(lat, starts),
+        "min_lon": np.fmin.reduceat(lon, starts),
+        "max_lon": np.fmax.reduceat(lon, starts),
+    }
+    times = {
+        "start_time": np.fmin.reduceat(time, starts),
+        "end_time": np.fmax.reduceat(time, starts),
+    }
+    valid = ~np.isnan(boxes["min_lat"]) & ~np.isnan(times["start_time"])
+    columns = {field: values[valid].tolist() for field, values in boxes.items()}
+    for field, values in times.items():
+        columns[field] = values[valid].astype("datetime64[us]").astype(object).tolist()
+
+    rows = [
+        {"course_id": course_id, **dict(zip(columns, values))}
+        for values in zip(*columns.values())
+    ]
+    if rows:
+        session.execute(insert(point_index), rows)
+    return len(rows)
+
+
+def _read_positions(session: Session, course_id: int) -> dict[str, np.ndarray]:
+    """The time and position of every point of a course."""
+    fields = ["time", "lat", "lon"]
+    if storage.course_backend(session, course_id) == storage.BLOCKS:
+        return storage.read_blocks(session, course_id, fields)
+    rows = session.exec(
+        select(CoursePoints.time, CoursePoints.lat, CoursePoints.lon)
+        .where(CoursePoints.course_id == course_id)
+        .order_by(CoursePoints.time)
+    ).all()
+    return _to_arrays(rows)
+
+
+def _to_arrays(rows: list[tuple]) -> dict[str, np.ndarray]:
+    time, lat, lon = list(zip(*rows)) or ([], [], [])
+    return {
+        "time": np.array(time, dtype="datetime64[us]"),
+        "lat": np.array(lat, dtype=np.float64),
+        "lon": np.array(lon, dtype=np.float64),
+    }
+
+
+def remove_course(session: Session, course_id: int) -> None:
+    """Remove the entries of a course from the index."""
+    if has_point_index(session.get_bind()):
+        session.execute(
+            delete(point_index).where(point_index.c.course_id == course_id)
+        )
+
+
+def index_course(session: Session, course_id: int) -> int:
+    """Replace the entries of a course within the index from its points."""
+    remove_course(session, course_id)
+    positions = _read_positions(session, course_id)
+    n_segments = 0
+    # Indexed in the same chunks as the points are stored
+    for first in range(0, len(positions["time"]), storage.BLOCK_SIZE):
+        chunk = slice(first, first + storage.BLOCK_SIZE)
+        n_segments += index_points(
+            session,
+            course_id,
+            positions["time"][chunk],
+            positions["lat"][chunk],
+            positions["lon"][chunk],
+        )
+    session.commit()
+    return n_segments
+
+
+def _overlapping(
+    session: Session, user_id: int, box: Box
+) -> dict[int, list[TimeRange]]:
+    """The time of the indexed segments overlapping the box, by course."""
+    if not has_point_index(session.get_bind()):
+        raise IndexUnavailable(
+            f"Searching by area needs the spatial index of an SQLite database, "
+            f"not {session.get_bind().dialect.name}"
+        )
+    rows = session.execute(
+        select(
+            point_index.c.course_id, point_index.c.start_time, point_index.c.end_time
+        )
+        .join(Course, Course.id == point_index.c.course_id)
+        .where(
+            Course.user_id == user_id,
+            point_index.c.min_lat <= box.max_lat,
+            point_index.c.max_lat >= box.min_lat,
+            point_index.c.min_lon <= box.max_lon,
+            point_index.c.max_lon >= box.min_lon,
+        )
+    )
+    segments = defaultdict(list)
+    for course_id, start_time, end_time in rows:
+        segments[course_id].append((start_time, end_time))
+    return segments
+
+
+def _merge(segments: list[TimeRange]) -> list[TimeRange]:
+    """Join the segments following one another into longer ranges of time.
+
+    Consecutive segments of a course are only a sample apart, so a course
+    crossing the area once becomes a single range to read. There is a limit on
+    the size of the statement, so a course crossing the area many times is
+    read as a single range from its first to last segment.
+
+    """
+    ranges = []
+    for start, end in sorted(segments):
+        if ranges and start - ranges[-1][1] <= _MERGE_GAP:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            ranges.append((start, end))
+    if len(ranges) > _MAX_RANGES:
+        return [(ranges[0][0], max(end for _, end in ranges))]
+    return ranges
+
+
+def _read_segments(
+    session: Session, course_id: int, segments: list[TimeRange]
+) -> dict[str, np.ndarray]:
+    """The time and position of the points within segments of a course.
+
+    A course stored as rows has only the points of the segments read, using
+    the index on the time of the points. A course stored in blocks has all the
+    positions decoded, which is cheaper than reading a row for each point.
+
+    """
+    if storage.course_backend(session, course_id) == storage.BLOCKS:
+        positions = storage.read_blocks(session, course_id, ["time", "lat", "lon"])
+    else:
+        ranges = _merge(segments)
+        positions = _to_arrays(
+            session.exec(
+                select(CoursePoints.time, CoursePoints.lat, CoursePoints.lon).where(
+                    CoursePoints.course_id == course_id,
+                    or_(
+                        *(
+                            and_(CoursePoints.time >= start, CoursePoints.time <= end)
+                            for start, end in ranges
+                        )
+                    ),
+                )
+            ).all()
+        )
+
+    time = positions["time"]
+    within = np.zeros(len(time), dtype=bool)
+    for start, end in segments:
+        within |= (time >= np.datetime64(start)) & (time <= np.datetime64(end))
+    return {field: values[within] for field, values in positions.items()}
+
+
+@timed("courses_in_box")
+def courses_in_box(session: Session, user_id: int, box: Box) -> list[Course]:
+    """The courses of the user with any point within the box, latest first."""
+    course_ids = []
+    for course_id, segments in _overlapping(session, user_id, box).items():
+        points = _read_segments(session, course_id, segments)
+        if box.contains(points["lat"], points["lon"]).any():
+            course_ids.append(course_id)
+    return session.exec(
+        select(Course)
+        .where(Course.id.in_(course_ids))
+        .order_by(Course.start_time.desc())
+    ).all()
+
+
+@timed("points_near")
+def points_near(
+    session: Session,
+    user_id: int,
+    lat: float,
+    lon: float,
+    radius: float,
+    limit: int = 100,
+) -> list[dict]:
+    """The points of the courses of the user within radius metres of a position.
+
+    These are the nearest points first, with at most limit points.
+
+    """
+    found = []
+    for course_id, segments in _overlapping(
+        session, user_id, Box.around(lat, lon, radius)
+    ).items():
+        points = _read_segments(session, course_id, segments)
+        distance = distance_to(lat, lon, points["lat"], points["lon"])
+        near = distance <= radius
+        found.extend(
+            zip(
+                distance[near].tolist(),
+                [course_id] * int(near.sum()),
+                points["time"][near].astype(object).tolist(),
+                points["lat"][near].tolist(),
+                points["lon"][near].tolist(),
+            )
+        )
+
+    found.sort(key=lambda point: point[0])
+    return [
+        {
+            "course_id": course_id,
+            "time": time.isoformat(),
+            "lat": point_lat,
+            "lon": point_lon,
+            "distance": distance,
+        }
+        for distance, course_id, time, point_lat, point_lon in found[:limit]
+    ]
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m python_demo.spatial",
+        description="Build the spatial index of the points of every course.",
+    )
+    parser.add_argument(
+        "--database",
+        default=os.getenv("DATABASE_URL", "sqlite:///database.db"),
+        help="The url of the database, by default from DATABASE_URL.",
+    )
+    args = parser.parse_args(argv)
+
+    engine = create_db_engine(args.database)
+    if not has_point_index(engine):
+        parser.error("The spatial index is only available with SQLite databases.")
+    create_db_and_tables(engine)
+    with Session(engine) as session:
+        course_ids = session.exec(select(Course.id).order_by(Course.id)).all()
+        for course_id in course_ids:
+            # Each course is indexed within its own transaction
+            n_segments = index_course(session, course_id)
+            print(f"indexed course {course_id} as {n_segments} segments")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+"""Store the points of a course as compressed blocks of columns.
+
+Storing every point as a row of CoursePoints repeats the id of the point and of
+the course with every sample, and a year of activities becomes millions of
+rows. The blocks backend instead keeps a few PointBlock rows for each field of
+a course, each holding the values of up to BLOCK_SIZE consecutive points as a
+compressed array:
+ - the times in microseconds, as the difference from the previous point which
+   is nearly always the same,
+ - the positions as integer semicircles, the units of positions within FIT
+   files, again as the difference from the previous point,
+ - the recorded metrics as 32 bit floats, and the derived values as 64 bit
+   floats as the cumulative distance needs the precision.
+Reading a course then reads a handful of blobs in order, decoding each field
+with a few numpy operations rather than converting every value of every row.
+
+The backend used for new courses is chosen with the POINT_STORAGE environment
+variable, either rows (the default) or blocks. The backend of each course is
+recorded on the Course, so courses of both can be read. Existing courses are
+moved between backends with
+
+    python -m python_demo.storage --to blocks
+
+which also adds any columns missing from the tables of an older database.
+
+This only depends on numpy, so the server is able to stream the points of a
+course without importing pandas.
+
+"""
+
+import argparse
+import itertools
+import os
+import zlib
+from collections.abc import Iterator
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import delete, func, update
+from sqlmodel import Session, select
+
+from .database import create_db_engine
+from .models import (
+    DERIVED_FIELDS,
+    Course,
+    CoursePoints,
+    PointBlock,
+    add_missing_columns,
+    create_db_and_tables,
+)
+
+ROWS = "rows"
+BLOCKS = "blocks"
+BACKENDS = [ROWS, BLOCKS]
+
+# The number of points within each block, this matches the number of points
+# decoded from a FIT file at a time so each chunk is written as a block.
+BLOCK_SIZE = 5000
+
+# Compressing the blocks quickly gets most of the reduction in size, the
+# differences of the times and positions being mostly zero bytes.
+COMPRESSION_LEVEL = 1
+
+# The number of semicircles in a degree, the fixed point units of positions
+# within FIT files. Positions decoded from a FIT file are then stored exactly,
+# while any others are within a centimetre.
+FIXED_SCALE = 2**31 / 180
+# The fixed point value of a missing position
+_MISSING_FIXED = np.iinfo(np.int64).min
+
+# How the values of each field are encoded, along with the type of the array
+# holding the encoded values.
+CODECS = {
+    "time": ("delta", np.int64),
+    "lat": ("fixed", np.int64),
+    "lon": ("fixed", np.int64),
+    "power": ("plain", np.float32),
+    "speed": ("plain", np.float32),
+    "heart_rate": ("plain", np.float32),
+    "altitude": ("plain", np.float32),
+    "detail": ("plain", np.int8),
+    **{field: ("plain", np.float64) for field in DERIVED_FIELDS},
+}
+STORED_FIELDS = list(CODECS)
+
+# The fields with integer values, the others are floats or the time
+INTEGER_FIELDS = {"id", "course_id", "heart_rate", "altitude", "detail"}
+
+
+def default_backend() -> str:
+    """The backend new courses are stored with."""
+    backend = os.getenv("POINT_STORAGE", ROWS)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown point storage {backend}")
+    return backend
+
+
+def course_backend(session: Session, course_id: int) -> str:
+    """The backend the points of the course are stored with."""
+    course = session.get(Course, course_id)
+    return course.storage if course is not None else ROWS
+
+
+def touch_course(session: Session, course_id: int) -> None:
+    """Record that the points of the course have changed, see Course.version."""
+    session.execute(
+        update(Course)
+        .where(Course.id == course_id)
+        .values(version=Course.version + 1, modified=datetime.now(timezone.utc))
+    )
+
+
+def nullable_list(values: np.ndarray, dtype: type = float) -> list:
+    """Convert an array to python values, with NaN becoming None."""
+    missing = np.isnan(values)
+    converted = np.where(missing, 0, values).astype(dtype).astype(object)
+    converted[missing] = None
+    return converted.tolist()
+
+
+def encode(field: str, values: np.ndarray) -> bytes:
+    """Compress the values of the field of consecutive points."""
+    codec, dtype = CODECS[field]
+    if codec == "delta":
+        encoded = values.astype("datetime64[us]").view(np.int64)
+    elif codec == "fixed":
+        encoded = np.full(len(values), _MISSING_FIXED, dtype=np.int64)
+        present = ~np.isnan(values)
+        encoded[present] = np.round(values[present] * FIXED_SCALE)
+    elif field in INTEGER_FIELDS:
+        # Truncated the same as storing the value within the integer column of
+        # CoursePoints, while the float keeps the missing values.
+        encoded = np.trunc(values).astype(dtype)
+    else:
+        encoded = values.astype(dtype)
+    if codec in ("delta", "fixed"):
+        # The integers wrap around rather than overflow, so even the missing
+        # values are recovered exactly by the cumulative sum.
+        encoded = np.diff(encoded, prepend=np.int64(0))
+    return zlib.compress(encoded.tobytes(), COMPRESSION_LEVEL)
+
+
+def decode(field: str, data: bytes) -> np.ndarray:
+    """The values of the field from a block compressed by encode."""
+    codec, dtype = CODECS[field]
+    values = np.frombuffer(zlib.decompress(data), dtype=dtype)
+    if codec == "delta":
+        return np.cumsum(values).view("datetime64[us]")
+    if codec == "fixed":
+        fixed = np.cumsum(values)
+        degrees = fixed / FIXED_SCALE
+        degrees[fixed == _MISSING_FIXED] = np.nan
+        return degrees
+    if dtype == np.float32:
+        return values.astype(np.float64)
+    # The other types are used as they are, without copying the values
+    return values
+
+
+def _missing(field: str, n_points: int) -> np.ndarray:
+    """The values of a field which hasn't been stored."""
+    if field == "detail":
+        return np.zeros(n_points, dtype=np.int8)
+    return np.full(n_points, np.nan)
+
+
+def write_blocks(
+    session: Session, course_id: int, columns: dict[str, np.ndarray], first: int = 0
+) -> int:
+    """Store the fields of consecutive points as blocks, starting from first.
+
+    Returns the number of blocks written.
+
+    """
+    n_points = len(next(iter(columns.values())))
+    starts = range(0, n_points, BLOCK_SIZE)
+    session.execute(
+        PointBlock.__table__.insert(),
+        [
+            {
+                "course_id": course_id,
+                "field": field,
+                "block": first + index,
+                "n_points": len(values[start : start + BLOCK_SIZE]),
+                "data": encode(field, values[start : start + BLOCK_SIZE]),
+            }
+            for field, values in columns.items()
+            for index, start in enumerate(starts)
+        ],
+    )
+    return len(starts)
+
+
+def write_columns(
+    session: Session, course_id: int, columns: dict[str, np.ndarray]
+) -> None:
+    """Replace the values of fields of every point of a course in blocks.
+
+    The values are split at the same points as the blocks of times, so all the
+    fields of a block belong to the same points.
+
+    """
+    sizes = session.exec(
+        select(PointBlock.n_points)
+        .where(PointBlock.course_id == course_id, PointBlock.field == "time")
+        .order_by(PointBlock.block)
+    ).all()
+    starts = np.cumsum([0, *sizes])
+    session.execute(
+        delete(PointBlock).where(
+            PointBlock.course_id == course_id, PointBlock.field.in_(list(columns))
+        )
+    )
+    if not sizes:
+        return
+    session.execute(
+        PointBlock.__table__.insert(),
+        [
+            {
+                "course_id": course_id,
+                "field": field,
+                "block": index,
+                "n_points": size,
+                "data": encode(field, values[start : start + size]),
+            }
+            for field, values in columns.items()
+            for index, (start, size) in enumerate(zip(starts, sizes))
+        ],
+    )
+
+
+def has_field(session: Session, course_id: int, field: str) -> bool:
+    """Whether the values of the field are stored in blocks for the course."""
+    return session.get(PointBlock, (course_id, field, 0)) is not None
+
+
+def _with_generated(
+    columns: dict[str, np.ndarray], fields: list[str], course_id: int, first: int
+) -> dict[str, np.ndarray]:
+    """Add the fields which aren't stored, in the order of fields.
+
+    The id of a point stored in blocks is its position within the course.
+
+    """
+    n_points = len(columns["time"])
+    generated = {
+        "id": np.arange(first, first + n_points),
+        "course_id": np.full(n_points, course_id),
+    }
+    return {
+        field: generated[field]
+        if field in generated
+        else columns.get(field, _missing(field, n_points))
+        for field in fields
+    }
+
+
+def _stored(fields: list[str], level: int) -> list[str]:
+    """The stored fields needed to read the fields at the level of detail."""
+    needed = {"time", *fields} | ({"detail"} if level > 0 else set())
+    return [field for field in STORED_FIELDS if field in needed]
+
+
+def iter_blocks(
+    session: Session, course_id: int, fields: list[str], level: int = 0
+) -> Iterator[dict[str, np.ndarray]]:
+    """Read the fields of the points in blocks, one block at a time.
+
+    Only the points kept at the level of detail are included, where level 0 is
+    every point.
+
+    """
+    result = session.execute(
+        select(PointBlock.block, PointBlock.field, PointBlock.data)
+        .where(
+            PointBlock.course_id == course_id,
+            PointBlock.field.in_(_stored(fields, level)),
+        )
+        .order_by(PointBlock.block),
+        # Without yield_per the session fetches every row before returning any,
+        # holding the whole course in memory. This fetches the rows of about a
+        # block at a time.
+        execution_options={"yield_per": len(CODECS)},
+    )
+    first = 0
+    for _, rows in itertools.groupby(result, key=lambda row: row.block):
+        stored = {row.field: decode(row.field, row.data) for row in rows}
+        columns = _with_generated(stored, fields, course_id, first)
+        first += len(stored["time"])
+        if level > 0:
+            kept = stored.get("detail", _missing("detail", len(stored["time"])))
+            kept = kept >= level
+            columns = {field: values[kept] for field, values in columns.items()}
+        yield columns
+
+
+def read_blocks(
+    session: Session, course_id: int, fields: list[str], level: int = 0
+) -> dict[str, np.ndarray]:
+    """Read the fields of all the points of a course stored in blocks."""
+    blocks = list(iter_blocks(session, course_id, fields, level))
+    if not blocks:
+        return {field: _missing(field, 0) for field in fields}
+    return {
+        field: np.concatenate([block[field] for block in blocks]) for field in fields
+    }
+
+
+def to_rows(columns: dict[str, np.ndarray]) -> list[tuple]:
+    """Convert the columns to a tuple of python values for each point."""
+    converted = []
+    for field, values in columns.items():
+        if field == "time":
+            converted.append(values.astype("datetime64[us]").astype(object).tolist())
+        elif field in INTEGER_FIELDS:
+            converted.append(nullable_list(values, int))
+        else:
+            converted.append(nullable_list(values))
+    return list(zip(*converted))
+
+
+def _read_rows(session: Session, course_id: int) -> dict[str, np.ndarray]:
+    """Read all the stored fields of the points of a course stored as rows."""
+    rows = session.exec(
+        select(*[getattr(CoursePoints, field) for field in STORED_FIELDS])
+        .where(CoursePoints.course_id == course_id)
+        .order_by(CoursePoints.time)
+    ).all()
+    values = list(zip(*rows)) or [[] for _ in STORED_FIELDS]
+    return {
+        field: np.array(column, dtype="datetime64[us]" if field == "time" else float)
+        for field, column in zip(STORED_FIELDS, values)
+    }
+
+
+def move_course(session: Session, course: Course, backend: str) -> None:
+    """Move the points of the course to the backend."""
+    if course.storage == backend:
+        return
+
+    if backend == BLOCKS:
+        columns = _read_rows(session, course.id)
+        # Fields without any values, like the derived values of a course from
+        # before these were stored, are left out as they would be missing.
+        columns = {
+            field: values
+            for field, values in columns.items()
+            if field == "time" or not np.isnan(values).all()
+        }
+        if len(columns["time"]) > 0:
+            write_blocks(session, course.id, columns)
+        session.execute(delete(CoursePoints).where(CoursePoints.course_id == course.id))
+    else:
+        rows = to_rows(read_blocks(session, course.id, STORED_FIELDS))
+        if rows:
+            session.execute(
+                CoursePoints.__table__.insert(),
+                [
+                    {"course_id": course.id, **dict(zip(STORED_FIELDS, row))}
+                    for row in rows
+                ],
+            )
+        session.execute(delete(PointBlock).where(PointBlock.course_id == course.id))
+
+    # The values read back can differ slightly, such as the speeds kept as 32
+    # bit floats, so any cached responses for the course are out of date.
+    touch_course(session, course.id)
+    course.storage = backend
+    session.add(course)
+    session.commit()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m python_demo.storage",
+        description="Move the points of the courses to another storage backend.",
+    )
+    parser.add_argument("--to", choices=BACKENDS, required=True)
+    parser.add_argument(
+        "--database",
+        default=os.getenv("DATABASE_URL", "sqlite:///database.db"),
+        help="The url of the database, by default from DATABASE_URL.",
+    )
+    parser.add_argument(
+        "--vacuum",
+        action="store_true",
+        help="Rebuild the database afterwards, returning the space freed.",
+    )
+    args = parser.parse_args(argv)
+
+    engine = create_db_engine(args.database)
+    create_db_and_tables(engine)
+    for column in add_missing_columns(engine):
+        print(f"added column {column}")
+
+    with Session(engine) as session:
+        course_ids = session.exec(
+            select(Course.id).where(Course.storage != args.to).order_by(Course.id)
+        ).all()
+        for course_id in course_ids:
+            course = session.get(Course, course_id)
+            # Each course is moved within its own transaction, so the tool can
+            # be stopped and run again at any point.
+            move_course(session, course, args.to)
+            print(f"moved course {course_id} ({course.n_points} points) to {args.to}")
+
+        blocks = session.exec(select(func.count()).select_from(PointBlock)).one()
+        rows = session.exec(select(func.count()).select_from(CoursePoints)).one()
+    print(f"{rows} point rows and {blocks} point blocks")
+
+    if args.vacuum:
+        with engine.connect() as connection:
+            connection.exec_driver_sql("VACUUM")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import asyncio
+import threading
+
+import pytest
+from passlib.hash import argon2
+
+from python_demo import authentication
+
+# Cheap settings so the tests run quickly
+FAST = argon2.using(time_cost=1, memory_cost=1024, parallelism=1)
+
+
+@pytest.fixture(autouse=True)
+def fast_hasher(monkeypatch):
+    monkeypatch.setattr(authentication, "hasher", FAST)
+
+
+def test_hash_and_verify():
+    hashed = asyncio.run(authentication.hash_password("secret"))
+
+    assert asyncio.run(authentication.verify_and_update("secret", hashed)) == (
+        True,
+        None,
+    )
+    assert asyncio.run(authentication.verify_and_update("wrong", hashed)) == (
+        False,
+        None,
+    )
+
+
+def test_rehash_on_changed_settings(monkeypatch):
+    hashed = authentication.get_password_hash("secret")
+    monkeypatch.setattr(authentication, "hasher", FAST.using(time_cost=2))
+
+    valid, new_hash = asyncio.run(authentication.verify_and_update("secret", hashed))
+    assert valid
+    assert new_hash is not None
+    assert "t=2" in new_hash
+    assert authentication.verify_password("secret", new_hash)
+    assert not authentication.needs_rehash(new_hash)
+
+
+def test_busy(monkeypatch):
+    monkeypatch.setattr(authentication, "_slots", threading.BoundedSemaphore(1))
+    authentication._slots.acquire()
+    rejected = authentication.HASH_REJECTED.value()
+
+    with pytest.raises(authentication.HashingBusy):
+        asyncio.run(authentication.hash_password("secret"))
+    assert authentication.HASH_REJECTED.value() == rejected + 1
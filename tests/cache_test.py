@@ -0,0 +1,60 @@
+from python_demo.cache import LRUCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lru_eviction():
+    cache: LRUCache[str, int] = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Using a makes b the least recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "hits": 3, "misses": 1, "evictions": 1}
+
+
+def test_ttl_expiry():
+    timer = FakeTimer()
+    cache: LRUCache[str, int] = LRUCache(ttl=10, timer=timer)
+    cache.set("a", 1)
+    timer.now = 5
+    assert cache.get("a") == 1
+    timer.now = 11
+    assert cache.get("a") is None
+    assert cache.evictions == 1
+
+
+def test_invalidate():
+    cache: LRUCache[str, int] = LRUCache()
+    cache.set("a", 1)
+    cache.invalidate("a")
+    cache.invalidate("missing")
+    assert cache.get("a") is None
+
+
+def test_maxbytes():
+    cache: LRUCache[str, bytes] = LRUCache(maxbytes=10)
+    cache.set("a", b"12345")
+    cache.set("b", b"1234")
+    # Too large to be cached at all
+    cache.set("c", b"12345678901")
+    assert cache.get("c") is None
+    assert cache.nbytes == 9
+
+    cache.set("d", b"12")
+    assert cache.get("a") is None
+    assert cache.get("b") == b"1234"
+    assert cache.nbytes == 6
+
+    cache.set("b", b"1")
+    assert cache.nbytes == 3
@@ -1,4 +1,43 @@
+import fitdecode
+import numpy as np
+import pandas as pd
+import pytest
+from sqlmodel import Session, create_engine, select
+
 from python_demo import course
+from python_demo.geometry import step_distance
+from python_demo.models import (
+    Course,
+    CoursePoints,
+    add_missing_columns,
+    create_db_and_tables,
+)
+
+
+def _reference_points(file) -> pd.DataFrame:
+    """Read the points one frame at a time using the default data processor."""
+    data_points = []
+    lap_no = 1
+    with fitdecode.FitReader(file) as fit_file:
+        for frame in fit_file:
+            if not isinstance(frame, fitdecode.records.FitDataMessage):
+                continue
+            if frame.name == "lap":
+                lap_no += 1
+            elif frame.name == "record" and frame.get_value(
+                "position_lat", fallback=None
+            ) is not None:
+                point = {
+                    field: frame.get_value(field)
+                    for field in course.colnames_points[3:]
+                    if frame.has_field(field)
+                }
+                point["latitude"] = frame.get_value("position_lat") / (2**32 / 360)
+                point["longitude"] = frame.get_value("position_long") / (2**32 / 360)
+                point["lap"] = lap_no
+                data_points.append(point)
+
+    return pd.DataFrame(data_points, columns=course.colnames_points)
 
 
 def test_decode():
@@ -6,3 +45,106 @@ def test_decode():
     points = course.decode_fit(file)
 
     assert isinstance(points, list)
+
+
+def test_columns_match_reference():
+    file = "tests/activity.fit"
+    columns = course.fit_to_columns(file)
+    reference = _reference_points(file)
+
+    assert list(columns) == course.colnames_points
+    assert all(len(values) == len(reference) for values in columns.values())
+    pd.testing.assert_frame_equal(course.fit_to_dataframes(file), reference)
+
+
+def test_decode_matches_columns():
+    file = "tests/activity.fit"
+    columns = course.fit_to_columns(file)
+    points = course.decode_fit(file)
+
+    assert len(points) == len(columns["latitude"])
+    assert np.array_equal([p.lat for p in points], columns["latitude"])
+    assert points[0].time == pd.Timestamp(columns["timestamp"][0]).tz_localize("UTC")
+
+
+def test_store_course_matches_orm():
+    file = "tests/activity.fit"
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+
+    with Session(engine) as session:
+        orm_course = Course(name="orm", points=course.decode_fit(file))
+        session.add(orm_course)
+        session.commit()
+
+        bulk_course = course.store_course(
+            session, course.iter_fit_columns(file), user_id=None, name="bulk"
+        )
+
+        fields = ["lat", "lon", "time", "power", "speed", "heart_rate", "altitude"]
+        rows = {
+            course_id: session.exec(
+                select(*[getattr(CoursePoints, f) for f in fields])
+                .where(CoursePoints.course_id == course_id)
+                .order_by(CoursePoints.time)
+            ).all()
+            for course_id in (orm_course.id, bulk_course.id)
+        }
+
+    assert len(rows[bulk_course.id]) == len(rows[orm_course.id])
+    assert rows[bulk_course.id] == rows[orm_course.id]
+
+
+def test_store_course_summary():
+    file = "tests/activity.fit"
+    columns = course.fit_to_columns(file)
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+
+    with Session(engine) as session:
+        # Using small chunks checks the distance between chunks is included
+        chunks = course.iter_fit_columns(file, chunk_size=1000)
+        stored = course.store_course(session, chunks, user_id=None, name="a")
+
+    distance = step_distance(columns["latitude"], columns["longitude"])
+    assert stored.n_points == len(columns["latitude"])
+    assert stored.distance == pytest.approx(np.nansum(distance))
+    assert stored.date == pd.Timestamp(columns["timestamp"][0]).date()
+    assert stored.duration == (
+        columns["timestamp"][-1] - columns["timestamp"][0]
+    ) / np.timedelta64(1, "s")
+    assert stored.min_lat == columns["latitude"].min()
+    assert stored.max_lon == columns["longitude"].max()
+
+
+def test_summary_backfilled():
+    file = "tests/activity.fit"
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+
+    with Session(engine) as session:
+        # Courses stored before the summary was kept have none of the values
+        orm_course = Course(name="orm", points=course.decode_fit(file))
+        session.add(orm_course)
+        session.commit()
+        assert orm_course.start_time is None
+        assert orm_course.n_points == 0
+
+        stored = course.store_course(
+            session, course.iter_fit_columns(file), user_id=None, name="bulk"
+        )
+
+        add_missing_columns(engine)
+        session.refresh(orm_course)
+        session.refresh(stored)
+
+    assert orm_course.n_points == stored.n_points
+    assert orm_course.start_time == stored.start_time
+    assert orm_course.duration == stored.duration
+    assert orm_course.distance == pytest.approx(stored.distance)
+    assert (
+        orm_course.min_lat,
+        orm_course.max_lat,
+        orm_course.min_lon,
+        orm_course.max_lon,
+    ) == (stored.min_lat, stored.max_lat, stored.min_lon, stored.max_lon)
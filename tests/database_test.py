@@ -0,0 +1,37 @@
+import asyncio
+
+from python_demo.database import create_async_db_engine, create_db_engine
+
+
+def test_pragmas(tmp_path, monkeypatch):
+    monkeypatch.setenv("SQLITE_BUSY_TIMEOUT", "1234")
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'test.db'}")
+
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 1234
+        # NORMAL
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+
+
+def test_memory_database():
+    engine = create_db_engine("sqlite://")
+
+    # Tables created on one connection are visible from the next
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE test (id INTEGER)")
+    with engine.connect() as connection:
+        connection.exec_driver_sql("SELECT * FROM test")
+
+
+def test_async_pragmas(tmp_path):
+    engine = create_async_db_engine(f"sqlite:///{tmp_path / 'test.db'}")
+
+    async def journal_mode():
+        async with engine.connect() as connection:
+            result = await connection.exec_driver_sql("PRAGMA journal_mode")
+            mode = result.scalar()
+        await engine.dispose()
+        return mode
+
+    assert asyncio.run(journal_mode()) == "wal"
@@ -0,0 +1,79 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, create_engine, select
+
+from python_demo import course, dedup, storage
+from python_demo.models import Course, add_missing_columns, create_db_and_tables
+
+
+def test_read_file_id():
+    assert course.read_file_id("tests/activity.fit") == (
+        3951646647,
+        datetime(2023, 2, 18, 20, 39, 41),
+    )
+
+
+def test_find_duplicates(monkeypatch):
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+    with Session(engine) as session:
+        stored = []
+        for backend, user_id in [("rows", 1), ("blocks", 1), ("rows", 2)]:
+            monkeypatch.setenv("POINT_STORAGE", backend)
+            chunks = course.iter_fit_columns("tests/activity.fit")
+            stored.append(
+                course.store_course(session, chunks, user_id=user_id, name="a").id
+            )
+        # The same start and number of points, but different positions
+        chunks = list(course.iter_fit_columns("tests/activity.fit"))
+        chunks[-1]["latitude"] = chunks[-1]["latitude"] + 0.001
+        different = course.store_course(session, chunks, user_id=1, name="b").id
+
+        assert dedup.find_duplicates(session) == [stored[:2]]
+        assert dedup.points_hash(session, stored[0]) != dedup.points_hash(
+            session, different
+        )
+        assert storage.course_backend(session, stored[1]) == storage.BLOCKS
+
+
+def test_find_duplicates_without_summary():
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+    with Session(engine) as session:
+        # Courses stored before the summary was kept, without a start time
+        for name in ["a", "b"]:
+            points = course.decode_fit("tests/activity.fit")
+            session.add(Course(user_id=1, name=name, points=points))
+        session.commit()
+
+        assert dedup.find_duplicates(session) == [[1, 2]]
+
+
+def test_unique_file_hash_added(tmp_path):
+    # The same file could be stored twice before the index was unique
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP INDEX ix_course_user_id_file_hash")
+        connection.exec_driver_sql(
+            "CREATE INDEX ix_course_user_id_file_hash ON course (user_id, file_hash)"
+        )
+    with Session(engine) as session:
+        for user_id in [1, 1, 2]:
+            stored = Course(user_id=user_id, name="a")
+            stored.file_hash = "abc"
+            session.add(stored)
+        session.commit()
+
+    add_missing_columns(engine)
+
+    with Session(engine) as session:
+        hashes = session.exec(select(Course.id, Course.file_hash)).all()
+        copy = Course(user_id=1, name="b")
+        copy.file_hash = "abc"
+        session.add(copy)
+        with pytest.raises(IntegrityError):
+            session.commit()
+    assert sorted(hashes) == [(1, "abc"), (2, None), (3, "abc")]
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlmodel import Session, create_engine, select, update
+
+from python_demo import course, derived, machine_learning
+from python_demo.models import Course, CoursePoints, create_db_and_tables
+
+
+def test_derive():
+    lat = np.array([0.0, 0.001, 0.002, 0.002])
+    lon = np.zeros(4)
+    altitude = np.array([10.0, 11.0, 12.0, 12.0])
+    values = derived.derive(lat, lon, altitude)
+
+    step = values["step_distance"]
+    assert np.isnan(step[-1])
+    assert step[2] == 0
+    np.testing.assert_allclose(
+        values["cumulative_distance"], [0, *np.cumsum(step[:-1])]
+    )
+    # There is no gradient between points in the same place or after the last
+    assert np.isnan(values["gradient"][2:]).all()
+    assert (values["gradient"][:2] > 0).all()
+
+
+def test_store_course_derived():
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+    fields = ["lat", "lon", "altitude", *derived.DERIVED_FIELDS]
+
+    with Session(engine) as session:
+        # Using small chunks checks the values carry on from one chunk to the next
+        chunks = course.iter_fit_columns("tests/activity.fit", chunk_size=1000)
+        stored = course.store_course(session, chunks, user_id=1, name="a")
+        assert derived.is_derived(session, stored.id)
+        df = course.load_points(session, stored.id, fields)
+
+    # The same as deriving the values from the whole course at once
+    expected = derived.derive(
+        df["lat"].to_numpy(np.float64),
+        df["lon"].to_numpy(np.float64),
+        df["altitude"].to_numpy(np.float64),
+    )
+    for field in derived.DERIVED_FIELDS:
+        np.testing.assert_allclose(
+            df[field].to_numpy(np.float64), expected[field], rtol=1e-9
+        )
+
+
+@pytest.mark.parametrize("paramstyle", ["qmark", "named"])
+def test_store_derived(monkeypatch, paramstyle):
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+    # Drivers without ? placeholders have the update built by SQLAlchemy
+    monkeypatch.setattr(engine.dialect, "paramstyle", paramstyle)
+
+    with Session(engine) as session:
+        stored = course.store_course(
+            session, course.iter_fit_columns("tests/activity.fit"), user_id=1, name="a"
+        )
+        # Courses stored before the values were derived have them all missing
+        session.execute(
+            update(CoursePoints).values(
+                {field: None for field in derived.DERIVED_FIELDS}
+            )
+        )
+        session.commit()
+        assert not derived.is_derived(session, stored.id)
+        df = derived.load_derived(
+            session, stored.id, ["lat", "lon", "altitude", *derived.DERIVED_FIELDS]
+        )
+        assert derived.is_derived(session, stored.id)
+        n_stored = len(session.exec(select(CoursePoints.id)).all())
+        # The points have changed, so the cached responses for them are stale
+        version = session.exec(select(Course.version).where(Course.id == stored.id))
+        assert version.one() == 2
+
+    assert len(df) == n_stored
+    # The same as the summary found as the course was stored, and the gradient
+    # calculated from the recorded values.
+    assert df["cumulative_distance"].iloc[-1] == pytest.approx(stored.distance)
+    expected = machine_learning.calculate_gradient(df["lat"], df["lon"], df["altitude"])
+    pd.testing.assert_series_equal(
+        df["gradient"].astype(float), expected, check_names=False
+    )
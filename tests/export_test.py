@@ -0,0 +1,79 @@
+import csv
+import io
+import json
+
+import pytest
+from sqlmodel import Session, create_engine
+
+from python_demo import course, export
+from python_demo.models import create_db_and_tables
+
+
+@pytest.mark.parametrize(
+    ("accept", "expected"),
+    [
+        (None, "json"),
+        ("*/*", "json"),
+        ("text/csv", "csv"),
+        ("text/html, text/csv;q=0.5, application/json;q=0.8", "json"),
+        ("application/vnd.apache.arrow.stream", "arrow"),
+    ],
+)
+def test_negotiate(accept, expected):
+    assert export.negotiate(accept) == expected
+
+
+def test_negotiate_unavailable():
+    with pytest.raises(ValueError):
+        export.negotiate("text/html")
+    with pytest.raises(ValueError):
+        export.negotiate(None, "xml")
+
+
+def test_parse_fields():
+    assert export.parse_fields(None) == export.POINT_FIELDS
+    assert export.parse_fields("lat, lon") == ["lat", "lon"]
+    with pytest.raises(ValueError):
+        export.parse_fields("lat,password")
+
+
+@pytest.fixture(scope="module")
+def stored_course():
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+    with Session(engine) as session:
+        chunks = course.iter_fit_columns("tests/activity.fit")
+        stored = course.store_course(session, chunks, user_id=None, name="a")
+        yield session, stored
+
+
+def _content(session, course_id, fields, format) -> bytes:
+    return b"".join(export.stream_points(session, course_id, fields, format))
+
+
+def test_formats_match(stored_course):
+    session, stored = stored_course
+    fields = ["time", "lat", "speed", "heart_rate"]
+
+    rows = json.loads(_content(session, stored.id, fields, "json"))
+    columns = json.loads(_content(session, stored.id, fields, "columns"))
+    text = _content(session, stored.id, fields, "csv").decode()
+    table = list(csv.reader(io.StringIO(text)))
+
+    assert len(rows) == stored.n_points
+    assert list(rows[0]) == fields
+    assert columns == {field: [row[field] for row in rows] for field in fields}
+    assert table[0] == fields
+    assert len(table) == stored.n_points + 1
+    assert table[1] == [str(value) for value in rows[0].values()]
+
+
+def test_arrow(stored_course):
+    pa = pytest.importorskip("pyarrow")
+    session, stored = stored_course
+
+    content = _content(session, stored.id, ["lat", "lon"], "arrow")
+    table = pa.ipc.open_stream(content).read_all()
+
+    assert table.num_rows == stored.n_points
+    assert table.schema.names == ["lat", "lon"]
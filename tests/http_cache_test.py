@@ -0,0 +1,74 @@
+from datetime import datetime
+
+import pytest
+from fastapi import Request
+
+from python_demo import http_cache
+
+VERSION = http_cache.CourseVersion(1, 2, datetime(2023, 2, 18, 20, 39, 41, 500))
+
+
+def request(**headers: str) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "headers": [
+                (name.replace("_", "-").encode(), value.encode())
+                for name, value in headers.items()
+            ],
+        }
+    )
+
+
+def test_etag():
+    tag = http_cache.etag(1, VERSION, "csv", ["lat", "lon"])
+    assert tag == http_cache.etag(1, VERSION, "csv", ["lat", "lon"])
+    assert tag != http_cache.etag(1, VERSION, "json", ["lat", "lon"])
+    assert tag != http_cache.etag(1, VERSION._replace(version=3), "csv", ["lat", "lon"])
+    assert http_cache.headers(tag, VERSION, "no-cache") == {
+        "ETag": tag,
+        "Cache-Control": "no-cache",
+        "Last-Modified": "Sat, 18 Feb 2023 20:39:41 GMT",
+    }
+
+
+@pytest.mark.parametrize(
+    ("headers", "expected"),
+    [
+        ({}, False),
+        ({"if_none_match": '"a", "1-2-x"'}, True),
+        ({"if_none_match": 'W/"1-2-x"'}, True),
+        ({"if_none_match": "*"}, True),
+        ({"if_none_match": '"1-1-x"'}, False),
+        ({"if_modified_since": "Sat, 18 Feb 2023 20:39:41 GMT"}, True),
+        ({"if_modified_since": "Sat, 18 Feb 2023 20:39:40 GMT"}, False),
+        ({"if_modified_since": "yesterday"}, False),
+        # The ETag is used in place of the time when both are given
+        (
+            {
+                "if_none_match": '"1-1-x"',
+                "if_modified_since": "Sat, 18 Feb 2023 20:39:41 GMT",
+            },
+            False,
+        ),
+    ],
+)
+def test_not_modified(headers, expected):
+    assert http_cache.not_modified(request(**headers), '"1-2-x"', VERSION) is expected
+
+
+def test_keep(monkeypatch):
+    monkeypatch.setattr(http_cache, "PAYLOAD_MAX_BYTES", 4)
+    http_cache.payload_cache.clear()
+
+    assert list(http_cache.keep("small", iter([b"ab", b"cd"]))) == [b"ab", b"cd"]
+    assert http_cache.payload_cache.get("small") == b"abcd"
+
+    assert b"".join(http_cache.keep("large", iter([b"abc", b"de"]))) == b"abcde"
+    assert http_cache.payload_cache.get("large") is None
+
+    # The content isn't cached when the response stops part way
+    content = http_cache.keep("partial", iter([b"a", b"b"]))
+    next(content)
+    content.close()
+    assert http_cache.payload_cache.get("partial") is None
@@ -0,0 +1,261 @@
+import io
+import tracemalloc
+import zipfile
+from pathlib import Path
+
+import pytest
+from sqlmodel import Session, create_engine, func, select
+
+from python_demo import course, jobs, machine_learning
+from python_demo.models import (
+    Course,
+    CoursePoints,
+    IngestJob,
+    JobStatus,
+    create_db_and_tables,
+)
+
+
+def test_run_job(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path / "uploads"))
+    database_url = f"sqlite:///{tmp_path / 'test.db'}"
+    engine = create_engine(database_url)
+    create_db_and_tables(engine)
+
+    with Session(engine) as session:
+        with open("tests/activity.fit", "rb") as file:
+            job = jobs.create_job(session, file, user_id=1, name="test")
+        spooled = Path(job.path)
+        assert spooled.exists()
+
+        course_id = jobs.run_job(database_url, job.id)
+
+        session.refresh(job)
+        n_points = session.exec(
+            select(func.count()).where(CoursePoints.course_id == course_id)
+        ).one()
+
+    assert job.status == JobStatus.done
+    assert job.course_id == course_id
+    assert n_points > 0
+    assert not spooled.exists()
+
+
+def test_run_job_memory(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path / "uploads"))
+    database_url = f"sqlite:///{tmp_path / 'test.db'}"
+    engine = create_engine(database_url)
+    create_db_and_tables(engine)
+    # FIT files can be chained together, giving a course twice the length of
+    # the test file in several chunks. Tracing the memory is slow, so this is
+    # enough to see each chunk is freed before the next. Stored as rows, which
+    # uses the most memory.
+    path = tmp_path / "chained.fit"
+    path.write_bytes(Path("tests/activity.fit").read_bytes() * 2)
+
+    with Session(engine) as session:
+        with open(path, "rb") as file:
+            job = jobs.create_job(session, file, user_id=1, name="test")
+
+        tracemalloc.start()
+        try:
+            course_id = jobs.run_job(database_url, job.id)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        stored = session.get(Course, course_id)
+
+    assert stored.n_points > 5 * course.POINTS_CHUNK_SIZE
+    assert peak < course.memory_ceiling()
+
+
+def test_run_job_failure(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path / "uploads"))
+    database_url = f"sqlite:///{tmp_path / 'test.db'}"
+    engine = create_engine(database_url)
+    create_db_and_tables(engine)
+
+    with Session(engine) as session:
+        job = IngestJob(user_id=1, name="missing", path=str(tmp_path / "none.fit"))
+        session.add(job)
+        session.commit()
+
+        assert jobs.run_job(database_url, job.id) is None
+
+        session.refresh(job)
+
+    assert job.status == JobStatus.failed
+    assert job.error is not None
+
+
+def test_run_job_failure_after_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path / "uploads"))
+    database_url = f"sqlite:///{tmp_path / 'test.db'}"
+    engine = create_engine(database_url)
+    create_db_and_tables(engine)
+
+    def fail(session, user_id, course_id):
+        raise RuntimeError("model")
+
+    monkeypatch.setattr(machine_learning, "update_user_model", fail)
+
+    with Session(engine) as session:
+        with open("tests/activity.fit", "rb") as file:
+            job = jobs.create_job(session, file, user_id=1, name="test")
+
+        assert jobs.run_job(database_url, job.id) is None
+
+        session.refresh(job)
+        # The course stored before the failure isn't left behind
+        assert session.exec(select(func.count()).select_from(Course)).one() == 0
+        assert session.exec(select(func.count()).select_from(CoursePoints)).one() == 0
+
+    assert job.status == JobStatus.failed
+    assert job.error == "model"
+    assert not Path(job.path).exists()
+
+
+def test_create_batch(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path / "uploads"))
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+
+    content = Path("tests/activity.fit").read_bytes()
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as writer:
+        writer.writestr("rides/a.fit", content)
+        writer.writestr("notes.txt", b"skipped")
+        writer.writestr("rides/corrupt.FIT", content)
+    # Changing the stored data of the last file fails its checksum
+    data = bytearray(archive.getvalue())
+    data[data.index(b"corrupt.FIT") + 200] ^= 0xFF
+
+    with Session(engine) as session:
+        batch, batch_jobs = jobs.create_batch(
+            session,
+            [(io.BytesIO(content), "b.fit"), (io.BytesIO(bytes(data)), "rides.zip")],
+            user_id=1,
+        )
+        status = jobs.batch_status(session, batch.id)
+
+    assert [job.name for job in batch_jobs] == ["b.fit", "a.fit", "corrupt.FIT"]
+    assert Path(batch_jobs[1].path).read_bytes() == content
+    assert status["total"] == 3
+    assert status["pending"] == 2
+    assert status["failed"] == 1
+    assert not status["finished"]
+    assert status["files"][2]["error"] is not None
+
+
+def test_create_batch_unreadable_archive(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path / "uploads"))
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as writer:
+        writer.writestr("a.fit", b"a")
+        writer.writestr("b.fit", b"b")
+    # The end of the archive is still found, but not the files it lists
+    corrupt = archive.getvalue().replace(b"PK\x01\x02", b"XX\x01\x02")
+    assert zipfile.is_zipfile(io.BytesIO(corrupt))
+
+    monkeypatch.setattr(jobs, "MAX_ARCHIVE_MEMBERS", 1)
+    with Session(engine) as session:
+        _, batch_jobs = jobs.create_batch(
+            session,
+            [
+                (io.BytesIO(corrupt), "corrupt.zip"),
+                (io.BytesIO(archive.getvalue()), "large.zip"),
+            ],
+            user_id=1,
+        )
+
+    assert [job.name for job in batch_jobs] == ["corrupt.zip", "large.zip"]
+    assert all(job.status == JobStatus.failed for job in batch_jobs)
+    assert "more than 1 files" in batch_jobs[1].error
+    assert list(jobs.upload_dir().iterdir()) == []
+
+
+def test_create_batch_removes_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path / "uploads"))
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+
+    class Broken(io.BytesIO):
+        def read(self, *args):
+            raise OSError("connection lost")
+
+    content = Path("tests/activity.fit").read_bytes()
+    with Session(engine) as session:
+        with pytest.raises(OSError, match="connection lost"):
+            jobs.create_batch(
+                session,
+                [(io.BytesIO(content), "a.fit"), (Broken(content), "b.fit")],
+                user_id=1,
+            )
+        assert session.exec(select(func.count()).select_from(IngestJob)).one() == 0
+
+    assert list(jobs.upload_dir().iterdir()) == []
+
+
+def test_duplicate_upload(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path / "uploads"))
+    database_url = f"sqlite:///{tmp_path / 'test.db'}"
+    engine = create_engine(database_url)
+    create_db_and_tables(engine)
+    content = Path("tests/activity.fit").read_bytes()
+
+    with Session(engine) as session:
+        first = jobs.create_job(session, io.BytesIO(content), user_id=1, name="a")
+        course_id = jobs.run_job(database_url, first.id)
+
+        again = jobs.create_job(session, io.BytesIO(content), user_id=1, name="b")
+        assert again.status == JobStatus.done
+        assert again.course_id == course_id
+        assert not Path(again.path).exists()
+
+        # Different bytes, but the same activity within the FIT file
+        rewritten = jobs.create_job(
+            session, io.BytesIO(content + b"\0"), user_id=1, name="c"
+        )
+        assert rewritten.status == JobStatus.pending
+        assert jobs.run_job(database_url, rewritten.id) == course_id
+
+        other_user = jobs.create_job(session, io.BytesIO(content), user_id=2, name="d")
+        assert other_user.status == JobStatus.pending
+        n_courses = session.exec(select(func.count()).select_from(Course)).one()
+
+    assert n_courses == 1
+
+
+def test_duplicate_upload_at_once(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path / "uploads"))
+    database_url = f"sqlite:///{tmp_path / 'test.db'}"
+    engine = create_engine(database_url)
+    create_db_and_tables(engine)
+    content = Path("tests/activity.fit").read_bytes()
+
+    with Session(engine) as session:
+        # Both jobs are recorded before either course is stored
+        _, (first, second) = jobs.create_batch(
+            session,
+            [(io.BytesIO(content), "a.fit"), (io.BytesIO(content), "b.fit")],
+            user_id=1,
+        )
+        assert second.status == JobStatus.pending
+        course_id = jobs.run_job(database_url, first.id)
+
+        # As if the second job checked before the first course was committed
+        find_duplicate = jobs.find_duplicate
+        checks = iter([None])
+        monkeypatch.setattr(
+            jobs,
+            "find_duplicate",
+            lambda *args: next(checks, None) or find_duplicate(*args),
+        )
+        assert jobs.run_job(database_url, second.id) == course_id
+        n_courses = session.exec(select(func.count()).select_from(Course)).one()
+
+    assert n_courses == 1
@@ -0,0 +1,206 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import LinearRegression
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import ClauseElement
+from sqlmodel import Session, create_engine, select
+
+from python_demo import course, machine_learning
+from python_demo.models import (
+    CoursePoints,
+    MLModel,
+    add_missing_columns,
+    create_db_and_tables,
+)
+
+
+@pytest.fixture(scope="module")
+def columns():
+    return course.fit_to_columns("tests/activity.fit")
+
+
+@pytest.mark.parametrize("method", ["haversine", "equirectangular"])
+def test_step_distance_error(columns, method):
+    exact = machine_learning.step_distance(
+        columns["latitude"], columns["longitude"], "geodesic"
+    )
+    approx = machine_learning.step_distance(
+        columns["latitude"], columns["longitude"], method
+    )
+
+    assert np.isnan(approx[-1])
+    moved = exact > 0
+    assert np.all(np.abs(approx[moved] - exact[moved]) / exact[moved] < 0.0025)
+
+
+def test_gradient_index(columns):
+    # The distance has to line up with the altitude, whatever its index.
+    altitude = pd.Series(columns["altitude"]).rename(lambda i: i + 10)
+    gradient = machine_learning.calculate_gradient(
+        columns["latitude"], columns["longitude"], altitude
+    )
+
+    assert gradient.index.equals(altitude.index)
+
+
+def test_power_model_matches_refit(columns):
+    df = pd.DataFrame(
+        {
+            "lat": columns["latitude"],
+            "lon": columns["longitude"],
+            "altitude": columns["altitude"],
+            "speed": columns["speed"],
+            "power": columns["power"],
+        }
+    )
+    X, y = machine_learning.training_data(df)
+    reference = LinearRegression().fit(X, y)
+
+    model = machine_learning.PowerModel()
+    for start in range(0, len(X), 1000):
+        model.partial_fit(X[start : start + 1000], y[start : start + 1000])
+
+    assert model.n_samples == len(X)
+    np.testing.assert_allclose(model.coef_, reference.coef_)
+    np.testing.assert_allclose(model.intercept_, reference.intercept_)
+    np.testing.assert_allclose(model.predict(X[:10]), reference.predict(X[:10]))
+
+
+def test_update_user_model(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+
+    with Session(engine) as session:
+        for name in ["first", "second"]:
+            stored = course.store_course(
+                session,
+                course.iter_fit_columns("tests/activity.fit"),
+                user_id=1,
+                name=name,
+            )
+            model = machine_learning.update_user_model(session, 1, stored.id)
+
+        points = session.exec(select(CoursePoints).order_by(CoursePoints.id)).all()
+        reference = machine_learning.generate_model(points)
+        ml_model = session.exec(select(MLModel)).one()
+        stored_model = machine_learning.load_model(ml_model)
+
+    # The model is stored by its parameters rather than pickled
+    assert ml_model.model is None
+    np.testing.assert_allclose(model.coef_, reference.coef_)
+    np.testing.assert_allclose(stored_model.coef_, reference.coef_)
+    np.testing.assert_allclose(stored_model.intercept_, reference.intercept_)
+
+
+def test_update_user_model_locks_row(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+
+    with Session(engine) as session:
+        for name in ["first", "second"]:
+            stored = course.store_course(
+                session,
+                course.iter_fit_columns("tests/activity.fit"),
+                user_id=1,
+                name=name,
+            )
+            if name == "first":
+                machine_learning.update_user_model(session, 1, stored.id)
+
+        # Other databases lock the row of the model rather than the database
+        statements = []
+
+        @event.listens_for(engine, "before_execute")
+        def record(connection, clauseelement, *args):
+            statements.append(clauseelement)
+
+        monkeypatch.setattr(engine.dialect, "name", "postgresql")
+        model = machine_learning.update_user_model(session, 1, stored.id)
+
+    sql = [
+        str(statement.compile(dialect=postgresql.dialect()))
+        if isinstance(statement, ClauseElement)
+        else statement
+        for statement in statements
+    ]
+    assert not any("BEGIN IMMEDIATE" in statement for statement in sql)
+    assert any(
+        "FROM mlmodel" in statement and "FOR UPDATE" in statement
+        for statement in sql
+    )
+    assert model.n_samples > 0
+
+
+def test_get_user_model_cached(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+    machine_learning.model_cache.clear()
+
+    with Session(engine) as session:
+        stored = course.store_course(
+            session, course.iter_fit_columns("tests/activity.fit"), user_id=1, name="a"
+        )
+        machine_learning.update_user_model(session, 1, stored.id)
+
+        model = machine_learning.get_user_model(session, 1)
+        hits = machine_learning.model_cache.hits
+        assert machine_learning.get_user_model(session, 1) is model
+        assert machine_learning.model_cache.hits == hits + 1
+
+        machine_learning.invalidate_user_model(1)
+        assert machine_learning.get_user_model(session, 1) is not model
+
+
+def test_get_user_model_pickled(tmp_path):
+    # Models stored before the parameters were used are still read
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+    machine_learning.model_cache.clear()
+    X = np.array([[10.0, 0.0], [20.0, 1.0], [30.0, -1.0], [25.0, 2.0]])
+    pickled = machine_learning.PowerModel().partial_fit(X, X @ [5.0, 20.0] + 50)
+    del pickled._coef
+
+    with Session(engine) as session:
+        ml_model = MLModel(user_id=1)
+        ml_model.model = pickled
+        session.add(ml_model)
+        session.commit()
+
+        model = machine_learning.get_user_model(session, 1)
+
+    np.testing.assert_allclose(model.coef_, [5.0, 20.0])
+    np.testing.assert_allclose(model.intercept_, 50.0)
+
+
+def test_save_model_replaces(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+    X = np.array([[10.0, 0.0], [20.0, 1.0], [30.0, -1.0], [25.0, 2.0]])
+
+    with Session(engine) as session:
+        # Both jobs found no model before training, the second replaces it
+        for intercept in [50.0, 60.0]:
+            y = X @ [5.0, 20.0] + intercept
+            model = machine_learning.PowerModel().partial_fit(X, y)
+            machine_learning.save_model(session, 1, model)
+
+        (ml_model,) = session.exec(select(MLModel)).all()
+        loaded = machine_learning.load_model(ml_model)
+    np.testing.assert_allclose(loaded.intercept_, 60.0)
+
+
+def test_duplicate_models_removed(tmp_path):
+    # Databases from before the unique index can have more than one model
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP INDEX ix_mlmodel_user_id")
+        connection.exec_driver_sql("INSERT INTO mlmodel (user_id) VALUES (1), (1), (2)")
+
+    add_missing_columns(engine)
+
+    with Session(engine) as session:
+        models = session.exec(select(MLModel.id, MLModel.user_id)).all()
+    assert sorted(models) == [(2, 1), (3, 2)]
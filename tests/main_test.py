@@ -0,0 +1,141 @@
+import io
+import subprocess
+import sys
+import time
+import zipfile
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+def test_heavy_modules_not_imported():
+    # Importing the application, as every new worker does, leaves the modules
+    # for analysing the courses until they are needed.
+    script = (
+        "import sys, python_demo.main; "
+        "print(sorted({'pandas', 'sklearn', 'geopy', 'fitdecode', 'pyarrow'} "
+        "& set(sys.modules)))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    ).stdout
+
+    assert output.strip() == "[]"
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("main")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # The application configures itself from the environment when it is
+        # imported, so this has to be set first.
+        monkeypatch.setenv("DATABASE_URL", f"sqlite:///{directory / 'test.db'}")
+        monkeypatch.setenv("UPLOAD_DIR", str(directory / "uploads"))
+        monkeypatch.setenv("SECRET_KEY", "test-secret-key-of-at-least-32-bytes")
+        from python_demo.main import app
+
+        with TestClient(app) as client:
+            credentials = {"username": "test", "password": "test"}
+            client.post("/user", data=credentials)
+            client.post("/auth", data=credentials)
+            yield client
+
+
+def test_course_batch(client):
+    content = Path("tests/activity.fit").read_bytes()
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as writer:
+        writer.writestr("rides/a.fit", content)
+    corrupt = archive.getvalue().replace(b"PK\x01\x02", b"XX\x01\x02")
+
+    response = client.post(
+        "/course/batch",
+        files=[
+            ("files", ("rides.zip", archive.getvalue())),
+            ("files", ("corrupt.zip", corrupt)),
+        ],
+    )
+    assert response.status_code == 202
+    batch = response.json()
+    assert [file["name"] for file in batch["files"]] == ["a.fit", "corrupt.zip"]
+    assert batch["failed"] == 1
+
+    deadline = time.monotonic() + 120
+    while not batch["finished"] and time.monotonic() < deadline:
+        time.sleep(0.5)
+        batch = client.get(f"/course/batch/{batch['id']}").json()
+    assert batch["finished"]
+    assert batch["done"] == 1
+    assert batch["files"][0]["course_id"] is not None
+
+    response = client.get(f"/course/batch/{batch['id'] + 1}")
+    assert response.status_code == 401
+
+
+def login(client, username: str) -> None:
+    """Sign up and log the client in as a new user."""
+    credentials = {"username": username, "password": username}
+    client.post("/user", data=credentials)
+    client.post("/auth", data=credentials)
+
+
+def test_user_cache(client):
+    from python_demo.main import manager, user_cache
+
+    login(client, "cached")
+    user_cache.invalidate("cached")
+    hits = user_cache.hits
+    assert client.get("/home").status_code == 200
+    assert user_cache.hits == hits
+    assert client.get("/home").status_code == 200
+    assert user_cache.hits == hits + 1
+
+    # A user who hasn't signed up yet isn't cached, so is found once they do
+    token = manager.create_access_token(data={"sub": "later"})
+    response = client.get("/home", cookies={manager.cookie_name: token})
+    assert response.status_code == 401
+    assert user_cache.get("later") is None
+    login(client, "later")
+    response = client.get("/home", cookies={manager.cookie_name: token})
+    assert response.status_code == 200
+
+
+def test_user_cache_rehash(client, monkeypatch):
+    from python_demo import authentication
+    from python_demo.main import user_cache
+
+    login(client, "rehash")
+    assert client.get("/home").status_code == 200
+    old_hash = user_cache.get("rehash").hashed_password
+
+    # As if the settings of argon2 had changed since the password was hashed
+    async def verify_and_update(password, hashed_password):
+        return True, "rehashed"
+
+    monkeypatch.setattr(authentication, "verify_and_update", verify_and_update)
+    credentials = {"username": "rehash", "password": "rehash"}
+    assert client.post("/auth", data=credentials).status_code == 200
+    assert user_cache.get("rehash") is None
+
+    assert client.get("/home").status_code == 200
+    assert user_cache.get("rehash").hashed_password == "rehashed" != old_hash
+
+
+def test_predict_without_courses(client):
+    from python_demo.main import model_cache, user_cache
+
+    login(client, "untrained")
+    response = client.post("/predict", data={"speed": 20, "gradient": 0})
+    assert response.status_code == 200
+    assert "Upload a course first" in response.text
+    response = client.post("/predict/batch", json={"speed": [20], "gradient": [0]})
+    assert response.status_code == 409
+    # The empty model isn't kept, so the first course trains it
+    assert model_cache.get(user_cache.get("untrained").id) is None
+
+
+@pytest.mark.parametrize("course_id", ["abc", "1", 1.5, True, None])
+def test_predict_batch_invalid_course_id(client, course_id):
+    response = client.post("/predict/batch", json={"course_id": course_id})
+    assert response.status_code == 422
@@ -0,0 +1,58 @@
+from python_demo.metrics import Registry
+
+
+def test_render():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests.")
+    seconds = registry.histogram("seconds", "Time taken.", buckets=(0.1, 1))
+    registry.gauge("size", "Size.", lambda: [({"cache": "a"}, 3)])
+
+    requests.inc(route="/home")
+    requests.inc(route="/home")
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    seconds.observe(5)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{route="/home"} 2' in lines
+    assert 'seconds_bucket{le="0.1"} 1' in lines
+    assert 'seconds_bucket{le="1"} 2' in lines
+    assert 'seconds_bucket{le="+Inf"} 3' in lines
+    assert "seconds_count 3" in lines
+    assert "seconds_sum 5.55" in lines
+    assert 'size{cache="a"} 3' in lines
+
+
+def test_timer():
+    registry = Registry()
+    seconds = registry.histogram("seconds", "Time taken.")
+
+    @seconds.time(function="add")
+    def add(a, b):
+        return a + b
+
+    assert add(1, 2) == 3
+    with seconds.time(function="block"):
+        pass
+
+    assert seconds.count(function="add") == 1
+    assert seconds.count(function="block") == 1
+
+
+def test_drain_merge():
+    worker, server = Registry(), Registry()
+    worker_jobs = worker.counter("jobs_total", "Jobs.")
+    worker_seconds = worker.histogram("seconds", "Time taken.")
+    server_jobs = server.counter("jobs_total", "Jobs.")
+    server_seconds = server.histogram("seconds", "Time taken.")
+
+    worker_jobs.inc(status="done")
+    worker_seconds.observe(1)
+    server_jobs.inc(status="done")
+    server.merge(worker.drain())
+
+    assert server_jobs.value(status="done") == 2
+    assert server_seconds.count() == 1
+    # Draining resets the values, so they are only sent once
+    assert worker_jobs.value(status="done") == 0
@@ -0,0 +1,49 @@
+import json
+
+import numpy as np
+import pytest
+
+from python_demo.power_model import SCHEMA_VERSION, PowerModel, UntrainedModel
+
+
+@pytest.fixture
+def model():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(0, 40, (100, 2))
+    y = X @ [8.0, 15.0] + 30 + rng.normal(0, 1, 100)
+    return PowerModel().partial_fit(X, y)
+
+
+def test_round_trip(model):
+    params = json.loads(json.dumps(model.to_dict()))
+    loaded = PowerModel.from_dict(params)
+
+    assert params["version"] == SCHEMA_VERSION
+    assert loaded.n_samples == model.n_samples
+    np.testing.assert_allclose(loaded.coef_, model.coef_)
+    np.testing.assert_allclose(loaded.intercept_, model.intercept_)
+
+    # The loaded model can continue to be updated
+    X = np.array([[10.0, 1.0], [35.0, -2.0]])
+    y = X @ [8.0, 15.0] + 30
+    loaded.partial_fit(X, y)
+    model.partial_fit(X, y)
+    np.testing.assert_allclose(loaded.coef_, model.coef_)
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        {"version": SCHEMA_VERSION + 1},
+        {"type": "forest"},
+        {"features": ["gradient", "speed_kmh"]},
+    ],
+)
+def test_unsupported(model, change):
+    with pytest.raises(ValueError):
+        PowerModel.from_dict({**model.to_dict(), **change})
+
+
+def test_predict_untrained():
+    with pytest.raises(UntrainedModel):
+        PowerModel().predict([[20.0, 0.0]])
@@ -0,0 +1,88 @@
+import numpy as np
+from sqlmodel import Session, create_engine, select
+
+from python_demo import course, simplify
+from python_demo.models import CourseLevel, CoursePoints, create_db_and_tables
+
+
+def _douglas_peucker(x, y, tolerance, start, end, kept):
+    """A direct recursive implementation to compare against."""
+    if end - start < 2:
+        return
+    index = np.arange(start + 1, end)
+    dx, dy = x[end] - x[start], y[end] - y[start]
+    t = ((x[index] - x[start]) * dx + (y[index] - y[start]) * dy) / (dx**2 + dy**2)
+    t = np.clip(t, 0, 1)
+    distance = np.hypot(x[index] - x[start] - t * dx, y[index] - y[start] - t * dy)
+    furthest = index[np.argmax(distance)]
+    if distance.max() > tolerance:
+        kept.add(furthest)
+        _douglas_peucker(x, y, tolerance, start, furthest, kept)
+        _douglas_peucker(x, y, tolerance, furthest, end, kept)
+
+
+def test_significance_matches_recursive():
+    rng = np.random.default_rng(0)
+    lat = -34.9 + np.cumsum(rng.normal(0, 1e-4, 500))
+    lon = 138.6 + np.cumsum(rng.normal(0, 1e-4, 500))
+    significance = simplify.significance(lat, lon)
+    x, y = simplify._planar(lat, lon)
+
+    for tolerance in simplify.LEVEL_TOLERANCES:
+        kept = {0, len(lat) - 1}
+        _douglas_peucker(x, y, tolerance, 0, len(lat) - 1, kept)
+        assert set(np.flatnonzero(significance > tolerance)) == kept
+
+
+def test_store_levels():
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+
+    with Session(engine) as session:
+        chunks = course.iter_fit_columns("tests/activity.fit")
+        stored = course.store_course(session, chunks, user_id=None, name="a")
+        levels = simplify.store_levels(session, stored.id)
+
+        counts = [
+            len(
+                session.exec(
+                    select(CoursePoints.id).where(CoursePoints.detail >= level.level)
+                ).all()
+            )
+            for level in levels
+        ]
+        n_points = [level.n_points for level in levels]
+        assert counts[0] == stored.n_points
+
+    assert counts == n_points
+    assert counts == sorted(counts, reverse=True)
+
+    levels = [CourseLevel(level=i, n_points=n) for i, n in enumerate(n_points)]
+    assert simplify.choose_level(levels, counts[0]) == 0
+    assert simplify.choose_level(levels, counts[2]) == 2
+    assert simplify.choose_level(levels, 0) == len(levels) - 1
+
+
+def test_store_course_levels():
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+
+    with Session(engine) as session:
+        # Each chunk is simplified on its own, sharing a point with the next
+        chunks = course.iter_fit_columns("tests/activity.fit", chunk_size=1000)
+        stored = course.store_course(session, chunks, user_id=None, name="a")
+        levels = session.exec(
+            select(CourseLevel)
+            .where(CourseLevel.course_id == stored.id)
+            .order_by(CourseLevel.level)
+        ).all()
+        detail = np.array(session.exec(select(CoursePoints.detail)).all())
+
+    assert [level.level for level in levels] == list(
+        range(len(simplify.LEVEL_TOLERANCES) + 1)
+    )
+    assert [level.n_points for level in levels] == [
+        int((detail >= level.level).sum()) for level in levels
+    ]
+    # The first point of every chunk is kept at every level
+    assert (detail[::1000] == len(simplify.LEVEL_TOLERANCES)).all()
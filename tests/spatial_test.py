@@ -0,0 +1,103 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from sqlmodel import Session, create_engine, func, select
+
+from python_demo import course, spatial, storage
+from python_demo.geometry import distance_to
+from python_demo.models import User, create_db_and_tables, point_index
+
+
+@pytest.fixture(scope="module")
+def stored():
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+    with Session(engine) as session:
+        users = [User(username=name, hashed_password="") for name in ["a", "b"]]
+        session.add_all(users)
+        session.commit()
+        user_ids = [user.id for user in users]
+        course_ids = {}
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            for backend in storage.BACKENDS:
+                monkeypatch.setenv("POINT_STORAGE", backend)
+                course_ids[backend] = course.store_course(
+                    session,
+                    course.iter_fit_columns("tests/activity.fit"),
+                    user_id=user_ids[0],
+                    name=backend,
+                ).id
+        points = course.load_points(session, course_ids["rows"], ["time", "lat", "lon"])
+        yield session, user_ids, course_ids, points
+
+
+def test_points_near(stored):
+    session, (user_id, other_id), course_ids, points = stored
+    lat, lon, radius = points["lat"][5000] + 0.0005, points["lon"][5000], 100
+    distance = distance_to(lat, lon, points["lat"], points["lon"])
+    expected = np.sort(distance[distance <= radius])
+
+    found = spatial.points_near(session, user_id, lat, lon, radius, limit=1000)
+
+    # Each point is found once from the course stored in each backend
+    assert {point["course_id"] for point in found} == set(course_ids.values())
+    np.testing.assert_allclose(
+        [point["distance"] for point in found], np.repeat(expected, 2)
+    )
+    assert len(spatial.points_near(session, user_id, lat, lon, radius, limit=3)) == 3
+    assert spatial.points_near(session, other_id, lat, lon, radius) == []
+
+
+def test_courses_in_box(stored):
+    session, (user_id, other_id), course_ids, points = stored
+    lat, lon = points["lat"][5000], points["lon"][5000]
+
+    found = spatial.courses_in_box(session, user_id, spatial.Box.around(lat, lon, 5))
+    assert {found_course.id for found_course in found} == set(course_ids.values())
+    # The box is within the bounding box of the course, but away from the track
+    middle = spatial.Box.around(
+        (points["lat"].min() + points["lat"].max()) / 2,
+        (points["lon"].min() + points["lon"].max()) / 2,
+        5,
+    )
+    assert spatial.courses_in_box(session, user_id, middle) == []
+    assert spatial.courses_in_box(session, other_id, middle) == []
+
+
+def test_index_course(stored):
+    session, _, course_ids, _ = stored
+
+    def count():
+        return session.exec(
+            select(func.count())
+            .select_from(point_index)
+            .where(point_index.c.course_id == course_ids["blocks"])
+        ).one()
+
+    indexed = count()
+    assert indexed > 0
+    assert spatial.index_course(session, course_ids["blocks"]) == indexed
+    assert count() == indexed
+
+
+def test_index_unavailable(monkeypatch):
+    # Databases other than SQLite have no R-tree to index the points with
+    monkeypatch.setattr(spatial, "has_point_index", lambda bind: False)
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+    with Session(engine) as session:
+        chunks = course.iter_fit_columns("tests/activity.fit")
+        stored = course.store_course(session, chunks, user_id=1, name="a")
+        assert spatial.index_course(session, stored.id) == 0
+        with pytest.raises(spatial.IndexUnavailable):
+            spatial.points_near(session, 1, stored.min_lat, stored.min_lon, 200)
+        course.delete_course(session, stored.id)
+
+
+def test_merge():
+    def at(minute, second):
+        return datetime(2023, 1, 1, 0, minute, second)
+
+    segments = [(at(0, 32), at(0, 40)), (at(0, 0), at(0, 31)), (at(5, 0), at(5, 9))]
+    assert spatial._merge(segments) == [(at(0, 0), at(0, 40)), (at(5, 0), at(5, 9))]
@@ -0,0 +1,144 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from sqlmodel import Session, create_engine, select
+
+from python_demo import course, derived, export, simplify, storage
+from python_demo.models import Course, CourseLevel, PointBlock, create_db_and_tables
+
+
+@pytest.mark.parametrize(
+    ("field", "values"),
+    [
+        (
+            "time",
+            np.array(
+                ["2023-01-01T00:00:00", "NaT", "2023-01-01T00:00:01.5"],
+                dtype="datetime64[us]",
+            ),
+        ),
+        # Positions from FIT files are a whole number of semicircles
+        ("lat", np.array([-416_700_000, np.nan, 2**30 - 1, -(2**31)]) / 2**31 * 180),
+        ("power", np.array([0.0, np.nan, 250.0, 1234.0])),
+        ("detail", np.array([0, 4, 1], dtype=np.int8)),
+        ("cumulative_distance", np.array([0.0, 1.23456789, 123456.789])),
+    ],
+)
+def test_encode_round_trip(field, values):
+    decoded = storage.decode(field, storage.encode(field, values))
+    np.testing.assert_array_equal(decoded, values)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    engine = create_engine("sqlite://")
+    create_db_and_tables(engine)
+    with Session(engine) as session:
+        stored = {}
+        for backend in storage.BACKENDS:
+            monkeypatch.setenv("POINT_STORAGE", backend)
+            stored[backend] = course.store_course(
+                session,
+                # Using small chunks gives blocks of different sizes
+                course.iter_fit_columns("tests/activity.fit", chunk_size=3000),
+                user_id=None,
+                name=backend,
+            ).id
+            simplify.store_levels(session, stored[backend])
+            derived.store_derived(session, stored[backend])
+        yield session, stored
+
+
+def test_blocks_match_rows(session):
+    session, stored = session
+    fields = ["time", "lat", "lon", "power", "heart_rate", "gradient", "detail"]
+    rows, blocks = (
+        course.load_points(session, stored[backend], fields)
+        for backend in storage.BACKENDS
+    )
+
+    assert session.get(Course, stored["blocks"]).storage == "blocks"
+    assert rows["time"].equals(blocks["time"])
+    np.testing.assert_allclose(blocks["lat"], rows["lat"], atol=1e-12)
+    np.testing.assert_allclose(blocks["lon"], rows["lon"], atol=1e-12)
+    for field in ["power", "heart_rate", "detail"]:
+        np.testing.assert_array_equal(blocks[field], rows[field])
+    np.testing.assert_allclose(blocks["gradient"], rows["gradient"], atol=1e-3)
+
+    levels = {
+        backend: [
+            level.n_points
+            for level in session.exec(
+                select(CourseLevel).where(CourseLevel.course_id == stored[backend])
+            )
+        ]
+        for backend in storage.BACKENDS
+    }
+    assert levels["blocks"] == levels["rows"]
+
+
+@pytest.mark.parametrize("level", [0, 2])
+def test_export_blocks(session, level):
+    session, stored = session
+    fields = ["time", "speed", "heart_rate"]
+    rows, blocks = (
+        json.loads(
+            b"".join(
+                export.stream_points(session, stored[backend], fields, "json", level)
+            )
+        )
+        for backend in storage.BACKENDS
+    )
+
+    assert len(blocks) == len(rows)
+    assert [point["time"] for point in blocks] == [point["time"] for point in rows]
+    assert [point["heart_rate"] for point in blocks] == [
+        point["heart_rate"] for point in rows
+    ]
+
+
+def test_move_course(session):
+    session, stored = session
+    fields = ["time", "lat", "speed", "detail", "cumulative_distance"]
+    before = course.load_points(session, stored["rows"], fields)
+
+    moved = session.get(Course, stored["rows"])
+    version = moved.version
+    storage.move_course(session, moved, storage.BLOCKS)
+    assert moved.version == version + 1
+    # The speed is kept as a 32 bit float
+    pd.testing.assert_frame_equal(
+        course.load_points(session, moved.id, fields), before, check_dtype=False
+    )
+    assert derived.is_derived(session, moved.id)
+
+    storage.move_course(session, moved, storage.ROWS)
+    assert moved.version == version + 2
+    after = course.load_points(session, moved.id, fields)
+    assert after["time"].equals(before["time"])
+    np.testing.assert_allclose(after["lat"], before["lat"], atol=1e-12)
+    assert not session.exec(
+        select(PointBlock).where(PointBlock.course_id == moved.id)
+    ).first()
+
+
+def test_migrate_older_database(tmp_path):
+    url = f"sqlite:///{tmp_path / 'old.db'}"
+    engine = create_engine(url)
+    create_db_and_tables(engine)
+    with Session(engine) as session:
+        chunks = course.iter_fit_columns("tests/activity.fit")
+        stored = course.store_course(session, chunks, user_id=None, name="a")
+        course_id, n_points = stored.id, stored.n_points
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE course DROP COLUMN storage"))
+
+    storage.main(["--to", "blocks", "--database", url, "--vacuum"])
+
+    with Session(engine) as session:
+        assert session.get(Course, course_id).storage == "blocks"
+        df = course.load_points(session, course_id, ["id", "time"])
+    assert len(df) == n_points